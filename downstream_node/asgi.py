@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The ASGI entry point, for serving many farmers from one process on an
+# asyncio event loop, e.g.
+#
+#     uvicorn --workers 1 downstream_node.asgi:application
+#
+# Requests are run in a pool of ASGI_THREADS threads, while reading request
+# bodies, writing responses and /challenge/ long polls are awaited on the
+# loop, see downstream_node.asyncserve.  Mongo events are written from a
+# thread of their own, and with HEARTBEAT_PROCESSES set, proofs are
+# verified and challenges generated in worker processes.
+
+from .startup import create_app
+from .asyncserve import AsgiApp, QueuedLogger
+
+app = create_app()
+
+if (app.mongo_logger is not None):
+    app.mongo_logger = QueuedLogger(app.mongo_logger)
+
+application = AsgiApp(app, app.config['ASGI_THREADS'])
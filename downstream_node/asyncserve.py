@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Serves the app over ASGI from an asyncio event loop, see downstream_node.asgi
+# for the entry point.  Under WSGI a worker is tied up for the whole of a
+# request: reading a slow farmer's upload, sleeping through a /challenge/
+# long poll and writing the response.  Here those are awaited on the event
+# loop, and only the routes themselves, which share their logic with the
+# WSGI app, run in a pool of threads where their database and tag file I/O
+# does not block the loop.  That I/O is not itself awaited: the routes are
+# the synchronous ones, so a request holds a thread, and while it queries a
+# database connection, until its route returns, and at most ASGI_THREADS
+# routes run at once.  Requires Python 3.5.
+
+import io
+import sys
+import json
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode
+
+from werkzeug.exceptions import NotFound
+from werkzeug.wsgi import DispatcherMiddleware
+
+from .startup import db
+from .queries import get_token
+from .node import next_challenge_delay
+
+# the number of chunks of a response the route may get ahead of the client
+RESPONSE_BUFFER = 4
+
+
+class QueuedLogger(object):
+
+    """Stands in for the mongo logger, writing its events from a thread of
+    its own so that a slow mongo does not hold up the request threads.
+    Everything else is passed through to the logger.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.executor = ThreadPoolExecutor(1)
+
+    def log_exception(self, ex, context=None):
+        self.log_event('exception', {'type': type(ex).__name__,
+                                     'value': str(ex),
+                                     'context': context})
+
+    def log_event(self, type, value):
+        self.executor.submit(self.logger.log_event, type, value)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def __getattr__(self, name):
+        return getattr(self.logger, name)
+
+
+class AsgiApp(object):
+
+    """Serves a flask app under its APPLICATION_ROOT as an ASGI app"""
+
+    def __init__(self, app, threads):
+        """
+        :param app: the flask app
+        :param threads: the number of threads to run requests in
+        """
+        self.app = app
+        self.root = app.config['APPLICATION_ROOT'] or ''
+        self.wsgi_app = DispatcherMiddleware(NotFound(), {self.root: app})
+        self.executor = ThreadPoolExecutor(threads)
+
+    async def __call__(self, scope, receive, send):
+        if (scope['type'] == 'lifespan'):
+            await self.lifespan(receive, send)
+            return
+        if (scope['type'] != 'http'):
+            raise ValueError('Unsupported scope type.')
+
+        body = await self.read_body(receive)
+        if (body is None):
+            # the farmer went away
+            return
+
+        query = await self.long_poll(scope, body)
+
+        loop = asyncio.get_event_loop()
+        environ = self.environ(scope, query, body)
+        queue = asyncio.Queue(RESPONSE_BUFFER)
+        closed = threading.Event()
+        task = loop.run_in_executor(self.executor, self.respond, environ,
+                                    loop, queue, closed)
+        try:
+            (status, headers) = await self.get(queue)
+            await send({'type': 'http.response.start',
+                        'status': status,
+                        'headers': headers})
+            chunk = await self.get(queue)
+            while (chunk is not None):
+                if (len(chunk) > 0):
+                    await send({'type': 'http.response.body',
+                                'body': chunk,
+                                'more_body': True})
+                chunk = await self.get(queue)
+            await send({'type': 'http.response.body'})
+        finally:
+            # stop the route, should the client have gone away, and let it
+            # finish any chunk it is waiting to put
+            closed.set()
+            while (not queue.empty()):
+                queue.get_nowait()
+            await task
+
+    async def lifespan(self, receive, send):
+        while (True):
+            message = await receive()
+            if (message['type'] == 'lifespan.startup'):
+                await send({'type': 'lifespan.startup.complete'})
+            elif (message['type'] == 'lifespan.shutdown'):
+                self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        """Reads the request body on the event loop, so that a slow upload
+        does not hold a thread
+
+        :returns: the body, or None if the client disconnected
+        """
+        chunks = list()
+        while (True):
+            message = await receive()
+            if (message['type'] == 'http.disconnect'):
+                return None
+            chunks.append(message.get('body', b''))
+            if (not message.get('more_body', False)):
+                return b''.join(chunks)
+
+    async def long_poll(self, scope, body):
+        """Sleeps through the wait of a /challenge/ long poll on the event
+        loop, rather than in the route, so that a waiting farmer only costs
+        a coroutine.  Waits that the route would reject are left for it.
+
+        :param scope: the request scope
+        :param body: the request body
+        :returns: the query string to pass on to the route
+        """
+        query = scope['query_string'].decode('latin-1')
+        prefix = self.root + '/challenge/'
+        path = request_path(scope)
+        if (not path.startswith(prefix) or 'wait=' not in query):
+            return query
+        token = path[len(prefix):]
+        if ('/' in token):
+            return query
+
+        args = parse_qsl(query, keep_blank_values=True)
+        try:
+            timeout = float(dict(args)['wait'])
+        except (KeyError, ValueError):
+            return query
+        if (not timeout > 0):
+            return query
+
+        hashes = None
+        if (scope['method'] == 'POST'):
+            try:
+                hashes = list(json.loads(body.decode('utf-8'))['hashes'])
+            except Exception:
+                # the route responds with the error
+                return query
+
+        loop = asyncio.get_event_loop()
+        delay = await loop.run_in_executor(
+            self.executor, self.challenge_delay, token, hashes, timeout)
+        if (delay > 0):
+            await asyncio.sleep(delay)
+        return urlencode([(k, v) for (k, v) in args if k != 'wait'])
+
+    def challenge_delay(self, token, hashes, timeout):
+        """Returns how long a /challenge/ long poll should wait for
+
+        :param token: the token string
+        :param hashes: the hashes posted, or None
+        :param timeout: the wait asked for
+        :returns: the number of seconds
+        """
+        with self.app.app_context():
+            try:
+                db_token = get_token(token)
+                if (db_token is None):
+                    return 0
+                return next_challenge_delay(db_token.id, hashes, timeout)
+            finally:
+                db.session.remove()
+
+    def environ(self, scope, query, body):
+        """Builds the WSGI environ for a request
+
+        :param scope: the request scope
+        :param query: the query string
+        :param body: the request body
+        :returns: the environ
+        """
+        (server_name, server_port) = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '')
+            .encode('utf-8').decode('latin-1'),
+            'PATH_INFO': request_path(scope)
+            .encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': client[0],
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False}
+        for (name, value) in scope.get('headers', []):
+            name = name.decode('latin-1')
+            value = value.decode('latin-1')
+            if (name == 'content-length'):
+                continue
+            elif (name == 'content-type'):
+                key = 'CONTENT_TYPE'
+            else:
+                key = 'HTTP_' + name.upper().replace('-', '_')
+            if (key in environ):
+                value = environ[key] + ',' + value
+            environ[key] = value
+        return environ
+
+    async def get(self, queue):
+        """Returns the next item the route put on the queue, raising what
+        it raised"""
+        item = await queue.get()
+        if (isinstance(item, BaseException)):
+            raise item
+        return item
+
+    def respond(self, environ, loop, queue, closed):
+        """Calls the WSGI app and iterates its response, in a thread of the
+        pool.  A streamed response is iterated in this one thread, since the
+        flask request context and database session it streams with belong
+        to the thread.  The (status, headers) of the response, then each
+        chunk and then None are put on the queue, or what was raised.
+
+        :param environ: the environ
+        :param loop: the event loop the queue belongs to
+        :param queue: the queue
+        :param closed: set once the response is no longer wanted
+        """
+        def put(item):
+            if (not closed.is_set()):
+                asyncio.run_coroutine_threadsafe(queue.put(item),
+                                                 loop).result()
+
+        response = dict()
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(k.lower().encode('latin-1'),
+                                    v.encode('latin-1')) for (k, v) in headers]
+
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+            try:
+                iterator = iter(iterable)
+                # a WSGI app may only start the response once it is iterated
+                chunk = next(iterator, None)
+                put((response['status'], response['headers']))
+                while (chunk is not None and not closed.is_set()):
+                    put(chunk)
+                    chunk = next(iterator, None)
+                put(None)
+            finally:
+                if (hasattr(iterable, 'close')):
+                    iterable.close()
+        except Exception as ex:
+            put(ex)
+
+    def shutdown(self):
+        self.executor.shutdown()
+        if (isinstance(self.app.mongo_logger, QueuedLogger)):
+            self.app.mongo_logger.shutdown()
+        if (self.app.heartbeat_pool is not None):
+            self.app.heartbeat_pool.shutdown()
+
+
+def request_path(scope):
+    """Returns the path of a request below the root path the app is
+    mounted at.  Servers differ on whether the path of the scope includes
+    it."""
+    path = scope['path']
+    root_path = scope.get('root_path', '')
+    if (len(root_path) > 0 and path.startswith(root_path)):
+        path = path[len(root_path):]
+    return path
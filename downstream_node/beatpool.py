@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Verifying proofs and generating challenges are the cpu heavy parts of a
+# farmer request.  HeartbeatPool runs them in worker processes, so that they
+# do not hold the interpreter lock of the process serving requests, which
+# matters most under the asyncio front end in downstream_node.asgi where a
+# single process serves every farmer.
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# the heartbeat of a worker process, set when it starts
+beat = None
+
+
+def initialize(heartbeat):
+    global beat
+    beat = heartbeat
+
+
+def verify(proof, challenge, state):
+    return beat.verify(proof, challenge, state)
+
+
+def gen_challenge(state):
+    # the state is advanced in the worker, so send it back
+    return (beat.gen_challenge(state), state)
+
+
+class HeartbeatPool(object):
+
+    """Runs the heartbeat in a pool of worker processes.  The heartbeat is
+    sent to each worker once, when it starts.  The executor is created on
+    first use in each process, since its call and result queues are created
+    with it, so a pool created before a pre-forking server forks gives each
+    of its workers an executor of its own.  The calls block the calling
+    thread until the worker is done.
+    """
+
+    def __init__(self, heartbeat, processes):
+        """
+        :param heartbeat: the app wide heartbeat
+        :param processes: the number of worker processes
+        """
+        self.heartbeat = heartbeat
+        self.processes = processes
+        self.lock = threading.Lock()
+        self.executor = None
+        self.executor_pid = None
+
+    def submit(self, fn, *args):
+        """Submits a call to the executor of this process, creating it if
+        need be
+
+        :returns: the future of the call
+        """
+        if (self.executor_pid != os.getpid()):
+            with self.lock:
+                # an executor inherited from the parent would share its
+                # queues, and so its results, with the parent
+                if (self.executor_pid != os.getpid()):
+                    self.executor = ProcessPoolExecutor(
+                        self.processes, initializer=initialize,
+                        initargs=(self.heartbeat,))
+                    self.executor_pid = os.getpid()
+        return self.executor.submit(fn, *args)
+
+    def verify(self, proof, challenge, state):
+        """Verifies a proof in a worker
+
+        :returns: whether the proof is valid
+        """
+        return self.submit(verify, proof, challenge, state).result()
+
+    def gen_challenge(self, state):
+        """Generates the next challenge for a state in a worker.  The state
+        passed in is left as it is.
+
+        :returns: a (challenge, state) tuple of the challenge and the
+            advanced state
+        """
+        return self.submit(gen_challenge, state).result()
+
+    def shutdown(self):
+        if (self.executor_pid == os.getpid()):
+            self.executor.shutdown()
+        self.executor = None
+        self.executor_pid = None
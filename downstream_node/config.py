@@ -12,9 +12,25 @@ SERVER_ALIAS = 'dsnode'
 
 # SQLAlchemy (DB)
 SQLALCHEMY_DATABASE_URI = 'mysql+pymysql://localhost/downstream'  # NOQA
+# the node also runs on sqlite (e.g. sqlite:///data/downstream.db) for
+# small deployments, in which case it is opened in WAL mode
+SQLITE_WAL = True
+# the status views read from this replica while it is no more than
+# REPLICA_MAX_LAG seconds behind, and from the primary otherwise.  the lag
+# is checked every REPLICA_CHECK_INTERVAL seconds
+SQLALCHEMY_REPLICA_URI = None
+REPLICA_MAX_LAG = 5
+REPLICA_CHECK_INTERVAL = 5
+# the status views bring the farmer uptime summary up to date on the
+# primary at most every UPTIME_SUMMARY_INTERVAL seconds in each worker, so
+# what they report may be that old.  0 leaves it to runapp.py
+# --summary-interval, so that the status views never touch the primary
+UPTIME_SUMMARY_INTERVAL = 60
 
 FILES_PATH = 'tmp/'
 TAGS_PATH = 'tags/'
+# look up the location of new farmers in the GeoIP database at MMDB_PATH
+GEOIP = True
 MMDB_PATH = 'data/GeoLite2-City.mmdb'
 
 # the heartbeat we use should probably eventually be associated with
@@ -25,9 +41,83 @@ HEARTBEAT_PATH = 'data/heartbeat'
 MONGO_LOGGING = False
 MONGO_URI = 'mongodb://localhost/dsnode_log'
 PROFILE = False
+# 'sample' periodically samples the stacks of the threads serving requests
+# and is cheap enough to leave on.  'line' runs every request under
+# line_profiler, which is very slow
+PROFILE_MODE = 'sample'
+PROFILE_SAMPLE_RATE = 100
+PROFILE_FLUSH_INTERVAL = 60
+# count and time the queries issued by each request.  in debug mode the
+# figures are sent in X-Query-* headers and /debug/queries/ shows them
+# per route
+SQL_STATS = True
+# serve request, proof and pool metrics at /metrics in the prometheus text
+# format
+METRICS = True
+# record statements slower than SLOW_QUERY_THRESHOLD seconds, with an
+# EXPLAIN of each distinct statement, in a local sqlite database.  they are
+# written by a thread of each worker, off the request path.  view them with
+# runapp.py --slow-queries.  the EXPLAINs run against the database, so it
+# is off by default
+SLOW_QUERY_LOG = False
+SLOW_QUERY_PATH = 'data/slow_queries.db'
+SLOW_QUERY_THRESHOLD = 0.5
+SLOW_QUERY_MAX_ENTRIES = 10000
+# trace allocations with tracemalloc, and take snapshots of the allocation
+# sites in downstream_node on demand at /debug/memory/, which requires
+# MEMORY_PROFILE_KEY.  tracing slows every allocation, so only turn it on
+# while hunting a leak
+MEMORY_PROFILE = False
+MEMORY_PROFILE_KEY = None
+MEMORY_PROFILE_FRAMES = 10
+MEMORY_PROFILE_SNAPSHOTS = 20
 
 DEFAULT_CHUNK_SIZE = 32000
 MAX_TOKENS_PER_IP = 5
 MIN_SJCX_BALANCE = 10000
 MAX_SIG_MESSAGE_SIZE = 1024
+
+# keep an in memory index of the whitelist in each worker.  runapp.py
+# --whitelist touches the stamp file so that workers reload their index
+WHITELIST_INDEX = False
+WHITELIST_STAMP_PATH = 'data/whitelist.stamp'
+WHITELIST_CHECK_INTERVAL = 5
+
+# the longest a /challenge/?wait= long poll is held for, in seconds.  long
+# polls sleep, so they are refused unless they are served by a cooperative
+# worker (gunicorn -k gevent) or the asyncio front end
+CHALLENGE_MAX_WAIT = 60
+# hold long polls even when the sleep blocks the thread serving them, which
+# ties up a thread, or a sync worker, per waiting farmer
+CHALLENGE_WAIT_BLOCKING = False
+
+# the number of deserialized contract heartbeat states and challenges each
+# worker keeps, by contract id and state version, so that contracts polled
+# every interval are only unpickled when they change.  0 turns it off
+STATE_CACHE_SIZE = 10000
+
+# verify proofs and generate challenges in this many worker processes, so
+# that they do not hold the interpreter lock of the process serving
+# requests.  0 runs them in process.  needs python 3.7
+HEARTBEAT_PROCESSES = 0
+# the number of threads the asyncio front end, downstream_node.asgi, runs
+# requests in.  keep it near the database connection pool size, since the
+# threads only run routes and long polls wait on the event loop
+ASGI_THREADS = 16
+
+# compress responses of at least COMPRESS_MIN_SIZE bytes with gzip or
+# deflate when the farmer accepts it.  smaller ones are not worth the cpu
+COMPRESS = True
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+# serve /chunk/, /challenge/, /answer/ and the status list as msgpack to
+# farmers that accept application/x-msgpack, if the msgpack package is
+# installed
+MSGPACK = True
+# stream the json of /chunk/ and the status list, encoding each chunk or
+# farmer as it is sent, rather than building the whole document first.  off
+# by default, since the status list then holds a replica connection for as
+# long as the client takes to read it
+STREAM_JSON = False
+
 REQUIRE_SIGNATURE = False
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Response encodings.  install() compresses responses of at least
+# COMPRESS_MIN_SIZE bytes with gzip or deflate for farmers that accept it,
+# and respond() encodes the farmer route responses as msgpack rather than
+# json for farmers that ask for application/x-msgpack, when the msgpack
+# package is installed.  tests/wirebench.py measures both.  respond_list()
+# streams long lists as json, see STREAM_JSON.
+
+import zlib
+
+from flask import current_app, request, jsonify, json, stream_with_context
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MIMETYPE = 'application/x-msgpack'
+
+# streamed json is written out in pieces of about this many bytes
+STREAM_BUFFER_SIZE = 16384
+
+# content coding -> wbits of the zlib stream.  gzip has a gzip header and
+# deflate, as used over http, is a zlib stream
+CODINGS = {'gzip': 16 + zlib.MAX_WBITS,
+           'deflate': zlib.MAX_WBITS}
+
+
+def compress(data, coding, level):
+    """Compresses data with a content coding
+
+    :param data: the bytes to compress
+    :param coding: 'gzip' or 'deflate'
+    :param level: the zlib compression level
+    :returns: the compressed bytes
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, CODINGS[coding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def accepts_msgpack():
+    """Returns whether the current request prefers msgpack to json and it
+    can be served"""
+    return (msgpack is not None and
+            request.accept_mimetypes.best_match(
+                ['application/json', MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE)
+
+
+def respond(obj):
+    """Returns the response for obj, encoded as msgpack if the farmer asked
+    for it and MSGPACK is on, and as json otherwise
+
+    :param obj: the response object
+    :returns: the response
+    """
+    if (current_app.config['MSGPACK'] and accepts_msgpack()):
+        # values msgpack has no type for, such as the due dates of the
+        # status list, are encoded as they are in json
+        response = current_app.response_class(
+            msgpack.packb(obj, use_bin_type=True,
+                          default=current_app.json_encoder().default),
+            mimetype=MSGPACK_MIMETYPE)
+    else:
+        response = jsonify(obj)
+    response.vary.add('Accept')
+    return response
+
+
+def compress_stream(chunks, coding, level):
+    """Compresses a streamed body as it is produced
+
+    :param chunks: an iterable of the body
+    :param coding: 'gzip' or 'deflate'
+    :param level: the zlib compression level
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, CODINGS[coding])
+    try:
+        for chunk in chunks:
+            if (not isinstance(chunk, bytes)):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if (len(data) > 0):
+                yield data
+        yield compressor.flush()
+    finally:
+        # let the body clean up if the client goes away part way
+        if (hasattr(chunks, 'close')):
+            chunks.close()
+
+
+def stream_json(key, items, done=None):
+    """Returns a response that encodes {key: [items]} as json as the items
+    are produced, so that the list is never held in memory and the first
+    bytes go out before the last item is produced.  The document is the one
+    jsonify() would build, apart from whitespace.  An error part way through
+    can only cut the response short.
+
+    :param key: the member that holds the list
+    :param items: an iterable of the items
+    :param done: called once every item has been encoded
+    :returns: the response
+    """
+    def generate():
+        buf = ['{{{0}: ['.format(json.dumps(key))]
+        size = 0
+        separator = ''
+        for item in items:
+            piece = separator + json.dumps(item)
+            separator = ', '
+            buf.append(piece)
+            size += len(piece)
+            if (size >= STREAM_BUFFER_SIZE):
+                yield ''.join(buf).encode('utf-8')
+                buf = list()
+                size = 0
+        buf.append(']}\n')
+        yield ''.join(buf).encode('utf-8')
+        if (done is not None):
+            done()
+
+    # keep the request, and the database session, around while streaming
+    return current_app.response_class(stream_with_context(generate()),
+                                      mimetype='application/json')
+
+
+def respond_list(key, items, done=None):
+    """Returns the response for {key: [items]}: streamed as json if
+    STREAM_JSON is on, see stream_json(), and otherwise built whole by
+    respond(), as it is when the farmer asked for msgpack
+
+    :param key: the member that holds the list
+    :param items: an iterable of the items
+    :param done: called once every item has been encoded
+    :returns: the response
+    """
+    if (current_app.config['STREAM_JSON'] and
+            not (current_app.config['MSGPACK'] and accepts_msgpack())):
+        response = stream_json(key, items, done)
+        response.vary.add('Accept')
+        return response
+    response = respond({key: list(items)})
+    if (done is not None):
+        done()
+    return response
+
+
+def compress_response(response, min_size, level):
+    """Compresses a response with the best content coding the request
+    accepts.  Streamed responses are compressed as they are streamed,
+    whatever their size.  Already encoded, unsuccessful and small responses
+    are left as they are.
+
+    :param response: the response
+    :param min_size: the smallest body to compress, in bytes
+    :param level: the zlib compression level
+    :returns: the response
+    """
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or response.direct_passthrough or
+            'Content-Encoding' in response.headers):
+        return response
+    coding = request.accept_encodings.best_match(['gzip', 'deflate'])
+    if (coding is None):
+        return response
+    if (response.is_streamed):
+        response.response = compress_stream(response.response, coding, level)
+        response.headers.pop('Content-Length', None)
+        response.headers['Content-Encoding'] = coding
+        return response
+    data = response.get_data()
+    if (len(data) < min_size):
+        return response
+    response.set_data(compress(data, coding, level))
+    response.headers['Content-Encoding'] = coding
+    # the body now differs by encoding, so only a weak etag still holds
+    (etag, weak) = response.get_etag()
+    if (etag is not None and not weak):
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def install(app):
+    """Compresses the responses of app, see compress_response()
+
+    :param app: the app
+    """
+    @app.after_request
+    def compress_after_request(response):
+        return compress_response(response,
+                                 app.config['COMPRESS_MIN_SIZE'],
+                                 app.config['COMPRESS_LEVEL'])
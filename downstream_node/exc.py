@@ -1,6 +1,9 @@
 from flask import jsonify
 import traceback
 
+from .sqlstats import current_stats
+from .metrics import count_error
+
 
 class NotFoundError(Exception):
     pass
@@ -12,15 +15,17 @@ class InvalidParameterError(Exception):
 
 class HttpHandler(object):
 
-    def __init__(self, logger=None, context=dict()):
+    def __init__(self, logger=None, context=None):
         """
         :param logger: the mongolog logger to use
         :param context: a dictionary of extra data to log
-            as a context for any exceptions that may occur
+            as a context for any exceptions that may occur, and for the
+            events logged with log_event().  the queries issued by the
+            current request are added to it
         """
         self.response = None
         self.logger = logger
-        self.context = context
+        self.context = context if context is not None else dict()
 
     def __enter__(self):
         """
@@ -31,25 +36,48 @@ class HttpHandler(object):
         """
         return self
 
+    def add_query_stats(self):
+        """Adds the queries issued by the current request so far to the
+        context"""
+        stats = current_stats()
+        if (stats is not None):
+            self.context['queries'] = stats.todict()
+
+    def log_event(self, type, response):
+        """Logs a request that succeeded, with the context and the queries
+        it issued
+
+        :param type: the event type
+        :param response: the response, or a summary of it
+        """
+        if (self.logger is not None):
+            self.add_query_stats()
+            self.logger.log_event(type, {'context': self.context,
+                                         'response': response})
+
     def __exit__(self, type, value, tb):
         if (type is not None and self.logger is not None):
+            self.add_query_stats()
             self.logger.log_exception(value, self.context)
 
         if (type is NotFoundError):
             self.response = jsonify(status='error',
                                     message=str(value))
             self.response.status_code = 404
+            count_error(404)
             return True
         elif (type is InvalidParameterError):
             self.response = jsonify(status='error',
                                     message=str(value))
             self.response.status_code = 400
+            count_error(400)
             return True
         elif (type is not None):
             self.response = jsonify(status='error',
                                     message='Internal Server Error')
             traceback.print_exception(type, value, tb)
             self.response.status_code = 500
+            count_error(500)
             return True
         else:
             return
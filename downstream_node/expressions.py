@@ -0,0 +1,111 @@
+from sqlalchemy import Integer, DateTime, case
+from sqlalchemy.sql.functions import GenericFunction
+from sqlalchemy.ext.compiler import compiles
+
+# SQL expressions that are compiled differently for MySQL, SQLite and
+# PostgreSQL, so that the models do not depend on MySQL only functions.
+# Unknown dialects get the MySQL form.
+
+# SQLite has no date arithmetic in seconds, so differences are taken in
+# julian days and rounded to milliseconds before truncating to seconds
+SQLITE_SECONDS = \
+    'CAST(ROUND((julianday({1}) - julianday({0})) * 86400000) AS INTEGER) ' \
+    '/ 1000'
+
+
+def if_(condition, if_true, if_false):
+    """Returns if_true where condition holds and if_false otherwise, like
+    MySQL's IF()
+    """
+    return case([(condition, if_true)], else_=if_false)
+
+
+class timestamp_diff(GenericFunction):
+
+    """The whole number of seconds from start to end, like MySQL's
+    TIMESTAMPDIFF(SECOND, start, end)
+    """
+
+    type = Integer()
+    name = 'timestamp_diff'
+
+
+class timestamp_add(GenericFunction):
+
+    """The timestamp seconds after timestamp, like MySQL's
+    TIMESTAMPADD(SECOND, seconds, timestamp)
+    """
+
+    type = DateTime()
+    name = 'timestamp_add'
+
+
+class interval_seconds(GenericFunction):
+
+    """The whole number of seconds in an Interval column.  Interval is
+    stored as a DATETIME after the epoch on MySQL and SQLite, and natively on
+    PostgreSQL.
+    """
+
+    type = Integer()
+    name = 'interval_seconds'
+
+
+def arguments(element, compiler, **kw):
+    return [compiler.process(c, **kw) for c in element.clauses]
+
+
+@compiles(timestamp_diff)
+def compile_timestamp_diff(element, compiler, **kw):
+    return 'TIMESTAMPDIFF(SECOND, {0}, {1})'.format(
+        *arguments(element, compiler, **kw))
+
+
+@compiles(timestamp_diff, 'sqlite')
+def compile_timestamp_diff_sqlite(element, compiler, **kw):
+    return SQLITE_SECONDS.format(*arguments(element, compiler, **kw))
+
+
+@compiles(timestamp_diff, 'postgresql')
+def compile_timestamp_diff_postgresql(element, compiler, **kw):
+    return 'CAST(TRUNC(EXTRACT(EPOCH FROM ({1} - {0}))) AS BIGINT)'.format(
+        *arguments(element, compiler, **kw))
+
+
+@compiles(timestamp_add)
+def compile_timestamp_add(element, compiler, **kw):
+    return 'TIMESTAMPADD(SECOND, {0}, {1})'.format(
+        *arguments(element, compiler, **kw))
+
+
+@compiles(timestamp_add, 'sqlite')
+def compile_timestamp_add_sqlite(element, compiler, **kw):
+    # SQLite compares timestamps as strings, so match the format
+    # SQLAlchemy stores them in, with six fractional digits
+    return "(strftime('%Y-%m-%d %H:%M:%f', {1}, " \
+        "CAST({0} AS TEXT) || ' seconds') || '000')".format(
+            *arguments(element, compiler, **kw))
+
+
+@compiles(timestamp_add, 'postgresql')
+def compile_timestamp_add_postgresql(element, compiler, **kw):
+    return "({1} + {0} * INTERVAL '1 second')".format(
+        *arguments(element, compiler, **kw))
+
+
+@compiles(interval_seconds)
+def compile_interval_seconds(element, compiler, **kw):
+    return "TIMESTAMPDIFF(SECOND, '1970-01-01', {0})".format(
+        *arguments(element, compiler, **kw))
+
+
+@compiles(interval_seconds, 'sqlite')
+def compile_interval_seconds_sqlite(element, compiler, **kw):
+    return SQLITE_SECONDS.format("'1970-01-01 00:00:00'",
+                                 *arguments(element, compiler, **kw))
+
+
+@compiles(interval_seconds, 'postgresql')
+def compile_interval_seconds_postgresql(element, compiler, **kw):
+    return 'CAST(TRUNC(EXTRACT(EPOCH FROM {0})) AS BIGINT)'.format(
+        *arguments(element, compiler, **kw))
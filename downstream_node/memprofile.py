@@ -0,0 +1,203 @@
+import os
+import sys
+import time
+import hmac
+import threading
+import linecache
+from collections import deque
+
+from flask import request
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2 needs the pytracemalloc backport
+    tracemalloc = None
+
+PACKAGE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# tracebacks list the oldest frame first since python 3.7
+OLDEST_FRAME_FIRST = sys.version_info >= (3, 7)
+
+
+def innermost_frame(traceback, prefix):
+    """Returns the most recent frame of a traceback that is in a file under
+    prefix, or None if there is none
+    """
+    if (OLDEST_FRAME_FIRST):
+        traceback = reversed(traceback)
+    for frame in traceback:
+        if (frame.filename.startswith(prefix)):
+            return frame
+    return None
+
+
+def allocation_sites(snapshot, prefix=PACKAGE_PATH):
+    """Sums the memory held by a snapshot per line of code under prefix.
+    Each allocation is attributed to the innermost line under prefix in
+    its traceback, so memory allocated by sqlalchemy or pickle on behalf of
+    the node is counted against the line of the node that asked for it.
+
+    :param snapshot: the tracemalloc snapshot
+    :param prefix: the directory whose files allocations are attributed to
+    :returns: a dict mapping (filename, lineno) to (size, count)
+    """
+    sites = dict()
+    for stat in snapshot.statistics('traceback'):
+        frame = innermost_frame(stat.traceback, prefix)
+        if (frame is None):
+            continue
+        key = (frame.filename, frame.lineno)
+        (size, count) = sites.get(key, (0, 0))
+        sites[key] = (size + stat.size, count + stat.count)
+    return sites
+
+
+def diff_sites(old, new, prefix=PACKAGE_PATH, limit=20):
+    """Compares the allocation sites of two snapshots
+
+    :param old: the sites of the earlier snapshot, or an empty dict
+    :param new: the sites of the later snapshot
+    :param prefix: stripped from the file names
+    :param limit: the number of sites to return
+    :returns: a list of dicts, ordered by the largest change in size first
+    """
+    diffs = list()
+    for key in set(old.keys()) | set(new.keys()):
+        (old_size, old_count) = old.get(key, (0, 0))
+        (size, count) = new.get(key, (0, 0))
+        (filename, lineno) = key
+        diffs.append(dict(
+            site='{0}:{1}'.format(
+                os.path.relpath(filename, os.path.dirname(prefix)), lineno),
+            line=linecache.getline(filename, lineno).strip(),
+            size=size,
+            size_diff=size - old_size,
+            count=count,
+            count_diff=count - old_count))
+    diffs.sort(key=lambda d: (abs(d['size_diff']), d['size']), reverse=True)
+    return diffs[:limit]
+
+
+class MemoryProfiler(object):
+
+    """Takes tracemalloc snapshots on demand, either immediately or after
+    the next request to a route, and keeps the allocation sites of the
+    most recent max_snapshots of each so that they can be compared over
+    time.  Tracing slows allocation down, so it is only meant to be turned
+    on while hunting a leak.
+    """
+
+    def __init__(self, frames=10, max_snapshots=20, prefix=PACKAGE_PATH):
+        """
+        :param frames: the number of frames tracemalloc records for each
+            allocation.  deeper stacks attribute more allocations to the
+            node, at the cost of memory
+        :param max_snapshots: the number of snapshots to keep per route
+        :param prefix: the directory whose files allocations are
+            attributed to
+        """
+        if (tracemalloc is None):
+            raise RuntimeError('Memory profiling requires tracemalloc.')
+        self.frames = frames
+        self.max_snapshots = max_snapshots
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        # routes to take a snapshot after the next request to
+        self.pending = set()
+        # route -> deque of snapshot dicts
+        self.snapshots = dict()
+
+    def start(self):
+        if (not tracemalloc.is_tracing()):
+            tracemalloc.start(self.frames)
+
+    def request_snapshot(self, route):
+        """Takes a snapshot after the next request to route finishes"""
+        with self.lock:
+            self.pending.add(route)
+
+    def take_snapshot(self, route):
+        """Takes a snapshot now and stores it under route
+
+        :param route: the route the snapshot is for
+        :returns: the number of snapshots stored for route
+        """
+        # leave out the memory held by the profiler itself
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, __file__, all_frames=True),
+            tracemalloc.Filter(False, tracemalloc.__file__)])
+        (current, peak) = tracemalloc.get_traced_memory()
+        entry = dict(time=time.time(),
+                     traced=current,
+                     peak=peak,
+                     sites=allocation_sites(snapshot, self.prefix))
+        with self.lock:
+            snapshots = self.snapshots.setdefault(
+                route, deque(maxlen=self.max_snapshots))
+            snapshots.append(entry)
+            return len(snapshots)
+
+    def routes(self):
+        """Returns the number of snapshots and the traced memory of the
+        latest one for each route
+        """
+        with self.lock:
+            return dict((route, dict(snapshots=len(s),
+                                     time=s[-1]['time'],
+                                     traced=s[-1]['traced']))
+                        for (route, s) in self.snapshots.items())
+
+    def diff(self, route, first=0, last=-1, limit=20):
+        """Compares two snapshots of route
+
+        :param route: the route
+        :param first: the index of the earlier snapshot.  with a single
+            snapshot, it is compared against nothing
+        :param last: the index of the later snapshot
+        :param limit: the number of allocation sites to return
+        :returns: a dict, or None if there are no snapshots of route
+        """
+        with self.lock:
+            snapshots = list(self.snapshots.get(route, ()))
+        if (len(snapshots) == 0):
+            return None
+        new = snapshots[last]
+        old = snapshots[first] if len(snapshots) > 1 else dict(
+            time=None, traced=0, sites=dict())
+        return dict(route=route,
+                    first=old['time'],
+                    last=new['time'],
+                    traced=new['traced'],
+                    traced_diff=new['traced'] - old['traced'],
+                    sites=diff_sites(old['sites'], new['sites'],
+                                     self.prefix, limit))
+
+    def finish_request(self, exception=None):
+        if (request.url_rule is None):
+            return
+        route = request.url_rule.rule
+        with self.lock:
+            if (route not in self.pending):
+                return
+            self.pending.discard(route)
+        self.take_snapshot(route)
+
+    def install(self, app):
+        """Starts tracing and takes requested snapshots as requests finish
+
+        :param app: the app to install into
+        """
+        self.start()
+        app.teardown_request(self.finish_request)
+
+
+def check_key(key):
+    """Returns whether the key given with the current request, in the
+    X-Memory-Profile-Key header or the key argument, matches key
+    """
+    given = request.headers.get('X-Memory-Profile-Key',
+                                request.args.get('key'))
+    if (key is None or given is None):
+        return False
+    return hmac.compare_digest(given.encode('utf-8'), key.encode('utf-8'))
@@ -0,0 +1,256 @@
+import time
+import threading
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+from .utils import Histogram, LATENCY_BUCKETS, UNMATCHED_ROUTE
+
+
+def format_labels(names, values):
+    if (len(names) == 0):
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(
+        n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for (n, v) in zip(names, values)) + '}'
+
+
+def format_value(value):
+    if (value == float('inf')):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+
+    """A named family of values, one for each combination of label values.
+    Updates take a lock and touch a single dict entry, so metrics are cheap
+    enough to update on every request.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        """
+        :param name: the metric name
+        :param help: a description of the metric
+        :param labels: the names of the labels the values are keyed by
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def samples(self):
+        """Returns a list of (suffix, label names, label values, value)"""
+        with self.lock:
+            return [('', self.labels, k, v) for (k, v) in
+                    sorted(self.values.items())]
+
+    def expose(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help),
+                 '# TYPE {0} {1}'.format(self.name, self.type)]
+        for (suffix, names, values, value) in self.samples():
+            lines.append('{0}{1}{2} {3}'.format(
+                self.name, suffix, format_labels(names, values),
+                format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+    def replace(self, values):
+        """Replaces all the values of the gauge
+
+        :param values: a dict mapping label values to value
+        """
+        with self.lock:
+            self.values = dict(values)
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+
+class Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.histogram.observe(time.time() - self.start, self.labels)
+
+
+class HistogramMetric(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), bounds=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.bounds = bounds
+
+    def observe(self, value, labels=()):
+        histogram = self.values.get(labels)
+        if (histogram is None):
+            with self.lock:
+                histogram = self.values.setdefault(labels,
+                                                   Histogram(self.bounds))
+        histogram.observe(value)
+
+    def time(self, labels=()):
+        """Returns a context manager that observes how long its block
+        takes"""
+        return Timer(self, labels)
+
+    def get(self, labels=()):
+        return self.values.get(labels)
+
+    def samples(self):
+        names = self.labels + ('le',)
+        samples = list()
+        with self.lock:
+            items = sorted(self.values.items())
+        for (values, histogram) in items:
+            with histogram.lock:
+                cumulative = histogram.cumulative()
+                total = histogram.total
+            for (bound, count) in cumulative:
+                le = format_value(float('inf') if bound is None else bound)
+                samples.append(('_bucket', names, values + (le,), count))
+            samples.append(('_sum', self.labels, values, total))
+            samples.append(('_count', self.labels, values,
+                            cumulative[-1][1]))
+        return samples
+
+
+class Registry(object):
+
+    """A collection of metrics that can be exposed in the prometheus text
+    format"""
+
+    def __init__(self):
+        self.metrics = list()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), bounds=LATENCY_BUCKETS):
+        return self.register(HistogramMetric(name, help, labels, bounds))
+
+    def expose(self):
+        return '\n'.join(m.expose() for m in self.metrics) + '\n'
+
+
+registry = Registry()
+
+request_latency = registry.histogram(
+    'downstream_request_duration_seconds',
+    'Time taken to serve requests, by route',
+    ['route'])
+requests = registry.counter(
+    'downstream_requests_total',
+    'Requests served, by route and status code',
+    ['route', 'status'])
+errors = registry.counter(
+    'downstream_errors_total',
+    'Exceptions turned into error responses, by route and status code',
+    ['route', 'status'])
+proof_verify_time = registry.histogram(
+    'downstream_proof_verify_seconds',
+    'Time taken to verify a heartbeat proof')
+challenge_gen_time = registry.histogram(
+    'downstream_challenge_generate_seconds',
+    'Time taken to generate a heartbeat challenge')
+chunk_pool = registry.gauge(
+    'downstream_chunk_pool',
+    'Pregenerated chunks waiting to be handed out, by chunk size',
+    ['size'])
+db_checkouts = registry.counter(
+    'downstream_db_pool_checkouts_total',
+    'Connections checked out of the database pool')
+db_checked_out = registry.gauge(
+    'downstream_db_pool_checked_out',
+    'Connections currently checked out of the database pool')
+reporting_reads = registry.counter(
+    'downstream_reporting_reads_total',
+    'Reporting reads, by the engine they were routed to',
+    ['engine'])
+replica_lag = registry.gauge(
+    'downstream_replica_lag_seconds',
+    'Seconds the read replica was behind the primary when last checked')
+state_cache = registry.gauge(
+    'downstream_state_cache',
+    'Size, capacity, hits, misses, evictions and hit rate of the contract '
+    'state cache',
+    ['stat'])
+
+
+def get_route():
+    if (request.url_rule is not None):
+        return request.url_rule.rule
+    return UNMATCHED_ROUTE
+
+
+def count_error(status):
+    """Counts an error response for the current request
+
+    :param status: the status code of the response
+    """
+    if (has_request_context()):
+        errors.inc((get_route(), str(status)))
+
+
+def start_request():
+    g.metrics_start = time.time()
+
+
+def finish_request(response):
+    start = getattr(g, 'metrics_start', None)
+    if (start is not None):
+        route = get_route()
+        request_latency.observe(time.time() - start, (route,))
+        requests.inc((route, str(response.status_code)))
+    return response
+
+
+def count_checkout(dbapi_connection, connection_record, connection_proxy):
+    db_checkouts.inc()
+
+
+def install(app):
+    """Times and counts each request served by app, and counts database
+    connection checkouts
+
+    :param app: the app to instrument
+    """
+    if (not event.contains(Pool, 'checkout', count_checkout)):
+        event.listen(Pool, 'checkout', count_checkout)
+    app.before_request(start_request)
+    app.after_request(finish_request)
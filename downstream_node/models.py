@@ -1,14 +1,40 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from sqlalchemy import func, text, Float, bindparam
+import time
+import threading
+
+from sqlalchemy import func, cast, Float, bindparam
 from sqlalchemy.sql import select
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import object_session
 from sqlalchemy.sql.expression import false, true
 from datetime import datetime, timedelta
 
 from .startup import db
 from .uptime import UptimeSummary, UptimeCalculator
 from .types import MutableTypeWrapper
+from .expressions import (if_, timestamp_diff, timestamp_add,
+                          interval_seconds)
+
+# when this process last brought the uptime summary up to date, see
+# refresh_uptime_summary()
+summary_lock = threading.Lock()
+summary_updated = None
+
+
+def make_location(row):
+    """Returns the location dict served by the status views from a token,
+    or from a row with its location columns
+
+    :param row: the token or row
+    :returns: the location
+    """
+    return {'country': row.country,
+            'state': row.region,
+            'city': row.city,
+            'zip': row.postal_code,
+            'lat': row.latitude,
+            'lon': row.longitude}
 
 
 class File(db.Model):
@@ -50,7 +76,18 @@ class Token(db.Model):
     ip_address = db.Column(db.String(32), nullable=False, index=True)
     farmer_id = db.Column(db.String(20), nullable=False, unique=True)
     hbcount = db.Column(db.Integer(), nullable=False, default=0)
-    location = db.Column(db.PickleType())
+    # incremented by each transaction that changes the challenge or status
+    # of the token's contracts, see node.challenge_seq()
+    challenge_seq = db.Column(db.Integer(), nullable=False, default=0)
+    # where the farmer's ip address was when it last changed, see
+    # node.get_ip_location().  typed rather than pickled so that farmers can
+    # be grouped by country and region in sql
+    country = db.Column(db.String(64))
+    region = db.Column(db.String(64))
+    city = db.Column(db.String(64))
+    postal_code = db.Column(db.String(16))
+    latitude = db.Column(db.Float())
+    longitude = db.Column(db.Float())
     # shouldn't need unicode, since it will have come over JSON which will have
     # escaped any unicode characters.  need to test that behavior.
     message = db.Column(db.Text())
@@ -67,13 +104,46 @@ class Token(db.Model):
                                                  lazy='dynamic',
                                                  cascade='all, delete-orphan'))
 
+    __table_args__ = (
+        db.Index('ix_tokens_country_region', 'country', 'region'), )
+
+    @property
+    def location(self):
+        return make_location(self)
+
+    @location.setter
+    def location(self, location):
+        if (location is None):
+            location = dict()
+        self.country = location.get('country')
+        self.region = location.get('state')
+        self.city = location.get('city')
+        self.postal_code = location.get('zip')
+        self.latitude = location.get('lat')
+        self.longitude = location.get('lon')
+
+    def aggregate_contracts(self, column, online=False):
+        """Computes an aggregate over the contracts of this token in the
+        database, so that the contracts themselves are not loaded
+
+        :param column: the aggregate, over contracts joined to their files
+        :param online: only aggregate the online contracts
+        :returns: the value of the aggregate
+        """
+        session = object_session(self) or db.session
+        q = session.query(column).select_from(Contract).join(File).\
+            filter(Contract.token_id == self.id)
+        if (online):
+            q = q.filter(Contract.online)
+        return q.scalar()
+
     @hybrid_property
     def online(self):
-        return any(c.expiration > datetime.utcnow() for c in self.contracts)
+        return self.online_count > 0
 
     @online.expression
     def online(self):
-        return func.IF(func.sum(Contract.online) > 0, true(), false())
+        return if_(func.sum(if_(Contract.online, 1, 0)) > 0, true(), false())
 
     @hybrid_property
     def online_time(self):
@@ -91,10 +161,8 @@ class Token(db.Model):
     # Return the date of the contract with the latest due date.
     @property
     def last_due(self):
-        contracts = Contract.query.filter(Contract.token_id == self.id).all()
-        sorted_dates = sorted([c.due for c in contracts])
-        num_dates = len(sorted_dates)
-        return sorted_dates.pop().isoformat() if num_dates > 0 else None
+        due = self.aggregate_contracts(func.max(Contract.due))
+        return due.isoformat() if due is not None else None
 
     @hybrid_property
     def contract_count(self):
@@ -102,7 +170,8 @@ class Token(db.Model):
 
     @hybrid_property
     def size(self):
-        return sum(c.file.size for c in self.contracts)
+        return int(self.aggregate_contracts(
+            func.coalesce(func.sum(File.size), 0)))
 
     @hybrid_property
     def addr(self):
@@ -110,37 +179,34 @@ class Token(db.Model):
 
     @total_time.expression
     def total_time(cls):
-        return func.TIMESTAMPDIFF(text('second'),
-                                  cls.__table__.c.start,
-                                  cls.__table__.c.end)
+        return timestamp_diff(cls.__table__.c.start, cls.__table__.c.end)
 
     @online_time.expression
     def online_time(cls):
-        return func.TIMESTAMPDIFF(text('second'),
-                                  '1970-01-01',
-                                  cls.__table__.c.upsum)
+        return interval_seconds(cls.__table__.c.upsum)
 
     @fraction.expression
     def fraction(cls):
-        return func.IF(func.ABS(cls.total_time) > 0,
-                       func.cast(cls.online_time, Float) /
-                       func.cast(cls.total_time, Float), 0)
+        return if_(func.abs(cls.total_time) > 0,
+                   cast(cls.online_time, Float) /
+                   cast(cls.total_time, Float), 0)
 
     @hybrid_property
     def online_count(self):
-        return sum([1 for c in self.contracts if c.online])
+        return int(self.aggregate_contracts(func.count(Contract.id), True))
 
     @online_count.expression
     def online_count(cls):
-        return func.sum(func.IF(Contract.online, 1, 0))
+        return func.sum(if_(Contract.online, 1, 0))
 
     @hybrid_property
     def online_size(self):
-        return sum([c.size for c in self.contracts if c.online])
+        return int(self.aggregate_contracts(
+            func.coalesce(func.sum(File.size), 0), True))
 
     @online_size.expression
     def online_size(cls):
-        return func.sum(func.IF(Contract.online, File.__table__.c.size, 0))
+        return func.sum(if_(Contract.online, File.__table__.c.size, 0))
 
 
 class Chunk(db.Model):
@@ -153,7 +219,8 @@ class Chunk(db.Model):
 
     id = db.Column(db.Integer(), primary_key=True, autoincrement=True)
     file_id = db.Column(db.ForeignKey('files.id'))
-    state = db.Column(db.PickleType(), nullable=False)
+    # only read when the chunk is handed out in a contract
+    state = db.deferred(db.Column(db.PickleType(), nullable=False))
     tag_path = db.Column(db.String(128), unique=True)
 
     file = db.relationship('File',
@@ -168,9 +235,23 @@ class Contract(db.Model):
     id = db.Column(db.Integer(), primary_key=True, autoincrement=True)
     token_id = db.Column(db.ForeignKey('tokens.id'), index=True)
     file_id = db.Column(db.ForeignKey('files.id'))
-    state = db.Column(
-        MutableTypeWrapper.as_mutable(db.PickleType), nullable=False)
-    challenge = db.Column(db.PickleType())
+    # the pickled heartbeat columns are large and most queries only need
+    # the dates, so they are deferred.  each group is loaded on first access,
+    # or for many contracts at once with queries.load_contract_groups()
+    state = db.deferred(db.Column(
+        MutableTypeWrapper.as_mutable(db.PickleType), nullable=False),
+        group='state')
+    challenge = db.deferred(db.Column(db.PickleType()), group='challenge')
+    # the next challenge and the state after generating it, precomputed by
+    # runapp.py --pregen-challenges so that requests only have to swap it in
+    next_challenge = db.deferred(db.Column(db.PickleType()), group='pregen')
+    next_state = db.deferred(db.Column(db.PickleType()), group='pregen')
+    # incremented whenever state and challenge are replaced, so that workers
+    # can cache them deserialized, see node.contract_heartbeat()
+    state_version = db.Column(db.Integer(), nullable=False, default=0)
+    # the challenge_seq of the token when the challenge or status of this
+    # contract last changed, so /challenge/ can return only what changed
+    challenge_seq = db.Column(db.Integer(), nullable=False, default=0)
     tag_path = db.Column(db.String(128), unique=True)
     start = db.Column(db.DateTime())
     due = db.Column(db.DateTime())
@@ -189,7 +270,9 @@ class Contract(db.Model):
 
     __table_args__ = (
         db.Index('ix_contracts_token_id_file_id', 'token_id', 'file_id'),
-        db.Index('ix_contracts_token_id_cached', 'token_id', 'cached'))
+        db.Index('ix_contracts_token_id_cached', 'token_id', 'cached'),
+        db.Index('ix_contracts_token_id_challenge_seq',
+                 'token_id', 'challenge_seq'))
 
     @hybrid_property
     def expiration(self):
@@ -200,13 +283,10 @@ class Contract(db.Model):
 
     @expiration.expression
     def expiration(cls):
-        # MySQL specific code.  will need to check compatibility on
-        # moving to different db
-        return func.IF(cls.__table__.c.answered,
-                       func.TIMESTAMPADD(text('SECOND'),
-                                         File.__table__.c.interval,
-                                         cls.__table__.c.due),
-                       cls.__table__.c.due)
+        return if_(cls.__table__.c.answered,
+                   timestamp_add(File.__table__.c.interval,
+                                 cls.__table__.c.due),
+                   cls.__table__.c.due)
 
     @hybrid_property
     def online(self):
@@ -214,7 +294,10 @@ class Contract(db.Model):
 
     @online.expression
     def online(cls):
-        return Contract.expiration > datetime.utcnow()
+        # the time is taken when the statement is executed, not when it is
+        # built, since the status selects are built once
+        return Contract.expiration > bindparam(
+            'utcnow', callable_=datetime.utcnow, type_=db.DateTime())
 
 
 def update_uptime_summary():
@@ -311,3 +394,28 @@ def update_uptime_summary():
                    upsum=bindparam('upsum'))
 
         db.engine.execute(s, new_summary)
+
+
+def refresh_uptime_summary(interval):
+    """Brings the uptime summary up to date for the status views, unless
+    this process has already done so in the last interval seconds, since it
+    reads and writes every token and uncached contract on the primary.
+
+    :param interval: the number of seconds between updates.  0 leaves the
+        summary to runapp.py --summary-interval
+    :returns: whether the summary was updated
+    """
+    global summary_updated
+    if (interval <= 0):
+        return False
+    if (summary_updated is not None and
+            time.time() - summary_updated < interval):
+        return False
+    with summary_lock:
+        # another thread may have updated it while we waited
+        if (summary_updated is not None and
+                time.time() - summary_updated < interval):
+            return False
+        update_uptime_summary()
+        summary_updated = time.time()
+    return True
@@ -1,20 +1,32 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import sys
+import copy
+import time
 import pickle
 import binascii
-import maxminddb
 import base58
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from Crypto.Hash import SHA256
 from RandomIO import RandomIO
-from sqlalchemy import and_, desc
+from sqlalchemy import and_, func, event
+from sqlalchemy.sql import select
+from sqlalchemy.sql.expression import true
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import flag_modified, get_history
 from heartbeat import HeartbeatError
 
 from .startup import db, app
 from .models import Address, Token, File, Contract, Chunk
+from .types import MutableTypeWrapper
+from .queries import (get_token, get_file, get_contract, get_largest_chunk,
+                      load_contract_groups, next_due_statement, execute)
 from .exc import InvalidParameterError
+from . import metrics
+
+EPOCH = datetime(1970, 1, 1)
 
 __all__ = ['create_token',
            'delete_token',
@@ -23,7 +35,17 @@ __all__ = ['create_token',
            'add_file',
            'remove_file',
            'verify_proof',
-           'update_contract']
+           'update_contract',
+           'contract_heartbeat',
+           'next_challenge_delay',
+           'wait_for_challenge',
+           'challenge_seq',
+           'read_challenge_seq',
+           'taken_challenge_seq',
+           'challenge_cursor',
+           'parse_challenge_cursor',
+           'load_challenge_columns',
+           'load_proof_columns']
 
 
 def get_ip_location(remote_addr):
@@ -31,9 +53,6 @@ def get_ip_location(remote_addr):
 
     :returns: the location
     """
-    # this code may need to be rethought for scalability, but for now,
-    # we're going with just opening a reader each time we get a location
-
     location = {'country': None,
                 'state': None,
                 'city': None,
@@ -41,8 +60,11 @@ def get_ip_location(remote_addr):
                 'lat': None,
                 'lon': None}
 
-    reader = maxminddb.Reader(app.config['MMDB_PATH'])
-    mmloc = reader.get(remote_addr)
+    # the reader is opened once by create_app and shared by every request
+    if (app.geoip is None):
+        return location
+
+    mmloc = app.geoip.get(remote_addr)
     if (mmloc is not None):
         if ('country' in mmloc):
             location['country'] = mmloc['country']['names']['en']
@@ -55,7 +77,6 @@ def get_ip_location(remote_addr):
         if ('location' in mmloc):
             location['lat'] = mmloc['location']['latitude']
             location['lon'] = mmloc['location']['longitude']
-    reader.close()
 
     return location
 
@@ -101,26 +122,207 @@ def process_token_ip_address(db_token, remote_addr, change=False):
             db_token.ip_address = remote_addr
 
 
+def heartbeat_key(db_contract):
+    """Returns the state cache key of the current state and challenge of a
+    contract.  Contract ids are reused once contracts are deleted, so the
+    start of the contract, which never changes, tells a new contract from
+    an old one with the same id and state version."""
+    return (db_contract.id, db_contract.start, db_contract.state_version)
+
+
+def heartbeat_cached(db_contract):
+    """Returns whether the current state and challenge of a contract are in
+    the state cache"""
+    return (app.state_cache is not None and
+            heartbeat_key(db_contract) in app.state_cache)
+
+
+def contract_heartbeat(db_contract):
+    """Returns the heartbeat state and current challenge of a contract.
+    They are deserialized once per state version and then kept in the state
+    cache, so the state is shared and must not be modified.  Values that
+    have not been committed yet are not cached.
+
+    :param db_contract: the contract
+    :returns: a (state, challenge) tuple
+    """
+    cache = app.state_cache
+    key = heartbeat_key(db_contract)
+    cacheable = (cache is not None and
+                 not get_history(db_contract, 'state_version').has_changes())
+    if (cacheable):
+        heartbeat = cache.get(key)
+        if (heartbeat is not None):
+            return heartbeat
+    # the state is wrapped to track changes to it, which the heartbeat does
+    # not need and which would pickle it on every method call
+    state = db_contract.state
+    if (isinstance(state, MutableTypeWrapper)):
+        state = state._underlying_object
+    heartbeat = (state, db_contract.challenge)
+    if (cacheable):
+        cache.put(key, heartbeat)
+    return heartbeat
+
+
+def gen_challenge(state):
+    """Generates the next challenge for a heartbeat state, in the heartbeat
+    pool if there is one.  Generating advances the state, so a copy is
+    advanced rather than the one passed in, which may be shared through the
+    state cache.
+
+    :param state: the heartbeat state
+    :returns: a (challenge, state) tuple of the challenge and the advanced
+        state
+    """
+    if (app.heartbeat_pool is not None):
+        return app.heartbeat_pool.gen_challenge(state)
+    state = copy.deepcopy(state)
+    return (app.heartbeat.gen_challenge(state), state)
+
+
+def verify_heartbeat(proof, chal, state):
+    """Verifies a proof against a challenge, in the heartbeat pool if there
+    is one
+
+    :returns: whether the proof is valid
+    """
+    if (app.heartbeat_pool is not None):
+        return app.heartbeat_pool.verify(proof, chal, state)
+    return app.heartbeat.verify(proof, chal, state)
+
+
 def contract_insert_next_challenge(db_contract):
     """This inserts the next challenge for the contract into the contract.
 
     :param db_contract: database contract object
     """
-    beat = app.heartbeat
-
-    try:
-        chal = beat.gen_challenge(db_contract.state)
-    except HeartbeatError as ex:
-        print(ex)
-        return False
-
+    if (db_contract.next_challenge is not None):
+        # the challenge was generated ahead of time, just swap it in
+        chal = db_contract.next_challenge
+        state = db_contract.next_state
+    else:
+        try:
+            with metrics.challenge_gen_time.time():
+                (chal, state) = gen_challenge(
+                    contract_heartbeat(db_contract)[0])
+        except HeartbeatError as ex:
+            print(ex)
+            return False
+
+    db_contract.state = state
     db_contract.challenge = chal
+    db_contract.state_version = db_contract.state_version + 1
+    mark_contract_changed(db_contract)
     db_contract.due = db_contract.expiration
     db_contract.answered = False
 
+    # always write these out, since a precomputed challenge may have been
+    # stored after we loaded the contract and it is now stale
+    db_contract.next_challenge = None
+    db_contract.next_state = None
+    flag_modified(db_contract, 'next_challenge')
+    flag_modified(db_contract, 'next_state')
+
     return True
 
 
+def pregenerate_challenges(lookahead, batch_size=100, exhausted=None):
+    """Generates the next challenge for answered contracts that will be due
+    within lookahead seconds, and stores it with the resulting state so that
+    the request that rolls the contract over only has to swap it in.
+
+    :param lookahead: how many seconds ahead of the due time to generate
+    :param batch_size: the maximum number of contracts to generate for
+    :param exhausted: a set of contract ids that have run out of challenges.
+        these are skipped, and any newly exhausted contracts are added to it
+    :returns: the number of challenges generated
+    """
+    contracts = Contract.__table__
+    files = File.__table__
+    now = datetime.utcnow()
+
+    if (exhausted is None):
+        exhausted = set()
+
+    candidate_stmt = select([contracts.c.id,
+                             contracts.c.due,
+                             contracts.c.state]).\
+        select_from(contracts.join(files)).\
+        where(and_(contracts.c.next_challenge.is_(None),
+                   contracts.c.answered == true(),
+                   contracts.c.due <= now + timedelta(seconds=lookahead),
+                   Contract.expiration > now)).\
+        order_by(contracts.c.due).\
+        limit(batch_size)
+
+    if (len(exhausted) > 0):
+        candidate_stmt = candidate_stmt.where(
+            ~contracts.c.id.in_(exhausted))
+
+    generated = 0
+
+    for c in db.engine.execute(candidate_stmt).fetchall():
+        try:
+            with metrics.challenge_gen_time.time():
+                (chal, state) = gen_challenge(c.state)
+        except HeartbeatError:
+            exhausted.add(c.id)
+            continue
+
+        # only store it if the contract has not been rolled over by a
+        # request in the meantime
+        s = contracts.update().\
+            where(and_(contracts.c.id == c.id,
+                       contracts.c.due == c.due,
+                       contracts.c.next_challenge.is_(None))).\
+            values(next_challenge=chal, next_state=state)
+
+        generated += db.engine.execute(s).rowcount
+
+    return generated
+
+
+def whitelist_rows():
+    """Returns the (address, id, balance) rows used to build the whitelist
+    index
+    """
+    addresses = Address.__table__
+    return db.engine.execute(select([addresses.c.address,
+                                     addresses.c.id,
+                                     addresses.c.crowdsale_balance]))
+
+
+def lookup_whitelisted_address(sjcx_address):
+    """Finds the whitelisted address that meets the minimum balance
+    requirement.  Uses the in memory whitelist index if it is enabled, so
+    that unknown or underfunded addresses are rejected without a database
+    query.
+
+    :param sjcx_address: the address to look up
+    :returns: the id of the address, or None if it is not whitelisted
+    """
+    index = app.whitelist
+
+    if (index is None):
+        db_address = Address.query.filter(
+            and_(Address.address == sjcx_address,
+                 Address.crowdsale_balance >=
+                 app.config['MIN_SJCX_BALANCE'])).first()
+        return db_address.id if db_address is not None else None
+
+    if (index.is_stale()):
+        index.load(whitelist_rows())
+
+    entry = index.lookup(sjcx_address)
+
+    if (entry is None or entry[1] is None
+            or entry[1] < app.config['MIN_SJCX_BALANCE']):
+        return None
+
+    return entry[0]
+
+
 def create_token(sjcx_address, remote_addr, message=None, signature=None):
     """Creates a token for the given address. Address must be in the white
     list of addresses.
@@ -130,9 +332,6 @@ def create_token(sjcx_address, remote_addr, message=None, signature=None):
     :returns: the token database object
     """
 
-    # make sure that the currnet ip has not excceeded it's token count
-    assert_ip_allowed_one_more_token(remote_addr)
-
     # make sure the address is valid
     try:
         base58.b58decode_check(sjcx_address)
@@ -143,15 +342,15 @@ def create_token(sjcx_address, remote_addr, message=None, signature=None):
     # confirm that sjcx_address is in the list of addresses
     # and meets balance requirements
     # for now we have a white list
-    db_address = Address.query.filter(
-        and_(Address.address == sjcx_address,
-             Address.crowdsale_balance >= app.config['MIN_SJCX_BALANCE'])).\
-        first()
+    address_id = lookup_whitelisted_address(sjcx_address)
 
-    if (db_address is None):
+    if (address_id is None):
         raise InvalidParameterError(
             'Invalid address given: address must be in whitelist.')
 
+    # make sure that the currnet ip has not excceeded it's token count
+    assert_ip_allowed_one_more_token(remote_addr)
+
     location = get_ip_location(remote_addr)
 
     token = os.urandom(16)
@@ -159,7 +358,7 @@ def create_token(sjcx_address, remote_addr, message=None, signature=None):
     token_hash = SHA256.new(token).hexdigest()[:20]
 
     db_token = Token(token=token_string,
-                     address=db_address,
+                     address_id=address_id,
                      ip_address=remote_addr,
                      farmer_id=token_hash,
                      location=location,
@@ -178,7 +377,7 @@ def delete_token(token):
     :param token: token to delete
     """
 
-    db_token = Token.query.filter(Token.token == token).first()
+    db_token = get_token(token)
 
     if (db_token is None):
         raise InvalidParameterError('Nonexistent token.')
@@ -235,6 +434,20 @@ def prepare_contract(db_file):
     return db_chunk
 
 
+def chunk_inventory():
+    """Counts the pregenerated chunks waiting to be handed out
+
+    :returns: a dict mapping (chunk size,) to the number of chunks
+    """
+    chunks = Chunk.__table__
+    files = File.__table__
+    s = select([files.c.size, func.count(chunks.c.id)]).\
+        select_from(chunks.join(files)).\
+        group_by(files.c.size)
+    return dict(((str(size),), count)
+                for (size, count) in db.engine.execute(s).fetchall())
+
+
 def get_chunk_contracts(token, size, remote_addr, max_chunk_count=0):
     """In the final version, this function should analyze currently available
     file chunks and disburse contracts for files that need higher redundancy
@@ -254,7 +467,7 @@ def get_chunk_contracts(token, size, remote_addr, max_chunk_count=0):
     # given out in a contract
 
     # verify the token
-    db_token = Token.query.filter(Token.token == token).first()
+    db_token = get_token(token)
 
     if (db_token is None):
         raise InvalidParameterError('Nonexistent token.')
@@ -285,8 +498,7 @@ def get_chunk_contracts(token, size, remote_addr, max_chunk_count=0):
         size_to_pull = size - total_size
         # now we pull from pregenerated chunks
         # we need a chunk that is smaller than the requested size
-        db_chunk = Chunk.query.filter(File.size <= size_to_pull).join(
-            File).order_by(desc(File.size)).first()
+        db_chunk = get_largest_chunk(size_to_pull)
 
         if (db_chunk is None):
             # no more of the appropriate size, we're done
@@ -295,6 +507,7 @@ def get_chunk_contracts(token, size, remote_addr, max_chunk_count=0):
         db_contract = Contract(token=db_token,
                                file=db_chunk.file,
                                state=db_chunk.state,
+                               state_version=0,
                                tag_path=db_chunk.tag_path,
                                # due time and answered and challenge will be
                                # inserted when we call update_contract() below
@@ -387,18 +600,17 @@ def lookup_contract(token, file_hash):
     :param file_hash: the file hash associated with this contract
     :returns: the contract database object
     """
-    db_token = Token.query.filter(Token.token == token).first()
+    db_token = get_token(token)
 
     if (db_token is None):
         raise InvalidParameterError('Nonexistent token.')
 
-    db_file = File.query.filter(File.hash == file_hash).first()
+    db_file = get_file(file_hash)
 
     if (db_file is None):
         raise InvalidParameterError('Invalid file hash')
 
-    db_contract = Contract.query.filter(Contract.token_id == db_token.id,
-                                        Contract.file_id == db_file.id).first()
+    db_contract = get_contract(db_token.id, db_file.id)
 
     if (db_contract is None):
         raise InvalidParameterError('Contract does not exist.')
@@ -417,9 +629,10 @@ def update_contract(db_contract):
         raise InvalidParameterError('Contract has expired.')
 
     # if the current challenge is good,
-    # and has a valid challenge, use it
-    if (db_contract.challenge is not None
-            and datetime.utcnow() < db_contract.due):
+    # and has a valid challenge, use it.  the due date is checked first so
+    # that the challenge is not loaded for contracts that need a new one
+    if (datetime.utcnow() < db_contract.due
+            and contract_heartbeat(db_contract)[1] is not None):
         return db_contract
 
     contract_still_valid = contract_insert_next_challenge(db_contract)
@@ -431,6 +644,193 @@ def update_contract(db_contract):
     return db_contract
 
 
+def next_challenge_delay(token_id, hashes, timeout):
+    """Returns the number of seconds until one of the online contracts of a
+    token falls due, when /challenge/ will have a new challenge or an expiry
+    to report for it, capped at the timeout.  Returns 0 if one is already
+    due or if there are none.
+
+    :param token_id: the id of the token
+    :param hashes: only include the contracts for files with these hashes
+    :param timeout: the most seconds to wait, capped at CHALLENGE_MAX_WAIT
+    :returns: the number of seconds
+    """
+    timeout = min(timeout, app.config['CHALLENGE_MAX_WAIT'])
+    if (timeout <= 0):
+        return 0
+    params = dict(token_id=token_id)
+    if (hashes is not None):
+        params['hashes'] = list(hashes)
+    next_due = execute(db.engine, next_due_statement(hashes is not None),
+                       **params).scalar()
+    if (next_due is None):
+        return 0
+    return max(min(timeout, (next_due - datetime.utcnow()).total_seconds()),
+               0)
+
+
+def cooperative_sleep():
+    """Returns whether time.sleep lets the worker serve other requests, as
+    it does once gevent or eventlet has patched it"""
+    gevent_monkey = sys.modules.get('gevent.monkey')
+    if (gevent_monkey is not None and
+            gevent_monkey.is_module_patched('time')):
+        return True
+    eventlet_patcher = sys.modules.get('eventlet.patcher')
+    return (eventlet_patcher is not None and
+            eventlet_patcher.is_monkey_patched('time'))
+
+
+def wait_for_challenge(token_id, hashes, timeout):
+    """Waits until one of the online contracts of a token falls due, or
+    until the timeout passes, see next_challenge_delay().  The due date is
+    known, so this is a single query and a sleep rather than a loop, and the
+    database connection of the session is released while sleeping.  The
+    route only waits under a cooperative worker, such as gunicorn's gevent
+    worker, where the sleep does not tie up a worker either, see
+    cooperative_sleep().  The asyncio front end sleeps on its event loop
+    instead, and never gets here with a wait.
+
+    :param token_id: the id of the token
+    :param hashes: only wait for the contracts for files with these hashes
+    :param timeout: the most seconds to wait, capped at CHALLENGE_MAX_WAIT
+    :returns: the number of seconds waited
+    """
+    delay = next_challenge_delay(token_id, hashes, timeout)
+    if (delay <= 0):
+        return 0
+    db.session.commit()
+    time.sleep(delay)
+    return delay
+
+
+def challenge_seq(token_id):
+    """Returns the challenge_seq to stamp on the contracts of a token that
+    change in the current transaction.  The counter of the token is
+    incremented the first time this is called in a transaction, which locks
+    the token row until the transaction ends, so transactions that change
+    the token's contracts commit in the order of their numbers.  A farmer
+    that has seen every contract up to a number then cannot later miss one
+    stamped with a lower number.
+
+    :param token_id: the id of the token
+    :returns: the sequence number of the current transaction for the token
+    """
+    seqs = db.session.info.setdefault('challenge_seqs', dict())
+    if (token_id not in seqs):
+        tokens = Token.__table__
+        db.session.execute(tokens.update()
+                           .where(tokens.c.id == token_id)
+                           .values(challenge_seq=tokens.c.challenge_seq + 1))
+        seqs[token_id] = read_challenge_seq(token_id)
+    return seqs[token_id]
+
+
+def read_challenge_seq(token_id):
+    """Returns the challenge_seq of a token as the current transaction sees
+    it, which is the highest number stamped on the contracts it can see
+
+    :param token_id: the id of the token
+    :returns: the challenge_seq
+    """
+    tokens = Token.__table__
+    return db.session.execute(select([tokens.c.challenge_seq])
+                              .where(tokens.c.id == token_id)).scalar()
+
+
+def taken_challenge_seq(token_id):
+    """Returns the challenge_seq the current transaction has stamped on the
+    contracts of a token, or None if it has not changed any"""
+    return db.session.info.get('challenge_seqs', dict()).get(token_id)
+
+
+def forget_challenge_seqs(session, *args):
+    """The sequence numbers only hold for the transaction that took them"""
+    session.info.pop('challenge_seqs', None)
+
+
+# flask-sqlalchemy creates its sessions with a function rather than a
+# sessionmaker, so listen on every session
+event.listen(Session, 'after_commit', forget_challenge_seqs)
+event.listen(Session, 'after_rollback', forget_challenge_seqs)
+
+
+def mark_contract_changed(db_contract):
+    """Stamps a contract whose challenge or status has changed with the
+    challenge_seq of the current transaction, so that it is returned to
+    farmers polling /challenge/ with an earlier cursor
+
+    :param db_contract: the contract
+    """
+    # a new contract only has its token until it is flushed
+    token_id = db_contract.token_id
+    if (token_id is None):
+        token_id = db_contract.token.id
+    db_contract.challenge_seq = challenge_seq(token_id)
+
+
+def challenge_cursor(seq, time):
+    """Returns the cursor that /challenge/ hands out for a challenge_seq and
+    the time it was read at
+
+    :param seq: the challenge_seq of the token
+    :param time: the time the contracts were read
+    :returns: the cursor string
+    """
+    delta = time - EPOCH
+    return '{0}-{1}'.format(seq, (delta.days * 86400 + delta.seconds) *
+                            1000000 + delta.microseconds)
+
+
+def parse_challenge_cursor(cursor):
+    """Parses a cursor from challenge_cursor()
+
+    :param cursor: the cursor string
+    :returns: a (challenge_seq, time) tuple
+    """
+    try:
+        (seq, micros) = cursor.split('-')
+        return (int(seq), EPOCH + timedelta(microseconds=int(micros)))
+    except (ValueError, OverflowError):
+        raise InvalidParameterError('Invalid since cursor.')
+
+
+def load_challenge_columns(db_contracts):
+    """Loads the deferred columns that update_contract() will need for a
+    list of contracts in at most three queries: the current challenge and
+    state of the contracts that are not in the state cache, and the
+    pregenerated challenge of the ones that need a new challenge.  Nothing
+    is loaded for expired contracts.
+
+    :param db_contracts: the contracts about to be updated
+    """
+    now = datetime.utcnow()
+    live = [c for c in db_contracts if now < c.expiration]
+    cached = set(c.id for c in live if heartbeat_cached(c))
+    load_contract_groups([c for c in live
+                          if now < c.due and c.id not in cached],
+                         'challenge', 'state')
+    load_contract_groups([c for c in live
+                          if now >= c.due and c.id not in cached],
+                         'challenge', 'state', 'pregen')
+    load_contract_groups([c for c in live
+                          if now >= c.due and c.id in cached], 'pregen')
+
+
+def load_proof_columns(db_contracts, received):
+    """Loads the challenge and heartbeat state that verify_proof() will
+    need for a list of contracts in a single query, skipping the contracts
+    in the state cache and those whose proofs will be rejected without them
+
+    :param db_contracts: the contracts about to be verified
+    :param received: the time the proofs were received
+    """
+    load_contract_groups([c for c in db_contracts
+                          if received < c.expiration and not c.answered
+                          and not heartbeat_cached(c)],
+                         'challenge', 'state')
+
+
 def verify_proof(db_contract, proof, received):
     """This queries the DB to retrieve the heartbeat, state and challenge for
     the contract id, and then checks the given proof.  Returns true if the
@@ -446,17 +846,17 @@ def verify_proof(db_contract, proof, received):
     if (received >= db_contract.expiration):
         raise InvalidParameterError('Answer failed: contract expired.')
 
-    beat = app.heartbeat
-    state = db_contract.state
-    chal = db_contract.challenge
+    (state, chal) = contract_heartbeat(db_contract)
 
     if (not db_contract.answered):
-        valid = beat.verify(proof, chal, state)
+        with metrics.proof_verify_time.time():
+            valid = verify_heartbeat(proof, chal, state)
     else:
         raise InvalidParameterError('Challenge already answered.')
 
     if (valid):
         db_contract.token.hbcount += 1
         db_contract.answered = True
+        mark_contract_changed(db_contract)
 
     return valid
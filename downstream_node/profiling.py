@@ -1,10 +1,14 @@
-from flask import request, g, render_template
-from line_profiler import LineProfiler
+from flask import request, g, render_template, jsonify, Response
+from werkzeug.exceptions import HTTPException
+import os
+import time
 import inspect
+import threading
 
 import linecache
 
 from .startup import app
+from .sampler import StackSampler
 
 from . import node, routes, utils
 
@@ -29,80 +33,312 @@ def collect_module_functions(modules):
     return functions
 
 
+def profiling_enabled():
+    return app.config['PROFILE'] and app.mongo_logger is not None
+
+
+def sampling():
+    return app.config['PROFILE_MODE'] == 'sample'
+
+
+def get_route():
+    """Returns the route of the current request, so that samples for
+    /challenge/abc and /challenge/def are counted together
+    """
+    if (request.url_rule is not None):
+        return request.url_rule.rule
+    return utils.UNMATCHED_ROUTE
+
+
+class ProfileRollups(object):
+
+    """Accumulates per route latencies and, in line mode, per line timings
+    between flushes, so that the database only receives increments
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # route -> Histogram
+        self.latency = dict()
+        # (route, filename, first_lineno, function, lineno) -> [hits, time]
+        self.lines = dict()
+        self.last_flush = time.time()
+
+    def add_request(self, route, elapsed):
+        # observed under the lock too, or a concurrent drain could hand the
+        # histogram to a flush before the observation lands in it
+        with self.lock:
+            histogram = self.latency.get(route)
+            if (histogram is None):
+                histogram = utils.Histogram()
+                self.latency[route] = histogram
+            histogram.observe(elapsed)
+
+    def add_line_stats(self, route, stats):
+        """Adds the timings of a line profiler run
+
+        :param route: the route that was profiled
+        :param stats: the line profiler stats.  stats.timings maps
+            (filename, first_lineno, function_name) of each profiled function
+            to a list of (lineno, nhits, total_time) tuples, where total_time
+            is in units of stats.unit seconds
+        """
+        with self.lock:
+            for (function, lines) in stats.timings.items():
+                for (lineno, hits, total_time) in lines:
+                    key = (route,) + tuple(function) + (lineno,)
+                    entry = self.lines.setdefault(key, [0, 0.0])
+                    entry[0] += hits
+                    entry[1] += total_time * stats.unit
+
+    def due(self, interval):
+        return time.time() - self.last_flush >= interval
+
+    def drain(self):
+        """Returns the latencies and line timings collected so far and resets
+        them
+        """
+        with self.lock:
+            drained = (self.latency, self.lines)
+            self.reset()
+        return drained
+
+
+rollups = ProfileRollups()
+
+
+def flush_rollups():
+    """Adds the request counts, latency buckets and line timings collected
+    since the last flush to the rollups in the database
+    """
+    (latency, lines) = rollups.drain()
+    db = app.mongo_logger.db
+    for (route, histogram) in latency.items():
+        increments = {'requests': histogram.count, 'time': histogram.total}
+        for i in range(0, len(histogram.counts)):
+            if (histogram.counts[i] > 0):
+                increments['buckets.{0}'.format(i)] = histogram.counts[i]
+        db.profiling_routes.update(
+            {'route': route},
+            {'$inc': increments, '$set': {'bounds': histogram.bounds}},
+            upsert=True)
+    for (key, (hits, total_time)) in lines.items():
+        (route, filename, first_lineno, function, lineno) = key
+        db.profiling_lines.update(
+            {'route': route,
+             'filename': filename,
+             'first_lineno': first_lineno,
+             'function': function,
+             'lineno': lineno},
+            {'$inc': {'hits': hits, 'time': total_time}},
+            upsert=True)
+
+
+def flush_samples(counts):
+    """Adds the sample counts collected by the sampler to the rollups in
+    the database
+
+    :param counts: a dict mapping (route, collapsed stack) to sample count
+    """
+    for ((route, stack), samples) in counts.items():
+        app.mongo_logger.db.profiling_stacks.update(
+            {'route': route, 'stack': stack},
+            {'$inc': {'samples': samples,
+                      'time': samples * sampler.interval}},
+            upsert=True)
+    flush_rollups()
+
+
+if (sampling()):
+    # one sampler per worker process.  it is started by the first request a
+    # worker serves, since a thread started here, in the master of a pre
+    # forking server, would not survive the fork
+    sampler = StackSampler(app.config['PROFILE_SAMPLE_RATE'],
+                           flush_samples,
+                           app.config['PROFILE_FLUSH_INTERVAL'])
+else:
+    from line_profiler import LineProfiler
+
+    # inspecting the modules is expensive, so only do it once
+    profiled_functions = collect_module_functions([node, routes, utils])
+
+
 @app.before_request
 def start_profiling():
-    if (app.config['PROFILE'] and app.mongo_logger is not None):
+    if (profiling_enabled()):
+        g.profile_start = time.time()
+        if (sampling()):
+            sampler.start()
+            sampler.begin(get_route())
+            return
         if (not hasattr(g, 'profiler') or g.profiler is None):
             setattr(g, 'profiler', LineProfiler())
-            # print('Collecting function info')
-            function_info = collect_module_functions([node, routes, utils])
-            for f in function_info:
+            for f in profiled_functions:
                 # print('Adding profile framework for function {0}'.format(f))
                 g.profiler.add_function(f)
         g.profiler.enable()
 
 
-def timing_key_to_str(k):
-    return '_'.join([k[0], str(k[1]), k[2]]).replace('.', '_')
-
-
 @app.teardown_request
 def finish_profiling(exception=None):
-    if (app.config['PROFILE'] and app.mongo_logger is not None):
+    if (profiling_enabled() and hasattr(g, 'profile_start')):
+        route = get_route()
+        rollups.add_request(route, time.time() - g.profile_start)
+        if (sampling()):
+            # the sampler thread flushes the rollups
+            sampler.end()
+            return
         g.profiler.disable()
-        stats = g.profiler.get_stats()
-        # stats is an object with these properties:
-        # timings : dict
-        #   Mapping from (filename, first_lineno, function_name) of the
-        #   profiled
-        #   function to a list of (lineno, nhits, total_time) tuples for each
-        #   profiled line. total_time is an integer in the native units of the
-        #   timer.
-        # unit : float
-        #   The number of seconds per timer unit.
-        functions = list(stats.timings.keys())
-        lines = list(stats.timings.values())
-
-        app.mongo_logger.db.profiling.insert(
-            {'path': request.path,
-             'functions': functions,
-             'lines': lines,
-             'unit': stats.unit})
-
-
-def get_function_source_hits(logged_function, line_hits, unit):
-    filename = logged_function[0]
-    source_hits = list()
-    for lineno in range(logged_function[1], min([l[0] for l in line_hits])):
-        function_def = linecache.getline(filename, lineno)
-        source_hits.append((function_def.rstrip(), None, None))
-    for hit in line_hits:
-        source_line = linecache.getline(filename, hit[0])
-        source_hits.append(
-            (source_line.rstrip(), hit[1], float(hit[2]) * float(unit)))
-    return source_hits
+        rollups.add_line_stats(route, g.profiler.get_stats())
+        if (rollups.due(app.config['PROFILE_FLUSH_INTERVAL'])):
+            flush_rollups()
+
+
+def resolve_route(path):
+    """Resolves a path such as /challenge/abc to the route that serves it,
+    /challenge/<token>.  Paths that are already routes, or that no route
+    serves, are returned unchanged.
+
+    :param path: the path to resolve
+    :returns: the route
+    """
+    if (any(rule.rule == path for rule in app.url_map.iter_rules())):
+        return path
+    adapter = app.url_map.bind('localhost')
+    for method in ['GET', 'POST']:
+        try:
+            (rule, arguments) = adapter.match(path, method, return_rule=True)
+            return rule.rule
+        except HTTPException:
+            pass
+    return path
+
+
+def frame_label(frame):
+    """Shortens a "filename:first line:function:line" frame label to
+    "function (file:line)"
+    """
+    (filename, first_lineno, function, lineno) = frame.rsplit(':', 3)
+    return '{0} ({1}:{2})'.format(function, os.path.basename(filename),
+                                  lineno)
+
+
+def collapsed_stacks(stacks):
+    """Formats the stacks in the collapsed format read by flamegraph.pl and
+    speedscope, one "frame;frame;frame samples" line per stack
+    """
+    lines = list()
+    for s in stacks:
+        frames = [frame_label(f) for f in s['stack'].split(';')]
+        lines.append('{0} {1}'.format(';'.join(frames), s['samples']))
+    return '\n'.join(lines) + '\n'
+
+
+def stack_line_totals(stacks, limit=50):
+    """Sums the sampled stacks per line.  Self samples count the stacks
+    that a line is the innermost frame of, total samples count the stacks
+    that a line appears in at all.
+
+    :param stacks: the stack documents of a route
+    :param limit: the number of lines to return
+    :returns: a list of line dicts, by descending self samples
+    """
+    totals = dict()
+    for s in stacks:
+        frames = s['stack'].split(';')
+        for f in set(frames):
+            entry = totals.setdefault(f, [0, 0])
+            entry[1] += s['samples']
+        totals[frames[-1]][0] += s['samples']
+    lines = list()
+    for (frame, (self_samples, total_samples)) in totals.items():
+        (filename, first_lineno, function, lineno) = frame.rsplit(':', 3)
+        lines.append(dict(filename=filename,
+                          function=function,
+                          lineno=int(lineno),
+                          source=linecache.getline(filename,
+                                                   int(lineno)).strip(),
+                          self_samples=self_samples,
+                          total_samples=total_samples))
+    lines.sort(key=lambda line: (line['self_samples'],
+                                 line['total_samples']),
+               reverse=True)
+    return lines[:limit]
+
+
+def timed_line_totals(lines, limit=50):
+    """Orders the line profiler rollups of a route by descending time
+
+    :param lines: the line documents of a route
+    :param limit: the number of lines to return
+    :returns: a list of line dicts
+    """
+    result = list()
+    lines = sorted(lines, key=lambda line: line['time'], reverse=True)
+    for line in lines[:limit]:
+        result.append(dict(filename=line['filename'],
+                           function=line['function'],
+                           lineno=line['lineno'],
+                           source=linecache.getline(line['filename'],
+                                                    line['lineno']).strip(),
+                           hits=line['hits'],
+                           time=line['time']))
+    return result
+
+
+def route_summary(doc):
+    """Summarizes the rollup document of a route
+
+    :param doc: the rollup document, or None if there is none
+    :returns: a dict with the request count, total and mean time and the
+        latency percentiles
+    """
+    if (doc is None):
+        histogram = utils.Histogram()
+    else:
+        buckets = doc.get('buckets', dict())
+        bounds = doc['bounds']
+        histogram = utils.Histogram(
+            bounds,
+            [buckets.get(str(i), 0) for i in range(0, len(bounds) + 1)],
+            doc['time'])
+    return dict(requests=histogram.count,
+                time=histogram.total,
+                mean=histogram.mean(),
+                p50=histogram.percentile(50),
+                p90=histogram.percentile(90),
+                p99=histogram.percentile(99))
 
 
 @app.route('/profile/<path:path>')
 def profiling_profile(path):
-    if (app.config['PROFILE'] and app.mongo_logger is not None):
-        mod_path = '/' + path
-        requests = list()
-        print('Showing profile for route: {0}'.format(mod_path))
-        for p in app.mongo_logger.db.profiling.find({'path': mod_path}):
-            request = dict(path=p['path'],
-                           functions=list())
-            for i in range(0, len(p['functions'])):
-                if any([len(l) > 0 for l in p['lines'][i]]):
-                    function = dict(
-                        name=p['functions'][i][2],
-                        filename=p['functions'][i][0],
-                        lines=get_function_source_hits(p['functions'][i],
-                                                       p['lines'][i],
-                                                       p['unit']))
-                    request['functions'].append(function)
-            requests.append(request)
-
-        return render_template('profile.html', path=path, requests=requests)
+    if (profiling_enabled()):
+        route = resolve_route('/' + path)
+        db = app.mongo_logger.db
+        stacks = list(db.profiling_stacks.find({'route': route}))
+
+        if (request.args.get('format') == 'collapsed'):
+            return Response(collapsed_stacks(stacks), mimetype='text/plain')
+
+        summary = route_summary(db.profiling_routes.find_one({'route': route}))
+        sampled_lines = stack_line_totals(stacks)
+        timed_lines = timed_line_totals(
+            db.profiling_lines.find({'route': route}))
+
+        if (request.args.get('format') == 'json'):
+            return jsonify(route=route,
+                           summary=summary,
+                           sampled_lines=sampled_lines,
+                           timed_lines=timed_lines)
+
+        return render_template('profile.html',
+                               path=path,
+                               route=route,
+                               summary=summary,
+                               sampled_lines=sampled_lines,
+                               timed_lines=timed_lines)
     else:
         return 'Profiling disabled.  Sorry!'
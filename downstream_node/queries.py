@@ -0,0 +1,264 @@
+from sqlalchemy import and_, or_, bindparam, desc, func
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import contains_eager, undefer, undefer_group
+from sqlalchemy.sql import select
+
+from .startup import db
+from .models import Token, Address, Contract, File, Chunk
+from .expressions import if_
+
+# The queries run on every farmer request are defined once here.  ORM
+# queries are baked, so the Query is built and compiled once and only the
+# bind parameters change between requests.  Core statements are built once
+# per variant and executed with a compiled cache.  Expanding IN parameters
+# need SQLAlchemy 1.2.
+
+bakery = baked.bakery()
+
+# (dialect, statement, parameter names) -> compiled statement.  the
+# statements are module constants, so this stays small
+compiled_cache = dict()
+
+token_query = bakery(lambda session: session.query(Token))
+token_query += lambda q: q.filter(Token.token == bindparam('token'))
+
+file_query = bakery(lambda session: session.query(File))
+file_query += lambda q: q.filter(File.hash == bindparam('hash'))
+
+contract_query = bakery(lambda session: session.query(Contract))
+contract_query += lambda q: q.filter(
+    Contract.token_id == bindparam('token_id'),
+    Contract.file_id == bindparam('file_id'))
+
+largest_chunk_query = bakery(lambda session: session.query(Chunk))
+largest_chunk_query += lambda q: q.join(File).filter(
+    File.size <= bindparam('size')).order_by(desc(File.size))
+# the chunk is about to be handed out, so load its state with it
+largest_chunk_query += lambda q: q.options(undefer(Chunk.state))
+
+token_contracts_query = bakery(lambda session: session.query(Contract))
+token_contracts_query += lambda q: q.join(File).filter(
+    Contract.token_id == bindparam('token_id'))
+token_contracts_query += lambda q: q.options(contains_eager(Contract.file))
+
+# deferred column groups -> query loading them for contracts by id
+contract_group_queries = dict()
+
+# (order, descending, limit, offset) -> farmer status select
+farmer_statements = dict()
+
+# (by region, for one country) -> geo aggregate select
+geo_statements = dict()
+
+# (for some hashes) -> next due select
+next_due_statements = dict()
+
+
+def get_token(token):
+    """Returns the token with this token string, or None"""
+    return token_query(db.session()).params(token=token).first()
+
+
+def get_file(file_hash):
+    """Returns the file with this hash, or None"""
+    return file_query(db.session()).params(hash=file_hash).first()
+
+
+def get_contract(token_id, file_id):
+    """Returns the contract of a token for a file, or None"""
+    return contract_query(db.session()).params(token_id=token_id,
+                                               file_id=file_id).first()
+
+
+def get_largest_chunk(max_size):
+    """Returns the pregenerated chunk with the largest file no larger than
+    max_size, or None
+    """
+    return largest_chunk_query(db.session()).params(size=max_size).first()
+
+
+def get_token_contracts(token_id, hashes=None, since=None, now=None):
+    """Returns the contracts of a token
+
+    :param token_id: the id of the token
+    :param hashes: only return the contracts for files with these hashes
+    :param since: a (challenge_seq, time) cursor.  only return the
+        contracts that have changed since then: those with a higher
+        challenge_seq, and those that were online at time and are now due
+    :param now: the current time, for since
+    :returns: a list of contracts
+    """
+    q = token_contracts_query
+    params = dict(token_id=token_id)
+    if (hashes is not None):
+        q = q + (lambda q: q.filter(
+            File.hash.in_(bindparam('hashes', expanding=True))))
+        params['hashes'] = list(hashes)
+    if (since is not None):
+        q = q + (lambda q: q.filter(or_(
+            Contract.challenge_seq > bindparam('since_seq'),
+            and_(Contract.due <= bindparam('now'),
+                 Contract.expiration > bindparam('since_time')))))
+        params.update(since_seq=since[0], since_time=since[1], now=now)
+    return q(db.session()).params(**params).all()
+
+
+def load_contract_groups(contracts, *groups):
+    """Loads deferred column groups of contracts in a single query, rather
+    than in one query per contract when each is first accessed.  The
+    contracts must be in the current session.
+
+    :param contracts: the contracts
+    :param groups: the names of the column groups to load
+    """
+    ids = [c.id for c in contracts]
+    if (len(ids) == 0):
+        return
+    q = contract_group_queries.get(groups)
+    if (q is None):
+        q = bakery(lambda session: session.query(Contract))
+        q += lambda q: q.filter(
+            Contract.id.in_(bindparam('ids', expanding=True)))
+        # the groups are passed so that they are part of the cache key
+        q.add_criteria(lambda q: q.options(
+            *[undefer_group(g) for g in groups]), *groups)
+        contract_group_queries[groups] = q
+    # the contracts are already in the identity map, so this only fills in
+    # their unloaded columns
+    q(db.session()).params(ids=ids).all()
+
+
+def farmer_statement(order, descending=False, limit=False, offset=False):
+    """Returns the select behind the status list.  Each variant is built
+    once, so that it is compiled once per database.
+
+    :param order: the label of the column to order by
+    :param descending: whether to order in descending order
+    :param limit: whether to limit the rows to the :limit parameter
+    :param offset: whether to skip the first :offset rows
+    :returns: the select
+    """
+    key = (order, descending, limit, offset)
+    s = farmer_statements.get(key)
+    if (s is None):
+        s = select([Token.__table__.c.farmer_id.label('id'),
+                    Address.__table__.c.address,
+                    Token.__table__.c.country,
+                    Token.__table__.c.region,
+                    Token.__table__.c.city,
+                    Token.__table__.c.postal_code,
+                    Token.__table__.c.latitude,
+                    Token.__table__.c.longitude,
+                    Token.__table__.c.hbcount.label('heartbeats'),
+                    Token.online_count.label('contract_count'),
+                    func.max(Contract.__table__.c.due).label('last_due'),
+                    Token.online_size.label('size'),
+                    Token.online.label('online'),
+                    Token.fraction.label('uptime')])\
+            .select_from(Token.__table__.join(Address.__table__)
+                         .join(Contract.__table__.join(File.__table__),
+                               isouter=True))\
+            .group_by(Token.__table__.c.id, Address.__table__.c.id)\
+            .order_by(desc(order) if descending else order)
+        if (limit):
+            s = s.limit(bindparam('limit'))
+        if (offset):
+            s = s.offset(bindparam('offset'))
+        farmer_statements[key] = s
+    return s
+
+
+def geo_statement(region=False, country=False):
+    """Returns the select behind the geo status views, which counts the
+    farmers, online farmers, online capacity and mean uptime of each country
+    or region.  The contracts are summed per token first, so the tokens are
+    grouped in the order of ix_tokens_country_region.
+
+    :param region: whether to group by region within each country, rather
+        than by country
+    :param country: whether to only include the :country parameter
+    :returns: the select
+    """
+    key = (region, country)
+    s = geo_statements.get(key)
+    if (s is None):
+        tokens = Token.__table__
+        contracts = Contract.__table__
+        files = File.__table__
+        token_contracts = select(
+            [contracts.c.token_id,
+             func.sum(if_(Contract.online, 1, 0)).label('online_count'),
+             func.sum(if_(Contract.online, files.c.size, 0))
+             .label('online_size')])\
+            .select_from(contracts.join(files))\
+            .group_by(contracts.c.token_id)\
+            .alias('token_contracts')
+        groups = [tokens.c.country]
+        if (region):
+            groups.append(tokens.c.region)
+        s = select(groups +
+                   [func.count(tokens.c.id).label('farmers'),
+                    func.sum(if_(token_contracts.c.online_count > 0, 1, 0))
+                    .label('online'),
+                    func.sum(token_contracts.c.online_size).label('size'),
+                    func.avg(Token.fraction).label('uptime')])\
+            .select_from(tokens.outerjoin(
+                token_contracts,
+                token_contracts.c.token_id == tokens.c.id))\
+            .group_by(*groups)\
+            .order_by(*groups)
+        if (country):
+            s = s.where(tokens.c.country == bindparam('country'))
+        geo_statements[key] = s
+    return s
+
+
+def next_due_statement(hashes=False):
+    """Returns the select of the earliest due date of the online contracts
+    of the :token_id parameter
+
+    :param hashes: whether to only include the contracts for files with the
+        :hashes parameter
+    :returns: the select
+    """
+    s = next_due_statements.get(hashes)
+    if (s is None):
+        contracts = Contract.__table__
+        s = select([func.min(contracts.c.due)])\
+            .select_from(contracts.join(File.__table__))\
+            .where(and_(contracts.c.token_id == bindparam('token_id'),
+                        Contract.online))
+        if (hashes):
+            s = s.where(File.__table__.c.hash.in_(
+                bindparam('hashes', expanding=True)))
+        next_due_statements[hashes] = s
+    return s
+
+
+def execute(engine, statement, **params):
+    """Executes a core statement, compiling it only the first time it is
+    executed on a database
+
+    :param engine: the engine to execute it on
+    :param statement: the statement, which should be built once
+    :param params: the bind parameters
+    :returns: the result
+    """
+    return engine.execution_options(compiled_cache=compiled_cache)\
+        .execute(statement, **params)
+
+
+def stream(engine, statement, **params):
+    """Executes a core statement like execute(), on a server side cursor
+    where the database driver has one, so that the rows are fetched as they
+    are read rather than all at once.  The connection is held until the
+    result is read to the end or closed.
+
+    :param engine: the engine to execute it on
+    :param statement: the statement, which should be built once
+    :param params: the bind parameters
+    :returns: the result
+    """
+    return engine.execution_options(compiled_cache=compiled_cache,
+                                    stream_results=True)\
+        .execute(statement, **params)
@@ -0,0 +1,113 @@
+import time
+import threading
+
+from flask import _app_ctx_stack
+from sqlalchemy import orm
+
+from . import metrics
+
+
+def replica_lag(engine):
+    """Returns the number of seconds a replica is behind its primary
+
+    :param engine: the replica engine
+    :returns: the lag in seconds, or None if the engine is not replicating
+    """
+    name = engine.dialect.name
+    if (name == 'mysql'):
+        row = engine.execute('SHOW SLAVE STATUS').first()
+        if (row is None):
+            return None
+        # None while the replication threads are stopped
+        return row['Seconds_Behind_Master']
+    if (name == 'postgresql'):
+        return engine.execute(
+            'SELECT EXTRACT(EPOCH FROM now() - '
+            'pg_last_xact_replay_timestamp())').scalar()
+    # other databases, like the sqlite stand in used in tests, have no
+    # replication to fall behind on
+    return 0
+
+
+class EngineRouter(object):
+
+    """Routes read only reporting queries to a replica engine while it is no
+    more than max_lag seconds behind the primary, and everything else to the
+    primary.  The lag is checked at most every check_interval seconds, and
+    the primary is used while the replica cannot be reached.
+    """
+
+    def __init__(self, primary, replica=None, max_lag=5, check_interval=5):
+        """
+        :param primary: a function returning the primary engine, so that
+            Flask-SQLAlchemy can create it when it is first needed
+        :param replica: the replica engine, or None to read from the primary
+        :param max_lag: the number of seconds a replica may be behind the
+            primary and still be read from
+        :param check_interval: the number of seconds between lag checks
+        """
+        self.primary = primary
+        self.replica = replica
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.checked = None
+        self.last_lag = None
+        # one reporting session per app context, bound to the engine that
+        # was chosen when it was first used
+        self.session = orm.scoped_session(
+            lambda: orm.Session(bind=self.reader()),
+            scopefunc=_app_ctx_stack.__ident_func__)
+
+    def measure_lag(self):
+        return replica_lag(self.replica)
+
+    def lag(self):
+        """Returns the lag of the replica as of the last check, checking it
+        again if check_interval has passed
+
+        :returns: the lag in seconds, or None if it is unknown
+        """
+        with self.lock:
+            now = time.time()
+            if (self.checked is None
+                    or now - self.checked >= self.check_interval):
+                try:
+                    self.last_lag = self.measure_lag()
+                except Exception as ex:
+                    print('Unable to check replica lag: {0}'.format(ex))
+                    self.last_lag = None
+                self.checked = now
+                if (self.last_lag is not None):
+                    metrics.replica_lag.set(self.last_lag)
+            return self.last_lag
+
+    def replica_usable(self):
+        if (self.replica is None):
+            return False
+        lag = self.lag()
+        return lag is not None and lag <= self.max_lag
+
+    def reader(self):
+        """Returns the engine to run a read only reporting query on.  Its
+        results may be up to max_lag seconds stale.
+        """
+        if (self.replica_usable()):
+            metrics.reporting_reads.inc(('replica',))
+            return self.replica
+        metrics.reporting_reads.inc(('primary',))
+        return self.primary()
+
+    def writer(self):
+        """Returns the primary engine"""
+        return self.primary()
+
+    def remove_session(self, exception=None):
+        self.session.remove()
+
+    def install(self, app):
+        """Closes the reporting session at the end of each app context
+
+        :param app: the app to install into
+        """
+        app.teardown_appcontext(self.remove_session)
@@ -2,20 +2,43 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
 import pickle
 import siggy
 
 from flask import jsonify, request
-from sqlalchemy import func, desc, and_
-from sqlalchemy.sql import select
 from datetime import datetime
 
 from .startup import app, db
-from .node import (create_token, get_chunk_contracts,
+from .node import (create_token, get_chunk_contracts, chunk_inventory,
                    verify_proof,  update_contract,
-                   process_token_ip_address)
-from .models import Token, Address, Contract, File, update_uptime_summary
+                   load_challenge_columns, load_proof_columns,
+                   contract_heartbeat, wait_for_challenge, cooperative_sleep,
+                   read_challenge_seq, taken_challenge_seq,
+                   challenge_cursor, parse_challenge_cursor,
+                   process_token_ip_address, whitelist_rows)
+from .models import Token, refresh_uptime_summary, make_location
+from .queries import get_token, get_token_contracts
 from .exc import InvalidParameterError, NotFoundError, HttpHandler
+from .encoding import respond, respond_list
+from . import sqlstats, metrics, memprofile, queries
+
+
+@app.before_first_request
+def warm_whitelist_index():
+    if (app.whitelist is not None and app.whitelist.is_stale()):
+        app.whitelist.load(whitelist_rows())
+
+
+def heartbeat_response(token):
+    """Builds the response for a token from the pre serialized public
+    heartbeat
+
+    :param token: the token string
+    :returns: the response object
+    """
+    return app.response_class('{{"token": {0}, {1}}}'.format(
+        json.dumps(token), app.public_heartbeat), mimetype='application/json')
 
 
 @app.route('/')
@@ -23,6 +46,105 @@ def api_index():
     return jsonify(msg='ok')
 
 
+@app.route('/metrics')
+def api_metrics():
+    with HttpHandler(app.mongo_logger) as handler:
+        if (not app.config['METRICS']):
+            raise NotFoundError('Not found.')
+
+        # gauges that would cost a query to keep up to date on every change
+        # are computed when scraped
+        metrics.chunk_pool.replace(chunk_inventory())
+        if (app.state_cache is not None):
+            metrics.state_cache.replace(
+                dict(((k,), v) for (k, v) in app.state_cache.stats().items()))
+        pool = db.engine.pool
+        if (hasattr(pool, 'checkedout')):
+            metrics.db_checked_out.set(pool.checkedout())
+
+        return app.response_class(metrics.registry.expose(),
+                                  mimetype='text/plain; version=0.0.4')
+
+    return handler.response
+
+
+@app.route('/debug/queries/')
+def api_debug_queries():
+    with HttpHandler(app.mongo_logger) as handler:
+        if (not app.debug):
+            raise NotFoundError('Not found.')
+
+        return jsonify(routes=sqlstats.route_stats())
+
+    return handler.response
+
+
+def memory_profiler():
+    """Returns the memory profiler if it is enabled and the request carries
+    MEMORY_PROFILE_KEY, and raises NotFoundError otherwise
+    """
+    if (app.memory_profiler is None
+            or not memprofile.check_key(app.config['MEMORY_PROFILE_KEY'])):
+        raise NotFoundError('Not found.')
+    return app.memory_profiler
+
+
+@app.route('/debug/memory/')
+def api_debug_memory():
+    with HttpHandler(app.mongo_logger) as handler:
+        memory_profiler()
+
+        (traced, peak) = memprofile.tracemalloc.get_traced_memory()
+
+        return jsonify(traced=traced,
+                       peak=peak,
+                       routes=app.memory_profiler.routes())
+
+    return handler.response
+
+
+@app.route('/debug/memory/snapshot', methods=['POST'])
+def api_debug_memory_snapshot():
+    with HttpHandler(app.mongo_logger) as handler:
+        profiler = memory_profiler()
+
+        route = request.args.get('route')
+        if (route is None):
+            # a snapshot of the whole process, taken now
+            count = profiler.take_snapshot('*')
+            return jsonify(route='*', snapshots=count)
+
+        if (route not in [r.rule for r in app.url_map.iter_rules()]):
+            raise InvalidParameterError('Unknown route.')
+
+        profiler.request_snapshot(route)
+
+        return jsonify(route=route, status='pending')
+
+    return handler.response
+
+
+@app.route('/debug/memory/diff')
+def api_debug_memory_diff():
+    with HttpHandler(app.mongo_logger) as handler:
+        profiler = memory_profiler()
+
+        try:
+            diff = profiler.diff(request.args.get('route', '*'),
+                                 request.args.get('first', 0, type=int),
+                                 request.args.get('last', -1, type=int),
+                                 request.args.get('limit', 20, type=int))
+        except IndexError:
+            raise InvalidParameterError('Invalid snapshot index.')
+
+        if (diff is None):
+            raise NotFoundError('No snapshots of this route.')
+
+        return jsonify(diff)
+
+    return handler.response
+
+
 @app.route('/status/list/',
            defaults={'o': False, 'd': False, 'sortby': 'id',
                      'limit': None, 'page': None})
@@ -80,51 +202,79 @@ def api_downstream_status_list(o, d, sortby, limit, page):
         if (sortby not in sort_map):
             raise InvalidParameterError('Invalid sort.')
 
-        update_uptime_summary()
-
-        farmer_stmt = select([Token.__table__.c.farmer_id.label('id'),
-                              Address.__table__.c.address,
-                              Token.__table__.c.location,
-                              Token.__table__.c.hbcount.label('heartbeats'),
-                              Token.online_count.label('contract_count'),
-                              func.max(Contract.__table__.c.due)
-                              .label('last_due'),
-                              Token.online_size.label('size'),
-                              Token.online.label('online'),
-                              Token.fraction.label('uptime')])\
-            .select_from(Token.__table__.join(Address.__table__)
-                         .join(Contract.__table__.join(File.__table__), isouter=True))\
-            .group_by('id')
-
-        # now get the tokens we need
-        if (d):
-            sort_stmt = desc(sort_map[sortby])
-        else:
-            sort_stmt = sort_map[sortby]
-
-        farmer_stmt = farmer_stmt.order_by(sort_stmt)
+        refresh_uptime_summary(app.config['UPTIME_SUMMARY_INTERVAL'])
 
+        farmer_stmt = queries.farmer_statement(sort_map[sortby], d,
+                                               limit is not None,
+                                               page is not None)
+        params = dict()
         if (limit is not None):
-            farmer_stmt = farmer_stmt.limit(limit)
-
+            params['limit'] = limit
         if (page is not None):
-            farmer_stmt = farmer_stmt.offset(limit * page)
+            params['offset'] = limit * page
 
-        farmer_list = db.engine.execute(farmer_stmt)
+        # the summary is brought up to date on the primary, so the replica
+        # may lag behind it by up to REPLICA_MAX_LAG seconds more than
+        # UPTIME_SUMMARY_INTERVAL
+        farmer_list = queries.stream(app.engines.reader(), farmer_stmt,
+                                     **params)
 
-        farmers = [dict(id=a.id,
-                        address=a.address,
-                        location=a.location,
-                        uptime=float(round(a.uptime * 100, 2)),
-                        heartbeats=a.heartbeats,
-                        contracts=int(a.contract_count),
-                        last_due=a.last_due,
-                        size=int(a.size if a.size is not None else 0),
-                        online=a.online)
-                   for a in farmer_list
-                   if not o or a.online]
+        def farmers():
+            # each farmer is encoded as its row is read, see STREAM_JSON
+            try:
+                for a in farmer_list:
+                    if (o and not a.online):
+                        continue
+                    yield dict(id=a.id,
+                               address=a.address,
+                               location=make_location(a),
+                               uptime=float(round(a.uptime * 100, 2)),
+                               heartbeats=a.heartbeats,
+                               contracts=int(a.contract_count),
+                               last_due=a.last_due,
+                               size=int(a.size if a.size is not None else 0),
+                               online=a.online)
+            finally:
+                farmer_list.close()
+
+        return respond_list('farmers', farmers())
+
+    return handler.response
 
-        return jsonify(farmers=farmers)
+
+@app.route('/status/geo/country/',
+           defaults={'region': False, 'country': None})
+@app.route('/status/geo/region/',
+           defaults={'region': True, 'country': None})
+@app.route('/status/geo/region/<country>', defaults={'region': True})
+def api_downstream_status_geo(region, country):
+    """Returns the number of farmers, online farmers, online capacity and
+    mean uptime of each country, or of each region of every country or of
+    one country.  Farmers whose location is unknown are counted under a null
+    country.
+    """
+    with HttpHandler(app.mongo_logger) as handler:
+        refresh_uptime_summary(app.config['UPTIME_SUMMARY_INTERVAL'])
+
+        geo_stmt = queries.geo_statement(region, country is not None)
+        params = dict()
+        if (country is not None):
+            params['country'] = country
+
+        rows = queries.execute(app.engines.reader(), geo_stmt, **params)
+
+        locations = list()
+        for a in rows:
+            location = dict(country=a.country,
+                            farmers=int(a.farmers),
+                            online=int(a.online or 0),
+                            size=int(a.size or 0),
+                            uptime=float(round((a.uptime or 0) * 100, 2)))
+            if (region):
+                location['region'] = a.region
+            locations.append(location)
+
+        return jsonify(locations=locations)
 
     return handler.response
 
@@ -132,7 +282,8 @@ def api_downstream_status_list(o, d, sortby, limit, page):
 @app.route('/status/show/<farmer_id>')
 def api_downstream_status_show(farmer_id):
     with HttpHandler(app.mongo_logger) as handler:
-        a = Token.query.filter(Token.farmer_id == farmer_id).first()
+        a = app.engines.session.query(Token)\
+            .filter(Token.farmer_id == farmer_id).first()
 
         if (a is None):
             raise NotFoundError('Nonexistant farmer id.')
@@ -201,18 +352,14 @@ def api_downstream_new_token(sjcx_address):
 
         db_token = create_token(
             sjcx_address, request.remote_addr, message, signature)
-        beat = app.heartbeat
-        pub_beat = beat.get_public()
-
-        response = dict(token=db_token.token,
-                        type=type(beat).__name__,
-                        heartbeat=pub_beat.todict())
 
         if (app.mongo_logger is not None):
-            app.mongo_logger.log_event('new', {'context': handler.context,
-                                               'response': response})
+            # the heartbeat is the same for everyone, so we leave it out
+            response = dict(token=db_token.token,
+                            type=type(app.heartbeat).__name__)
+            handler.log_event('new', response)
 
-        return jsonify(response)
+        return heartbeat_response(db_token.token)
 
     return handler.response
 
@@ -229,23 +376,26 @@ def api_downstream_heartbeat(token):
     with HttpHandler(app.mongo_logger) as handler:
         handler.context['token'] = token
         handler.context['remote_addr'] = request.remote_addr
-        db_token = Token.query.filter(Token.token == token).first()
+        db_token = get_token(token)
 
         if (db_token is None):
             raise NotFoundError('Nonexistent token.')
 
-        beat = app.heartbeat
-        pub_beat = beat.get_public()
-        response = dict(token=db_token.token,
-                        type=type(beat).__name__,
-                        heartbeat=pub_beat.todict())
-
         if (app.mongo_logger is not None):
-            app.mongo_logger.log_event('heartbeat',
-                                       {'context': handler.context,
-                                        'response': response})
+            response = dict(token=db_token.token,
+                            type=type(app.heartbeat).__name__)
+            handler.log_event('heartbeat', response)
+
+        # the public heartbeat almost never changes, so farmers can
+        # revalidate what they have
+        # weakly, since compression weakens the etag
+        if (request.if_none_match.contains_weak(app.public_heartbeat_etag)):
+            response = app.response_class(status=304)
+        else:
+            response = heartbeat_response(db_token.token)
+        response.set_etag(app.public_heartbeat_etag)
 
-        return jsonify(response)
+        return response
 
     return handler.response
 
@@ -267,15 +417,16 @@ def api_downstream_chunk_contract(token, size):
             # no contracts available
             if (app.mongo_logger is not None):
                 rsummary = {'status': 'no chunks available'}
-                app.mongo_logger.log_event('chunk',
-                                           {'context': handler.context,
-                                            'response': rsummary})
+                handler.log_event('chunk', rsummary)
 
-            return jsonify(response)
+            return respond(response)
 
         chunks = list()
         summary = list()
 
+        # the tags are read, and removed, before anything is sent, so that
+        # an error is reported as such rather than as a cut short response.
+        # only the encoding is streamed, see STREAM_JSON
         for db_contract in db_contracts:
             with open(db_contract.tag_path, 'rb') as f:
                 tag = pickle.load(f)
@@ -303,15 +454,11 @@ def api_downstream_chunk_contract(token, size):
             chunks.append(chunk)
             summary.append(chunk_summary)
 
-        response = dict(chunks=chunks)
-
         if (app.mongo_logger is not None):
             # we'll remove the tag becauase it could potentially be very large
-            app.mongo_logger.log_event('chunk',
-                                       {'context': handler.context,
-                                        'response': dict(chunks=summary)})
+            handler.log_event('chunk', dict(chunks=summary))
 
-        return jsonify(response)
+        return respond_list('chunks', chunks)
 
     return handler.response
 
@@ -324,16 +471,23 @@ def api_downstream_chunk_contract_status(token):
 
     :param limit: only update limit contracts.
     :param answered: only update answered contracts
+    :param wait: hold the request for up to this many seconds, until one of
+        the contracts falls due
+    :param since: the cursor from a previous response.  only the contracts
+        whose challenge or status has changed since then are returned
     """
     with HttpHandler(app.mongo_logger) as handler:
         handler.context['token'] = token
         handler.context['remote_addr'] = request.remote_addr
 
-        db_token = Token.query.filter(Token.token == token).first()
+        db_token = get_token(token)
 
         if (db_token is None):
             raise InvalidParameterError('Nonexistent token.')
 
+        token_id = db_token.id
+        hashes = None
+
         d = request.get_json(silent=True)
 
         if (request.method == 'POST' and d is not False):
@@ -344,12 +498,34 @@ def api_downstream_chunk_contract_status(token):
                                             '[...contract hashes...]}')
 
             # pull the contracts for the hashes
-            db_contracts = Contract.query.join(File).filter(
-                and_(Contract.token_id == db_token.id,
-                     File.hash.in_(d['hashes']))).all()
-        else:
-            db_contracts = Contract.query.filter(
-                Contract.token_id == db_token.id).all()
+            hashes = d['hashes']
+
+        wait = request.args.get('wait', 0, type=float)
+
+        if (wait < 0):
+            raise InvalidParameterError('Wait must not be negative.')
+
+        if (wait > 0 and not (app.config['CHALLENGE_WAIT_BLOCKING'] or
+                              cooperative_sleep())):
+            # a sync worker would be tied up for the whole wait
+            raise InvalidParameterError('Wait is not supported by this '
+                                        'server.')
+
+        since = request.args.get('since')
+
+        if (since is not None):
+            since = parse_challenge_cursor(since)
+
+        wait_for_challenge(token_id, hashes, wait)
+
+        # read in the same transaction as the contracts, so that every
+        # change stamped with this number or lower is in them
+        now = datetime.utcnow()
+        seq = read_challenge_seq(token_id)
+
+        db_contracts = get_token_contracts(token_id, hashes, since, now)
+
+        load_challenge_columns(db_contracts)
 
         challenges = list()
 
@@ -368,23 +544,28 @@ def api_downstream_chunk_contract_status(token):
                 challenges.append(challenge)
                 continue
 
-            challenge['challenge'] = db_contract.challenge.todict()
+            challenge['challenge'] = \
+                contract_heartbeat(db_contract)[1].todict()
             challenge['due'] = (db_contract.due - datetime.utcnow())\
                 .total_seconds()
             challenge['answered'] = db_contract.answered
 
             challenges.append(challenge)
 
+        # if nothing else changed the contracts in between, the farmer has
+        # also seen the changes made here
+        if (taken_challenge_seq(token_id) == seq + 1):
+            seq += 1
+
         db.session.commit()
 
-        response = dict(challenges=challenges)
+        response = dict(challenges=challenges,
+                        cursor=challenge_cursor(seq, now))
 
         if (app.mongo_logger is not None):
-            app.mongo_logger.log_event('challenge',
-                                       {'context': handler.context,
-                                        'response': response})
+            handler.log_event('challenge', response)
 
-        return jsonify(response)
+        return respond(response)
 
     return handler.response
 
@@ -400,7 +581,7 @@ def api_downstream_challenge_answer(token):
 
         received = datetime.utcnow()
 
-        db_token = Token.query.filter(Token.token == token).first()
+        db_token = get_token(token)
 
         if (db_token is None):
             raise InvalidParameterError('Nonexistent token.')
@@ -428,9 +609,9 @@ def api_downstream_challenge_answer(token):
             proofs[p['file_hash']] = p['proof']
 
         # pull contracts from db
-        db_contracts = Contract.query.join(File).filter(
-            and_(Contract.token_id == db_token.id,
-                 File.hash.in_(proofs.keys()))).all()
+        db_contracts = get_token_contracts(db_token.id, proofs.keys())
+
+        load_proof_columns(db_contracts, received)
 
         report = list()
 
@@ -463,10 +644,8 @@ def api_downstream_challenge_answer(token):
         response = dict(report=report)
 
         if (app.mongo_logger is not None):
-            app.mongo_logger.log_event('answer',
-                                       {'context': handler.context,
-                                        'response': response})
+            handler.log_event('answer', response)
 
-        return jsonify(response)
+        return respond(response)
 
     return handler.response
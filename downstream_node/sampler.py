@@ -0,0 +1,134 @@
+import os
+import sys
+import time
+import threading
+
+
+class StackSampler(object):
+
+    """A statistical profiler.  A background thread periodically captures the
+    stack of every thread that is currently serving a request and counts each
+    distinct stack per route, so the overhead depends on the sample rate
+    rather than on how much code the request runs.
+    """
+
+    def __init__(self, rate=100, flush=None, flush_interval=60,
+                 max_depth=64):
+        """
+        :param rate: samples per second
+        :param flush: called from the sampler thread every flush_interval
+            seconds with the counts collected since the last flush
+        :param flush_interval: seconds between flushes
+        :param max_depth: the maximum number of frames kept per stack
+        """
+        self.interval = 1.0 / rate
+        self.flush = flush
+        self.flush_interval = flush_interval
+        self.max_depth = max_depth
+        # thread ident -> route of the request it is serving
+        self.active = dict()
+        # (route, collapsed stack) -> sample count
+        self.counts = dict()
+        self.labels = dict()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.running = False
+
+    def start(self):
+        """Starts the sampler thread of this process, if it has not been
+        started.  A forked worker inherits the sampler but not its thread, so
+        it starts its own, with the counts of its own requests.
+        """
+        if (self.thread is not None and self.pid == os.getpid()):
+            return
+        with self.lock:
+            if (self.thread is not None and self.pid == os.getpid()):
+                return
+            if (self.pid is not None):
+                # the parent's counts are its own to flush
+                self.counts = dict()
+            self.running = True
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def stop(self):
+        self.running = False
+        if (self.thread is not None):
+            self.thread.join()
+            self.thread = None
+            self.pid = None
+
+    def begin(self, route):
+        """Marks the current thread as serving route
+
+        :param route: the route being served
+        """
+        self.active[threading.current_thread().ident] = route
+
+    def end(self):
+        """Marks the current thread as idle"""
+        self.active.pop(threading.current_thread().ident, None)
+
+    def _label(self, code):
+        # formatting the frame labels is the expensive part of sampling, so
+        # keep them around
+        label = self.labels.get(code)
+        if (label is None):
+            label = '{0}:{1}:{2}'.format(code.co_filename,
+                                         code.co_firstlineno,
+                                         code.co_name)
+            self.labels[code] = label
+        return label
+
+    def collapse(self, frame):
+        """Collapses the stack ending in frame into a string of
+        "filename:first line:function:line" frames separated by ';', outermost
+        first, as used by flamegraph tools.
+
+        :param frame: the innermost frame
+        :returns: the collapsed stack
+        """
+        parts = list()
+        while (frame is not None and len(parts) < self.max_depth):
+            parts.append('{0}:{1}'.format(self._label(frame.f_code),
+                                          frame.f_lineno))
+            frame = frame.f_back
+        parts.reverse()
+        return ';'.join(parts)
+
+    def sample(self):
+        """Takes one sample of every active thread"""
+        frames = sys._current_frames()
+        for (ident, route) in list(self.active.items()):
+            frame = frames.get(ident)
+            if (frame is None):
+                continue
+            key = (route, self.collapse(frame))
+            with self.lock:
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def drain(self):
+        """Returns the counts collected so far and resets them
+
+        :returns: a dict mapping (route, collapsed stack) to sample count
+        """
+        with self.lock:
+            (counts, self.counts) = (self.counts, dict())
+        return counts
+
+    def _run(self):
+        last_flush = time.time()
+        while (self.running):
+            time.sleep(self.interval)
+            self.sample()
+            if (self.flush is not None
+                    and time.time() - last_flush >= self.flush_interval):
+                last_flush = time.time()
+                try:
+                    self.flush(self.drain())
+                except Exception as ex:
+                    # never let a failed flush stop the sampler
+                    print('Unable to flush profile samples: {0}'.format(ex))
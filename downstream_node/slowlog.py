@@ -0,0 +1,306 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from flask import request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    import queue
+except ImportError:
+    # python 2
+    import Queue as queue
+
+from .utils import UNMATCHED_ROUTE
+
+# a parenthesized list of two or more placeholders, as rendered for IN (...)
+PLACEHOLDER_LIST = re.compile(
+    r'\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*\)')
+
+EXPLAINABLE = ('select', 'update', 'delete')
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS statements ('
+    'fingerprint TEXT PRIMARY KEY, '
+    'statement TEXT, '
+    'explain TEXT, '
+    'first_seen REAL, '
+    'count INTEGER, '
+    'total_time REAL, '
+    'max_time REAL)',
+    'CREATE TABLE IF NOT EXISTS slow_queries ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+    'fingerprint TEXT, '
+    'time REAL, '
+    'duration REAL, '
+    'route TEXT, '
+    'parameters TEXT)']
+
+
+def fingerprint(statement):
+    """Returns a key that is the same for statements that only differ in
+    the number of values in an IN list
+    """
+    normalized = PLACEHOLDER_LIST.sub('(...)', ' '.join(statement.split()))
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def shape(value):
+    """Describes a bind parameter by its type, and its length for strings
+    and sequences, without recording its value
+    """
+    name = type(value).__name__
+    if (isinstance(value, (type(u''), bytes, bytearray, list, tuple))):
+        return '{0}[{1}]'.format(name, len(value))
+    return name
+
+
+def parameter_shapes(parameters, executemany):
+    """Describes the bind parameters of a statement
+
+    :param parameters: the parameters passed to the cursor
+    :param executemany: whether parameters is a list of parameter sets
+    :returns: a json string
+    """
+    if (executemany):
+        return json.dumps({'executemany': len(parameters),
+                           'first': json.loads(
+                               parameter_shapes(parameters[0], False))
+                           if len(parameters) > 0 else None})
+    if (isinstance(parameters, dict)):
+        return json.dumps(dict((k, shape(v)) for (k, v) in
+                               parameters.items()), sort_keys=True)
+    return json.dumps([shape(v) for v in parameters or ()])
+
+
+def explain_prefix(dialect_name):
+    if (dialect_name == 'sqlite'):
+        return 'EXPLAIN QUERY PLAN '
+    return 'EXPLAIN '
+
+
+class SlowQueryLog(object):
+
+    """Records statements that take longer than a threshold in a local
+    sqlite database, along with the shapes of their parameters and the
+    route that issued them.  Each distinct statement is explained once.  The
+    store is trimmed to the most recent max_entries slow queries.
+
+    Slow queries are queued and written, and explained on a connection of
+    their own, by a writer thread in each process, so that requests neither
+    wait for the store nor for each other.  Slow queries are dropped when
+    max_pending are already queued.
+    """
+
+    def __init__(self, path, threshold=0.5, max_entries=10000,
+                 max_pending=1000):
+        """
+        :param path: the path of the sqlite database to store them in
+        :param threshold: the number of seconds above which a statement is
+            considered slow
+        :param max_entries: the number of slow queries to keep
+        :param max_pending: the number of slow queries that may wait to be
+            written
+        """
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+        # fingerprints that are already in the store
+        self.explained = set()
+        self.pending = None
+        self.writer = None
+        self.writer_pid = None
+
+    def connect(self):
+        # sqlite connections must not be shared with forked workers
+        if (self.connection is None or self.pid != os.getpid()):
+            self.connection = sqlite3.connect(self.path,
+                                              check_same_thread=False)
+            for s in SCHEMA:
+                self.connection.execute(s)
+            self.connection.commit()
+            self.pid = os.getpid()
+            self.explained = set(r[0] for r in self.connection.execute(
+                'SELECT fingerprint FROM statements'))
+        return self.connection
+
+    def explain(self, engine, statement, parameters, executemany):
+        """Explains a statement on a connection of its own from the engine
+        it ran on, so that the connection it ran on, and any results still
+        being read from it, are left alone
+
+        :returns: the plan as text, or the error if it could not be explained
+        """
+        if (not statement.lstrip().lower().startswith(EXPLAINABLE)):
+            return None
+        if (executemany):
+            parameters = parameters[0] if len(parameters) > 0 else ()
+        try:
+            connection = engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                cursor.execute(explain_prefix(engine.dialect.name) +
+                               statement, parameters)
+                columns = [d[0] for d in cursor.description or ()]
+                rows = [dict(zip(columns, [str(v) for v in r]))
+                        for r in cursor.fetchall()]
+                cursor.close()
+            finally:
+                connection.close()
+            return json.dumps(rows, sort_keys=True)
+        except Exception as ex:
+            return 'EXPLAIN failed: {0}'.format(ex)
+
+    def submit(self, slow_query):
+        """Queues a slow query for the writer thread of this process,
+        starting it if need be
+
+        :param slow_query: the arguments of record()
+        """
+        if (self.writer_pid != os.getpid()):
+            with self.lock:
+                # a forked worker inherits neither the thread nor a usable
+                # queue, so it starts its own
+                if (self.writer_pid != os.getpid()):
+                    self.pending = queue.Queue(self.max_pending)
+                    self.writer = threading.Thread(target=self.write,
+                                                   args=(self.pending,),
+                                                   name='slow query log')
+                    self.writer.daemon = True
+                    self.writer.start()
+                    self.writer_pid = os.getpid()
+        try:
+            self.pending.put_nowait(slow_query)
+        except queue.Full:
+            # rather than hold up the request
+            pass
+
+    def write(self, pending):
+        while (True):
+            slow_query = pending.get()
+            try:
+                self.record(*slow_query)
+            except Exception as ex:
+                print('Unable to log slow query: {0}'.format(ex))
+            finally:
+                pending.task_done()
+
+    def flush(self):
+        """Waits until the slow queries queued by this process are
+        written"""
+        if (self.writer_pid == os.getpid()):
+            self.pending.join()
+
+    def record(self, engine, statement, parameters, executemany, duration,
+               route, shapes, now):
+        """Writes a slow query to the store, explaining its statement if it
+        is the first of its kind.  Called by the writer thread
+        """
+        key = fingerprint(statement)
+        plan = None
+        explain = key not in self.explained
+        if (explain):
+            plan = self.explain(engine, statement, parameters, executemany)
+
+        with self.lock:
+            store = self.connect()
+            if (explain):
+                store.execute(
+                    'INSERT OR IGNORE INTO statements VALUES '
+                    '(?, ?, ?, ?, 0, 0, 0)', (key, statement, plan, now))
+                self.explained.add(key)
+            store.execute(
+                'UPDATE statements SET count = count + 1, '
+                'total_time = total_time + ?, '
+                'max_time = MAX(max_time, ?) WHERE fingerprint = ?',
+                (duration, duration, key))
+            cursor = store.execute(
+                'INSERT INTO slow_queries (fingerprint, time, duration, '
+                'route, parameters) VALUES (?, ?, ?, ?, ?)',
+                (key, now, duration, route, shapes))
+            store.execute('DELETE FROM slow_queries WHERE id <= ?',
+                          (cursor.lastrowid - self.max_entries,))
+            if (cursor.lastrowid % self.max_entries == 0):
+                # forget statements whose slow queries have all been trimmed
+                store.execute('DELETE FROM statements WHERE fingerprint NOT '
+                              'IN (SELECT fingerprint FROM slow_queries)')
+                self.explained = set(r[0] for r in store.execute(
+                    'SELECT fingerprint FROM statements'))
+            store.commit()
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        context._slow_query_start = time.time()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        start = getattr(context, '_slow_query_start', None)
+        if (start is None):
+            return
+        duration = time.time() - start
+        if (duration >= self.threshold):
+            route = None
+            if (has_request_context()):
+                if (request.url_rule is not None):
+                    route = request.url_rule.rule
+                else:
+                    route = UNMATCHED_ROUTE
+            try:
+                self.submit((conn.engine, statement, parameters, executemany,
+                             duration, route,
+                             parameter_shapes(parameters, executemany),
+                             time.time()))
+            except Exception as ex:
+                # never fail a request because it could not be logged
+                print('Unable to log slow query: {0}'.format(ex))
+
+    def install(self):
+        """Starts timing the statements of every engine"""
+        if (not event.contains(Engine, 'before_cursor_execute',
+                               self.before_cursor_execute)):
+            event.listen(Engine, 'before_cursor_execute',
+                         self.before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         self.after_cursor_execute)
+
+    def statements(self, limit=20):
+        """Returns the slowest distinct statements by total time
+
+        :param limit: the number of statements to return
+        :returns: a list of dicts
+        """
+        with self.lock:
+            cursor = self.connect().execute(
+                'SELECT fingerprint, statement, explain, count, total_time, '
+                'max_time FROM statements ORDER BY total_time DESC LIMIT ?',
+                (limit,))
+            columns = [d[0] for d in cursor.description]
+            return [dict(zip(columns, r)) for r in cursor.fetchall()]
+
+    def recent(self, fingerprint=None, limit=20):
+        """Returns the most recent slow queries
+
+        :param fingerprint: only return queries of this statement
+        :param limit: the number of queries to return
+        :returns: a list of dicts
+        """
+        s = 'SELECT fingerprint, time, duration, route, parameters ' \
+            'FROM slow_queries'
+        args = tuple()
+        if (fingerprint is not None):
+            s += ' WHERE fingerprint = ?'
+            args = (fingerprint,)
+        with self.lock:
+            cursor = self.connect().execute(
+                s + ' ORDER BY id DESC LIMIT ?', args + (limit,))
+            columns = [d[0] for d in cursor.description]
+            return [dict(zip(columns, r)) for r in cursor.fetchall()]
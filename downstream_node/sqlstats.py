@@ -0,0 +1,155 @@
+import time
+import threading
+
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .utils import UNMATCHED_ROUTE
+
+
+class QueryStats(object):
+
+    """The queries issued while serving one request"""
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.slowest = None
+        self.slowest_time = 0.0
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.time += elapsed
+        if (self.slowest is None or elapsed > self.slowest_time):
+            self.slowest = statement
+            self.slowest_time = elapsed
+
+    def todict(self):
+        return dict(count=self.count,
+                    time=self.time,
+                    slowest=self.slowest,
+                    slowest_time=self.slowest_time)
+
+
+class RouteQueryStats(object):
+
+    """The queries issued by all the requests to one route"""
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.time = 0.0
+        self.max_queries = 0
+        self.slowest = None
+        self.slowest_time = 0.0
+
+    def add(self, stats):
+        self.requests += 1
+        self.queries += stats.count
+        self.time += stats.time
+        self.max_queries = max(self.max_queries, stats.count)
+        if (stats.slowest is not None and
+                stats.slowest_time > self.slowest_time):
+            self.slowest = stats.slowest
+            self.slowest_time = stats.slowest_time
+
+    def todict(self):
+        return dict(requests=self.requests,
+                    queries=self.queries,
+                    time=self.time,
+                    mean_queries=float(self.queries) / self.requests,
+                    max_queries=self.max_queries,
+                    slowest=self.slowest,
+                    slowest_time=self.slowest_time)
+
+
+# route -> RouteQueryStats, for this worker
+routes = dict()
+routes_lock = threading.Lock()
+
+
+def current_stats():
+    """Returns the query stats of the current request, or None if there is
+    no request or it has not issued a query
+    """
+    if (has_request_context()):
+        return getattr(g, 'query_stats', None)
+    return None
+
+
+def get_route():
+    if (request.url_rule is not None):
+        return request.url_rule.rule
+    return UNMATCHED_ROUTE
+
+
+def format_statement(statement, length=200):
+    """Collapses a statement onto a single line, so it can be sent in a
+    header"""
+    return ' '.join(statement.split())[:length]
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    context._query_start = time.time()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    start = getattr(context, '_query_start', None)
+    if (start is not None and has_request_context()):
+        stats = getattr(g, 'query_stats', None)
+        if (stats is None):
+            stats = QueryStats()
+            g.query_stats = stats
+        stats.record(statement, time.time() - start)
+
+
+def add_headers(response):
+    stats = current_stats()
+    if (current_app.debug and stats is not None):
+        response.headers['X-Query-Count'] = str(stats.count)
+        response.headers['X-Query-Time'] = '{0:.6f}'.format(stats.time)
+        response.headers['X-Slowest-Query'] = \
+            format_statement(stats.slowest)
+    return response
+
+
+def aggregate(exception=None):
+    stats = current_stats()
+    if (stats is not None):
+        route = get_route()
+        with routes_lock:
+            route_stats = routes.get(route)
+            if (route_stats is None):
+                route_stats = RouteQueryStats()
+                routes[route] = route_stats
+            route_stats.add(stats)
+
+
+def route_stats():
+    """Returns the aggregated query stats of each route served by this
+    worker
+
+    :returns: a dict mapping route to a dict of its stats
+    """
+    with routes_lock:
+        return dict((r, s.todict()) for (r, s) in routes.items())
+
+
+def install(app):
+    """Records the queries issued by each request served by app.  In debug
+    mode, the count, total time and slowest statement are sent in the
+    X-Query-Count, X-Query-Time and X-Slowest-Query response headers.
+
+    :param app: the app to instrument
+    """
+    # listen on every engine, so that engines flask-sqlalchemy creates
+    # when the database uri changes are instrumented too
+    if (not event.contains(Engine, 'before_cursor_execute',
+                           before_cursor_execute)):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    app.after_request(add_headers)
+    app.teardown_request(aggregate)
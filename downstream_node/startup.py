@@ -1,17 +1,39 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import gc
+import sys
+import json
 import pickle
+import sqlite3
+import hashlib
 
 from flask import Flask
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event, create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import configure_mappers
 
-from . import config
-from .log import mongolog
+from . import config, sqlstats, metrics, encoding
+from .whitelist import WhitelistIndex
+from .slowlog import SlowQueryLog
+from .replicas import EngineRouter
+from .memprofile import MemoryProfiler
+from .utils import LRUCache
 
 app = Flask(__name__)
 app.config.from_object(config)
 db = SQLAlchemy(app)
+# set by create_app
+app.created = False
+
+
+def enable_sqlite_wal(dbapi_connection, connection_record):
+    # write ahead logging lets readers continue while a request writes, so
+    # a single box node can serve concurrent farmers from sqlite.  in memory
+    # databases keep their own journal mode
+    if (isinstance(dbapi_connection, sqlite3.Connection)):
+        dbapi_connection.execute('PRAGMA journal_mode=WAL')
 
 
 def load_heartbeat(constructor, path):
@@ -26,21 +48,198 @@ def load_heartbeat(constructor, path):
         return beat
 
 
+def install_heartbeat(app, beat):
+    """Installs beat as the app wide heartbeat.  The public heartbeat is
+    serialized once here so that routes only need to splice in a token.
+
+    :param app: the app to install the heartbeat into
+    :param beat: the heartbeat
+    """
+    fragment = json.dumps({'type': type(beat).__name__,
+                           'heartbeat': beat.get_public().todict()},
+                          sort_keys=True)
+    app.heartbeat = beat
+    # strip the braces, so that we can splice the members into a response
+    app.public_heartbeat = fragment[1:-1]
+    app.public_heartbeat_etag = hashlib.sha256(
+        fragment.encode('utf-8')).hexdigest()
+
+
 def load_logger(log, uri, server_alias):
     if (log):
+        # pymongo is only imported when mongo logging is on
+        from .log import mongolog
         return mongolog(uri, server_alias)
     else:
         return None
 
-app.heartbeat = load_heartbeat(
-    app.config['HEARTBEAT'], app.config['HEARTBEAT_PATH'])
 
-app.mongo_logger = load_logger(app.config['MONGO_LOGGING'],
-                               app.config['MONGO_URI'],
-                               app.config['SERVER_ALIAS'])
+def load_geoip(enabled, path):
+    if (enabled):
+        import maxminddb
+        try:
+            # the database is memory mapped, so forked workers share its
+            # pages
+            return maxminddb.Reader(path)
+        except IOError as ex:
+            print('Unable to open the GeoIP database, locations will not '
+                  'be looked up: {0}'.format(ex))
+            return None
+    else:
+        return None
+
+
+def load_whitelist_index(enabled, stamp_path, check_interval):
+    if (enabled):
+        return WhitelistIndex(stamp_path, check_interval)
+    else:
+        return None
+
+
+def warm_whitelist_index(index):
+    """Loads the whitelist index from the database, if it can be reached.
+    Otherwise each worker loads it before its first request.
+    """
+    from .node import whitelist_rows
+    try:
+        with app.app_context():
+            index.load(whitelist_rows())
+    except Exception as ex:
+        print('Unable to load the whitelist index: {0}'.format(ex))
+    finally:
+        # connections must not be shared with forked workers
+        db.engine.dispose()
+
+
+def load_slow_query_log(enabled, path, threshold, max_entries):
+    if (enabled):
+        log = SlowQueryLog(path, threshold, max_entries)
+        log.install()
+        return log
+    else:
+        return None
+
+
+def load_engine_router(replica_uri, max_lag, check_interval):
+    replica = None
+    if (replica_uri is not None):
+        # recycle connections before mysql's wait_timeout closes them
+        replica = create_engine(replica_uri, pool_recycle=3600)
+    router = EngineRouter(lambda: db.engine, replica, max_lag, check_interval)
+    router.install(app)
+    return router
+
+
+def load_state_cache(size):
+    if (size > 0):
+        return LRUCache(size)
+    else:
+        return None
+
+
+def load_heartbeat_pool(processes, beat):
+    if (processes > 0):
+        # the pool initializes its workers with the heartbeat, which the
+        # process pool only supports from python 3.7
+        if (sys.version_info < (3, 7)):
+            raise RuntimeError('HEARTBEAT_PROCESSES needs python 3.7 or '
+                               'later.')
+        from .beatpool import HeartbeatPool
+        return HeartbeatPool(beat, processes)
+    else:
+        return None
+
+
+def load_memory_profiler(enabled, frames, max_snapshots):
+    if (enabled):
+        profiler = MemoryProfiler(frames, max_snapshots)
+        profiler.install(app)
+        return profiler
+    else:
+        return None
+
+# the command line tools use the same databases, so they are opened in WAL
+# mode on import
+if (app.config['SQLITE_WAL']):
+    event.listen(Engine, 'connect', enable_sqlite_wal)
+
+# set by create_app
+app.slow_queries = None
+
+
+def create_app():
+    """Loads the heartbeat, the GeoIP database, the whitelist index and the
+    optional subsystems, configures the mappers and registers the routes.
+    Importing this module only sets up sqlite's WAL mode, so that the
+    command line tools and tests only pay for what they use.
+    Under a pre-forking server, call this in the master so that the
+    workers share what it loads copy on write.  Calling it again does
+    nothing.
+
+    :returns: the app
+    """
+    if (app.created):
+        return app
+
+    install_heartbeat(app, load_heartbeat(
+        app.config['HEARTBEAT'], app.config['HEARTBEAT_PATH']))
+
+    app.mongo_logger = load_logger(app.config['MONGO_LOGGING'],
+                                   app.config['MONGO_URI'],
+                                   app.config['SERVER_ALIAS'])
+
+    app.geoip = load_geoip(app.config['GEOIP'], app.config['MMDB_PATH'])
+
+    app.whitelist = load_whitelist_index(
+        app.config['WHITELIST_INDEX'],
+        app.config['WHITELIST_STAMP_PATH'],
+        app.config['WHITELIST_CHECK_INTERVAL'])
+    if (app.whitelist is not None):
+        warm_whitelist_index(app.whitelist)
+
+    app.state_cache = load_state_cache(app.config['STATE_CACHE_SIZE'])
+
+    app.heartbeat_pool = load_heartbeat_pool(
+        app.config['HEARTBEAT_PROCESSES'], app.heartbeat)
+
+    # reporting queries read from the replica, if there is one
+    app.engines = load_engine_router(app.config['SQLALCHEMY_REPLICA_URI'],
+                                     app.config['REPLICA_MAX_LAG'],
+                                     app.config['REPLICA_CHECK_INTERVAL'])
+
+    app.memory_profiler = load_memory_profiler(
+        app.config['MEMORY_PROFILE'],
+        app.config['MEMORY_PROFILE_FRAMES'],
+        app.config['MEMORY_PROFILE_SNAPSHOTS'])
+
+    if (app.config['SQL_STATS']):
+        sqlstats.install(app)
+
+    app.slow_queries = load_slow_query_log(
+        app.config['SLOW_QUERY_LOG'],
+        app.config['SLOW_QUERY_PATH'],
+        app.config['SLOW_QUERY_THRESHOLD'],
+        app.config['SLOW_QUERY_MAX_ENTRIES'])
+
+    if (app.config['METRICS']):
+        metrics.install(app)
+
+    if (app.config['COMPRESS']):
+        encoding.install(app)
+
+    from . import routes  # NOQA
+
+    if (app.config['PROFILE']):
+        from . import profiling  # NOQA
 
+    # build the mapper relationships now, rather than in each worker on its
+    # first query
+    configure_mappers()
 
-from . import routes  # NOQA
+    if (hasattr(gc, 'freeze')):
+        # keep the collector from touching, and so copying, the objects
+        # loaded so far in each worker
+        gc.freeze()
 
-if (app.config['PROFILE']):
-    from . import profiling  # NOQA
+    app.created = True
+    return app
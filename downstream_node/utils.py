@@ -1,4 +1,11 @@
 import math
+import bisect
+import threading
+from collections import OrderedDict
+
+# the route label of requests that matched no route.  labelling them with
+# their path instead would let every probed url add a label
+UNMATCHED_ROUTE = '<unmatched>'
 
 
 class Distribution(object):
@@ -140,3 +147,151 @@ class MonopolyDistribution(Distribution):
         :returns: the distribution of missing items
         """
         return self.subtract(Distribution(from_list=other_list))
+
+
+# upper bounds, in seconds, of the default latency histogram buckets
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0]
+
+
+class Histogram(object):
+
+    """Counts observations in fixed buckets, so that totals and percentiles
+    can be kept in constant space no matter how many observations are made.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS, counts=None, total=0.0):
+        """
+        :param bounds: the ascending upper bounds of the buckets.  there is
+            one more bucket for everything above the last bound
+        :param counts: initial bucket counts
+        :param total: initial sum of the observations
+        """
+        self.bounds = list(bounds)
+        if (counts is not None):
+            self.counts = list(counts)
+        else:
+            self.counts = [0] * (len(self.bounds) + 1)
+        self.total = total
+        self.lock = threading.Lock()
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        """Adds an observation to the histogram"""
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.total += value
+
+    def mean(self):
+        count = self.count
+        return self.total / count if count > 0 else 0
+
+    def percentile(self, p):
+        """Estimates a percentile by interpolating within the bucket that
+        contains it.  Observations above the last bound are reported as the
+        last bound.
+
+        :param p: the percentile, between 0 and 100
+        :returns: the estimated value
+        """
+        count = self.count
+        if (count == 0):
+            return 0
+        target = count * p / 100.0
+        cumulative = 0
+        for i in range(0, len(self.counts)):
+            if (self.counts[i] > 0 and cumulative + self.counts[i] >= target):
+                if (i == len(self.bounds)):
+                    return self.bounds[-1]
+                lower = self.bounds[i - 1] if i > 0 else 0
+                fraction = (target - cumulative) / self.counts[i]
+                return lower + (self.bounds[i] - lower) * fraction
+            cumulative += self.counts[i]
+        return self.bounds[-1]
+
+    def cumulative(self):
+        """Returns a list of (upper bound, cumulative count) pairs, with
+        None as the bound of the last bucket
+        """
+        result = list()
+        cumulative = 0
+        for (bound, count) in zip(self.bounds + [None], self.counts):
+            cumulative += count
+            result.append((bound, cumulative))
+        return result
+
+
+class LRUCache(object):
+
+    """A bounded mapping that evicts its least recently used entry when it
+    is full, and counts its hits, misses and evictions.  It can be shared
+    between threads.
+    """
+
+    def __init__(self, capacity):
+        """
+        :param capacity: the maximum number of entries
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        """Returns whether key is cached, without counting a hit or a miss
+        or making it more recent"""
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key, default=None):
+        """Returns the value cached for key and makes it the most recently
+        used, or default if it is not cached
+        """
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Caches value for key, evicting the least recently used entries
+        if the cache is over capacity
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while (len(self.entries) > self.capacity):
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups > 0 else 0.0
+
+    def stats(self):
+        """Returns the size, capacity, hits, misses, evictions and hit rate
+        of the cache as a dict
+        """
+        return dict(size=len(self.entries),
+                    capacity=self.capacity,
+                    hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    hit_rate=self.hit_rate())
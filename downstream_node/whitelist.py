@@ -0,0 +1,125 @@
+import math
+import struct
+import hashlib
+import threading
+import time
+
+
+class BloomFilter(object):
+
+    """A fixed size Bloom filter for strings.  Membership tests may return
+    false positives at roughly error_rate, but never false negatives.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        self.size = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(
+            float(self.size) / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        if (not isinstance(item, bytes)):
+            item = item.encode('utf-8')
+        # double hashing, see Kirsch and Mitzenmacher
+        (h1, h2) = struct.unpack('<QQ', hashlib.sha256(item).digest()[:16])
+        return [(h1 + i * h2) % self.size for i in range(0, self.hashes)]
+
+    def add(self, item):
+        for p in self._positions(item):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[p >> 3] & (1 << (p & 7))
+                   for p in self._positions(item))
+
+
+def touch_stamp(path):
+    """Marks the whitelist as changed so that every worker reloads its
+    index on the next check.
+
+    :param path: the path of the stamp file
+    """
+    with open(path, 'w') as f:
+        f.write(str(time.time()))
+
+
+def read_stamp(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+class WhitelistIndex(object):
+
+    """A per process index of the whitelist, so that signups from unknown
+    or underfunded addresses can be rejected without touching the database.
+    A Bloom filter in front of a hash map of address to (id, balance) keeps
+    the common miss cheap.
+    """
+
+    def __init__(self, stamp_path=None, check_interval=5):
+        """
+        :param stamp_path: path of the stamp file touched whenever the
+            whitelist changes
+        :param check_interval: the minimum number of seconds between checks
+            of the stamp file
+        """
+        self.stamp_path = stamp_path
+        self.check_interval = check_interval
+        self.bloom = None
+        self.addresses = dict()
+        self.stamp = None
+        self.last_check = 0
+        self.lock = threading.Lock()
+
+    def load(self, rows):
+        """Rebuilds the index.
+
+        :param rows: an iterable of (address, id, balance) rows
+        """
+        with self.lock:
+            stamp = None
+            if (self.stamp_path is not None):
+                stamp = read_stamp(self.stamp_path)
+            addresses = dict((r[0], (r[1], r[2])) for r in rows)
+            bloom = BloomFilter(len(addresses))
+            for address in addresses:
+                bloom.add(address)
+            # swap in the new structures in one go, lookups in other
+            # threads may still be using the old ones
+            (self.bloom, self.addresses) = (bloom, addresses)
+            self.stamp = stamp
+            self.last_check = time.time()
+
+    def is_stale(self):
+        """Returns whether the index needs to be reloaded, either because it
+        has never been loaded or because the stamp file has changed.
+        """
+        if (self.bloom is None):
+            return True
+        if (self.stamp_path is None):
+            return False
+        now = time.time()
+        if (now - self.last_check < self.check_interval):
+            return False
+        self.last_check = now
+        return read_stamp(self.stamp_path) != self.stamp
+
+    def lookup(self, address):
+        """Looks up an address in the index.
+
+        :param address: the address to look up
+        :returns: a tuple of (id, balance), or None if the address is not in
+            the whitelist
+        """
+        (bloom, addresses) = (self.bloom, self.addresses)
+        if (bloom is None or address not in bloom):
+            return None
+        return addresses.get(address)
+
+    def __len__(self):
+        return len(self.addresses)
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The WSGI entry point.  The app is loaded when this module is imported, so
+# a pre-forking server that imports it in its master, e.g.
+#
+#     gunicorn --preload -w 4 downstream_node.wsgi:application
+#
+# loads the heartbeat, the GeoIP database and the whitelist index once and
+# forks workers that share them.
+
+from werkzeug.exceptions import NotFound
+from werkzeug.wsgi import DispatcherMiddleware
+
+from .startup import create_app
+
+app = create_app()
+
+# served under APPLICATION_ROOT, like the development server
+application = DispatcherMiddleware(NotFound(),
+                                   {app.config['APPLICATION_ROOT']: app})
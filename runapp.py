@@ -6,37 +6,176 @@
 
 import argparse
 import csv
+import os
 import time
+import uuid
 from flask import Flask, jsonify
 from werkzeug.serving import run_simple
 from werkzeug.wsgi import DispatcherMiddleware
 from datetime import datetime, timedelta
-from sqlalchemy import select, engine, update, insert, bindparam, true, func, and_
+from sqlalchemy import select, bindparam, true, func, and_, or_, exists
+from sqlalchemy import Table, MetaData, Column, Integer, String, BigInteger, PickleType
 
-from downstream_node.startup import app, db
+from downstream_node.startup import app, db, create_app
 from downstream_node.models import Contract, Address, Token, File, Chunk, update_uptime_summary
 from downstream_node import node
 from downstream_node.utils import MonopolyDistribution, Distribution
+from downstream_node.whitelist import touch_stamp
+from downstream_node.slowlog import SlowQueryLog
 
 def initdb():   
     db.create_all()
 
 
-def cleandb():
+def cleandb(batch_size=1000, pause=0.1, grace=600):
+    """Incrementally removes cached contracts, files that are no longer
+    referenced by any contract or chunk, and tag files that are no longer
+    referenced by the database.  Rows are deleted in batches of batch_size
+    keyed by id so that no single statement holds locks for long, which
+    makes this safe to run alongside live traffic.
+
+    :param batch_size: the maximum number of rows or tags per statement
+    :param pause: seconds to sleep between batches to let the api through
+    :param grace: files and tags younger than this many seconds are left
+        alone, since they may belong to a chunk that is still being prepared
+    """
     # update uptime summary
     update_uptime_summary()
 
-    # delete expired contracts and files
-    s = Contract.__table__.delete().where(Contract.cached == true())
-    
-    db.engine.execute(s)
-    
-    # and delete unreferenced files
-    s = File.__table__.delete().where(~File.__table__.c.id.in_(select([Contract.__table__.c.file_id])
-                                                               .union(
-                                                               select([Chunk.__table__.c.file_id]))))
-    
-    db.engine.execute(s)
+    contracts = Contract.__table__
+    files = File.__table__
+    chunks = Chunk.__table__
+
+    # delete expired contracts
+    print('Deleting cached contracts...')
+    deleted_contracts = delete_in_batches(contracts,
+                                          contracts,
+                                          contracts.c.cached == true(),
+                                          contracts.c.cached == true(),
+                                          batch_size,
+                                          pause)
+
+    # and delete unreferenced files.  candidates are found with an anti-join
+    # and then rechecked when deleted in case a contract or chunk has picked
+    # them up in the meantime
+    print('Deleting unreferenced files...')
+    cutoff = datetime.utcnow() - timedelta(seconds=grace)
+    unreferenced = files.\
+        outerjoin(contracts, contracts.c.file_id == files.c.id).\
+        outerjoin(chunks, chunks.c.file_id == files.c.id)
+    deleted_files = delete_in_batches(
+        files,
+        unreferenced,
+        and_(contracts.c.id == None,  # NOQA
+             chunks.c.id == None,  # NOQA
+             files.c.added < cutoff),
+        and_(~exists().where(contracts.c.file_id == files.c.id),
+             ~exists().where(chunks.c.file_id == files.c.id)),
+        batch_size,
+        pause)
+
+    print('Deleting orphaned tags...')
+    deleted_tags = delete_orphaned_tags(batch_size, grace)
+
+    print('Removed {0} cached contracts, {1} unreferenced files and {2} '
+          'orphaned tags.'.format(deleted_contracts,
+                                  deleted_files,
+                                  deleted_tags))
+
+
+def delete_in_batches(table, from_obj, condition, guard, batch_size, pause=0):
+    """Deletes the rows of table matching condition in batches, walking the
+    table in id order so that each batch is a short, index bounded statement.
+
+    :param table: the table to delete from
+    :param from_obj: the selectable to search for candidate rows in
+    :param condition: the condition candidate rows must meet
+    :param guard: a condition rechecked at delete time, in case a candidate
+        row no longer qualifies
+    :param batch_size: the maximum number of rows per batch
+    :param pause: seconds to sleep between batches
+    :returns: the number of rows deleted
+    """
+    last_id = 0
+    deleted = 0
+    while (1):
+        candidate_stmt = select([table.c.id]).\
+            select_from(from_obj).\
+            where(and_(condition, table.c.id > last_id)).\
+            order_by(table.c.id).\
+            limit(batch_size)
+        ids = [r[0] for r in db.engine.execute(candidate_stmt).fetchall()]
+        if (len(ids) == 0):
+            break
+        last_id = ids[-1]
+        result = db.engine.execute(
+            table.delete().where(and_(table.c.id.in_(ids), guard)))
+        deleted += result.rowcount
+        print('  {0}: {1} deleted so far (up to id {2})'.format(
+            table.name, deleted, last_id))
+        time.sleep(pause)
+    return deleted
+
+
+def delete_orphaned_tags(batch_size, grace):
+    """Reconciles the tag directory against the database, removing any tag
+    file that is referenced by neither a chunk nor a contract.
+
+    :param batch_size: the number of tag files to check per query
+    :param grace: tags younger than this many seconds are left alone
+    :returns: the number of tag files removed
+    """
+    tags_path = app.config['TAGS_PATH']
+    cutoff = time.time() - grace
+    deleted = 0
+    batch = list()
+    for name in os.listdir(tags_path):
+        if (name.startswith('.')):
+            continue
+        batch.append(os.path.join(tags_path, name))
+        if (len(batch) >= batch_size):
+            deleted += delete_unreferenced_tags(batch, cutoff)
+            print('  tags: {0} deleted so far'.format(deleted))
+            batch = list()
+    if (len(batch) > 0):
+        deleted += delete_unreferenced_tags(batch, cutoff)
+    return deleted
+
+
+def delete_unreferenced_tags(paths, cutoff):
+    referenced_stmt = select([Chunk.__table__.c.tag_path]).\
+        where(Chunk.__table__.c.tag_path.in_(paths)).\
+        union(select([Contract.__table__.c.tag_path]).
+              where(Contract.__table__.c.tag_path.in_(paths)))
+    referenced = set(r[0] for r in
+                     db.engine.execute(referenced_stmt).fetchall())
+    deleted = 0
+    for path in paths:
+        if (path in referenced):
+            continue
+        try:
+            if (os.path.getmtime(path) < cutoff):
+                os.remove(path)
+                deleted += 1
+        except OSError:
+            # the tag was removed from under us, probably by /chunk/
+            pass
+    return deleted
+
+
+def maintain_db(interval, batch_size):
+    # cleans the db continuously
+    while(1):
+        cleandb(batch_size)
+        time.sleep(interval)
+
+
+def maintain_summary(interval):
+    # keeps the uptime summary of the status views up to date, so that they
+    # do not have to, see UPTIME_SUMMARY_INTERVAL
+    while(1):
+        update_uptime_summary()
+        time.sleep(interval)
 
 def get_available_sizes():
     available_sizes_stmt = select([File.__table__.c.size]).select_from(Chunk.__table__.join(File.__table__))
@@ -64,62 +203,288 @@ def maintain_capacity(min_chunk_size, max_chunk_size, size, base=2):
             print('Done.')
         time.sleep(2)
     
+def pregenerate_challenges(lookahead, batch_size):
+    # keeps the next challenge ready for contracts that are nearly due
+    exhausted = set()
+    while(1):
+        generated = node.pregenerate_challenges(lookahead,
+                                                batch_size,
+                                                exhausted)
+        if (generated > 0):
+            print('Pre-generated {0} challenges.'.format(generated))
+        if (generated < batch_size):
+            time.sleep(1)
+
+
+# tokens.location held a pickled dict before the location was split into
+# columns.  --migrate-locations reads it through this table
+legacy_tokens = Table(
+    'tokens', MetaData(),
+    Column('id', Integer(), primary_key=True),
+    Column('location', PickleType()))
+
+
+def migrate_locations(batch_size=1000):
+    """Copies the pickled location of each token into the location
+    columns, in batches in id order.  Add the columns before running it,
+    and drop tokens.location once it is done.
+
+    :param batch_size: the maximum number of tokens per batch
+    """
+    tokens = Token.__table__
+    update_stmt = tokens.update().\
+        where(tokens.c.id == bindparam('token_id')).\
+        values(country=bindparam('country'),
+               region=bindparam('region'),
+               city=bindparam('city'),
+               postal_code=bindparam('postal_code'),
+               latitude=bindparam('latitude'),
+               longitude=bindparam('longitude'))
+    last_id = 0
+    migrated = 0
+    while (1):
+        rows = db.engine.execute(
+            select([legacy_tokens.c.id, legacy_tokens.c.location]).
+            where(legacy_tokens.c.id > last_id).
+            order_by(legacy_tokens.c.id).
+            limit(batch_size)).fetchall()
+        if (len(rows) == 0):
+            break
+        last_id = rows[-1].id
+        values = list()
+        for r in rows:
+            location = r.location if r.location is not None else dict()
+            values.append(dict(token_id=r.id,
+                               country=location.get('country'),
+                               region=location.get('state'),
+                               city=location.get('city'),
+                               postal_code=location.get('zip'),
+                               latitude=location.get('lat'),
+                               longitude=location.get('lon')))
+        db.engine.execute(update_stmt, values)
+        migrated += len(values)
+    print('Migrated the locations of {0} tokens.'.format(migrated))
+
+
 def generate_chunks(size, number=1):
     # generates a test chunk
     for i in range(0,number):
         node.generate_test_file(size)
 
 
-def updatewhitelist(path):
-    with open(path,'r') as f:
+def whitelist_staging_table():
+    """Returns a new table to stream a whitelist csv into, so that the
+    address table can be synchronized with a handful of set based
+    statements.  The name is unique to the run, so that concurrent runs do
+    not drop or fill each other's table.
+    """
+    return Table(
+        'whitelist_staging_{0}'.format(uuid.uuid4().hex[:16]), MetaData(),
+        Column('id', Integer(), primary_key=True, autoincrement=True),
+        Column('address', String(128), nullable=False, unique=True),
+        Column('crowdsale_balance', BigInteger()))
+
+
+def updatewhitelist(path, batch_size=5000, min_ratio=0.5):
+    """Synchronizes the address table with a whitelist csv.  New addresses
+    are inserted, changed balances are updated, and addresses that are no
+    longer listed are removed along with their tokens and contracts.
+
+    Since an empty or truncated csv would remove every farmer missing from
+    it, a whitelist with no addresses, or with fewer than min_ratio times
+    the addresses currently listed, is refused and nothing is changed.
+
+    :param path: path to the whitelist csv
+    :param batch_size: the maximum number of rows per statement
+    :param min_ratio: the smallest fraction of the listed addresses the
+        whitelist may have.  0 accepts any whitelist that is not empty
+    """
+    staging = whitelist_staging_table()
+    staging.create(db.engine)
+    try:
+        staged = stage_whitelist(path, staging, batch_size)
+        print('Staged {0} whitelist rows.'.format(staged))
+        listed = db.engine.execute(
+            select([func.count(Address.__table__.c.id)])).scalar()
+        if (staged == 0 or staged < listed * min_ratio):
+            raise ValueError('Refusing a whitelist of {0} addresses when {1} '
+                             'are listed, since the rest would be removed.  '
+                             'Pass --whitelist-min-ratio 0 to accept it.'.
+                             format(staged, listed))
+        (inserted, updated) = upsert_whitelist(staging, batch_size)
+        (removed, tokens, contracts) = remove_unlisted_addresses(staging,
+                                                                 batch_size)
+    finally:
+        staging.drop(db.engine)
+    # let the workers know that they need to reload their whitelist index
+    touch_stamp(app.config['WHITELIST_STAMP_PATH'])
+    print('Inserted {0} and updated {1} addresses.  Removed {2} addresses, '
+          '{3} tokens and {4} contracts.'.format(inserted,
+                                                 updated,
+                                                 removed,
+                                                 tokens,
+                                                 contracts))
+
+
+def stage_whitelist(path, staging, batch_size):
+    """Streams the whitelist csv into the staging table in batches.  If an
+    address is listed more than once, the last balance wins.
+
+    :returns: the number of distinct addresses staged
+    """
+    seen = set()
+    batch = list()
+    with open(path, 'r') as f:
         r = csv.reader(f)
         next(r)
-        updated=list()
         for l in r:
-            s = Address.__table__.select().where(Address.address == l[0])
-            result = db.engine.execute(s).first()                
-            if (result is not None):
-                db.engine.execute(Address.__table__.update().\
-                    where(Address.id == result.id).\
-                    values(crowdsale_balance=int(l[1])))
-            else:
-                db.engine.execute(Address.__table__.insert().\
-                    values(address=l[0], crowdsale_balance=l[1]))
-                result = db.engine.execute(Address.__table__.select().\
-                    where(Address.address == l[0])).first()
-            updated.append(result.id)
-        all = db.engine.execute(Address.__table__.select()).fetchall()
-        for row in all:
-            if (row.id not in updated):
-                # also recursively delete all tokens associated with that address
-                tbd_tokens = db.engine.execute(Token.__table__.select().\
-                    where(Token.address_id == row.id)).fetchall()
-                for t in tbd_tokens:
-                    # and all contracts associated with that address                        
-                    db.engine.execute(Contract.__table__.delete().\
-                        where(Contract.token_id == t.id))
-                    db.engine.execute(Token.__table__.delete().\
-                        where(Token.id == t.id))
-                db.engine.execute(Address.__table__.delete().\
-                    where(Address.id == row.id))
+            if (len(l) < 2):
+                continue
+            row = {'address': l[0], 'crowdsale_balance': int(l[1])}
+            if (row['address'] in seen):
+                # rare, so just fix up the staged row.  it may still be in
+                # the pending batch, so flush that first
+                if (len(batch) > 0):
+                    db.engine.execute(staging.insert(), batch)
+                    batch = list()
+                s = staging.update().\
+                    where(staging.c.address == row['address']).\
+                    values(crowdsale_balance=row['crowdsale_balance'])
+                db.engine.execute(s)
+                continue
+            seen.add(row['address'])
+            batch.append(row)
+            if (len(batch) >= batch_size):
+                db.engine.execute(staging.insert(), batch)
+                batch = list()
+    if (len(batch) > 0):
+        db.engine.execute(staging.insert(), batch)
+    return len(seen)
+
+
+def upsert_whitelist(staging, batch_size):
+    """Applies the staged balances to the address table, walking the staging
+    table in id ranges of batch_size.
+
+    :returns: a tuple of (inserted, updated) address counts
+    """
+    addresses = Address.__table__
+    max_id = db.engine.execute(select([func.max(staging.c.id)])).scalar()
+    inserted = 0
+    updated = 0
+    for low in range(0, max_id or 0, batch_size):
+        in_batch = and_(staging.c.id > low, staging.c.id <= low + batch_size)
+
+        # update the balances that have changed
+        balance = select([staging.c.crowdsale_balance]).\
+            where(staging.c.address == addresses.c.address).\
+            as_scalar()
+        s = addresses.update().\
+            where(and_(addresses.c.address.in_(
+                select([staging.c.address]).where(in_batch)),
+                or_(addresses.c.crowdsale_balance == None,  # NOQA
+                    addresses.c.crowdsale_balance != balance))).\
+            values(crowdsale_balance=balance)
+        updated += db.engine.execute(s).rowcount
+
+        # and insert the addresses we have not seen before
+        new = select([staging.c.address, staging.c.crowdsale_balance]).\
+            select_from(staging.outerjoin(
+                addresses, addresses.c.address == staging.c.address)).\
+            where(and_(in_batch, addresses.c.id == None))  # NOQA
+        s = addresses.insert().from_select(['address', 'crowdsale_balance'],
+                                           new)
+        inserted += db.engine.execute(s).rowcount
+
+        print('  {0} inserted, {1} updated so far'.format(inserted, updated))
+    return (inserted, updated)
+
+
+def remove_unlisted_addresses(staging, batch_size):
+    """Removes addresses that are not in the staging table, along with all
+    the tokens and contracts associated with them.
+
+    :returns: a tuple of (addresses, tokens, contracts) removed
+    """
+    addresses = Address.__table__
+    tokens = Token.__table__
+    contracts = Contract.__table__
+    removed = [0, 0, 0]
+    last_id = 0
+    while (1):
+        candidate_stmt = select([addresses.c.id]).\
+            select_from(addresses.outerjoin(
+                staging, staging.c.address == addresses.c.address)).\
+            where(and_(staging.c.id == None,  # NOQA
+                       addresses.c.id > last_id)).\
+            order_by(addresses.c.id).\
+            limit(batch_size)
+        ids = [r[0] for r in db.engine.execute(candidate_stmt).fetchall()]
+        if (len(ids) == 0):
+            break
+        last_id = ids[-1]
+        with db.engine.begin() as conn:
+            token_ids = select([tokens.c.id]).\
+                where(tokens.c.address_id.in_(ids))
+            removed[2] += conn.execute(contracts.delete().where(
+                contracts.c.token_id.in_(token_ids))).rowcount
+            removed[1] += conn.execute(tokens.delete().where(
+                tokens.c.address_id.in_(ids))).rowcount
+            removed[0] += conn.execute(addresses.delete().where(
+                addresses.c.id.in_(ids))).rowcount
+        print('  {0} addresses removed so far'.format(removed[0]))
+    return tuple(removed)
+
+
+def show_slow_queries(limit):
+    log = app.slow_queries
+    if (log is None):
+        log = SlowQueryLog(app.config['SLOW_QUERY_PATH'])
+    for s in log.statements(limit):
+        print('{0} slow, {1:.3f}s total, {2:.3f}s max: {3}'.format(
+            s['count'], s['total_time'], s['max_time'], s['fingerprint']))
+        print('  ' + ' '.join(s['statement'].split()))
+        print('  EXPLAIN: {0}'.format(s['explain']))
+        for q in log.recent(s['fingerprint'], 3):
+            print('  {0} {1:.3f}s {2} {3}'.format(
+                datetime.utcfromtimestamp(q['time']).isoformat(),
+                q['duration'], q['route'], q['parameters']))
 
 
 def eval_args(args):
     if args.initdb:
         initdb()
     elif args.cleandb:
-        cleandb()
+        if (args.clean_interval is not None):
+            maintain_db(args.clean_interval, args.batch_size)
+        else:
+            cleandb(args.batch_size)
+    elif (args.summary_interval is not None):
+        maintain_summary(args.summary_interval)
     elif (args.whitelist is not None):
-        updatewhitelist(args.whitelist)
+        updatewhitelist(args.whitelist, args.batch_size,
+                        args.whitelist_min_ratio)
+    elif args.migrate_locations:
+        migrate_locations(args.batch_size)
     elif (args.generate_chunk is not None):
+        create_app()
         generate_chunks(args.generate_chunk)
     elif (args.maintain is not None):
+        create_app()
         print('Maintaining total size: {0}, min chunk size: {1}, max chunk size: {2}'.format(
             args.maintain[2],
             args.maintain[0],
             args.maintain[1]))
         maintain_capacity(int(args.maintain[0]), int(args.maintain[1]), int(args.maintain[2]))
+    elif (args.slow_queries is not None):
+        show_slow_queries(args.slow_queries)
+    elif (args.pregen_challenges is not None):
+        create_app()
+        print('Pre-generating challenges {0} seconds ahead.'.format(
+            args.pregen_challenges))
+        pregenerate_challenges(args.pregen_challenges, args.batch_size)
     else:
+        create_app()
         debug_root = Flask(__name__)
         debug_root.debug = True
         debug_root.add_url_rule('/','index',lambda: jsonify(msg='debugging'))
@@ -130,17 +495,42 @@ def eval_args(args):
 def parse_args():
     parser = argparse.ArgumentParser('downstream')
     parser.add_argument('--initdb', action='store_true')
-    parser.add_argument('--cleandb', action='store_true')
+    parser.add_argument('--cleandb', action='store_true', help='Removes '
+        'cached contracts, unreferenced files and orphaned tags in batches.')
+    parser.add_argument('--batch-size', help='Maximum number of rows '
+        'per statement for --cleandb, --whitelist, --pregen-challenges and '
+        '--migrate-locations',
+        type=int, default=1000)
+    parser.add_argument('--clean-interval', help='Keep running --cleandb '
+        'every specified number of seconds', type=int)
+    parser.add_argument('--summary-interval', help='Keep bringing the '
+        'farmer uptime summary of the status views up to date every '
+        'specified number of seconds', type=int)
     parser.add_argument('--whitelist', help='updates the white list '
         'in the db and exits from a whitelist csv file.  each row except'
         'the first should be in the format\n'
         '"address","crowdsale_balance",...\n'
         'and the first row will be skipped.')
+    parser.add_argument('--whitelist-min-ratio', help='Refuse a --whitelist '
+        'with fewer than this fraction of the addresses currently listed, '
+        'since it would remove the rest.  0 accepts any whitelist that is '
+        'not empty', type=float, default=0.5)
     parser.add_argument('--generate-chunk', help='Generates a test chunk of'
         'specified size.', type=int)
     parser.add_argument('--maintain', help='Maintain available chunk capacity'
         'Specify three values (min chunk size, max chunk size, total pre-gen '
         'size)', nargs=3)
+    parser.add_argument('--pregen-challenges', help='Keep generating the '
+        'next challenge for contracts that will be due within the specified '
+        'number of seconds, so that requests only have to swap it in',
+        type=int)
+    parser.add_argument('--migrate-locations', action='store_true',
+        help='Copies the pickled tokens.location of a database created '
+        'before the location columns into them')
+    parser.add_argument('--slow-queries', help='Shows the specified number '
+        'of statements in the slow query log with the most total time, '
+        'their EXPLAIN output and their most recent occurrences',
+        type=int, nargs='?', const=20)
     return parser.parse_args()
 
 
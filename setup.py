@@ -9,6 +9,7 @@ install_requires = [
     'flask',
     'pymysql',
     'flask-sqlalchemy',
+    'sqlalchemy>=1.2',
     'RandomIO',
     'storj-heartbeat',
     'base58',
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Microbenchmarks for the core algorithms of the node, each run at several
+# scales.
+#
+#     python tests/benchmark.py --output results.json
+#     python tests/benchmark.py --save-baseline tests/baseline.json
+#     python tests/benchmark.py --baseline tests/baseline.json \
+#         --max-regression 0.2
+#
+# With --baseline, the run fails (exit status 1) if the median time of any
+# benchmark at any scale is more than --max-regression slower than the
+# baseline.  Baselines are only comparable on the same machine.
+#
+# The database benchmarks use --database, which is reset.
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import binascii
+import subprocess
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from downstream_node.startup import app, db, create_app  # NOQA
+from downstream_node import models, node  # NOQA
+from downstream_node.uptime import UptimeCalculator, UptimeSummary  # NOQA
+from downstream_node.utils import Distribution, MonopolyDistribution  # NOQA
+from downstream_node.types import MutableTypeWrapper  # NOQA
+
+# (name, function, scales).  the function takes a scale and returns a
+# (run, reset) pair.  run is timed, reset is called untimed before each run
+benchmarks = list()
+
+
+def benchmark(name, scales):
+    def register(f):
+        benchmarks.append((name, f, scales))
+        return f
+    return register
+
+
+class FakeContract(object):
+    def __init__(self, id, start, expiration):
+        self.id = id
+        self.start = start
+        self.expiration = expiration
+
+
+@benchmark('uptime_calculator_update', [100, 1000, 10000])
+def bench_uptime_calculator_update(n):
+    rng = random.Random(n)
+    now = datetime.utcnow()
+    contracts = list()
+    for i in range(0, n):
+        start = now - timedelta(seconds=rng.randint(0, 86400))
+        contracts.append(FakeContract(
+            i, start, start + timedelta(seconds=rng.randint(60, 86400))))
+
+    def run():
+        UptimeCalculator(contracts, UptimeSummary()).update()
+    return (run, None)
+
+
+@benchmark('update_uptime_summary', [100, 1000, 10000])
+def bench_update_uptime_summary(n):
+    reset_database()
+    tokens = models.Token.__table__
+    files = models.File.__table__
+    contracts = models.Contract.__table__
+    rng = random.Random(n)
+    now = datetime.utcnow()
+    token_count = max(n // 10, 1)
+    db.engine.execute(files.insert(), [dict(
+        id=1, hash='benchmark', redundancy=1, interval=60, added=now)])
+    db.engine.execute(tokens.insert(), [dict(
+        id=i + 1, token='token{0}'.format(i), ip_address='127.0.0.1',
+        farmer_id='farmer{0}'.format(i), hbcount=0,
+        upsum=timedelta(seconds=0)) for i in range(0, token_count)])
+    db.engine.execute(contracts.insert(), [dict(
+        token_id=i % token_count + 1, file_id=1, state=dict(),
+        start=now - timedelta(seconds=rng.randint(0, 86400)),
+        due=now - timedelta(seconds=rng.randint(-60, 86400)),
+        answered=True, cached=False) for i in range(0, n)])
+
+    def reset():
+        db.engine.execute(contracts.update().values(cached=False))
+        db.engine.execute(tokens.update().values(
+            start=None, end=None, upsum=timedelta(seconds=0)))
+
+    return (models.update_uptime_summary, reset)
+
+
+@benchmark('monopoly_distribution', [10 ** 6, 10 ** 8, 10 ** 10])
+def bench_monopoly_distribution(total):
+    def run():
+        MonopolyDistribution(1024, 2 ** 30, total, 2)
+    return (run, None)
+
+
+def chunk_distribution(n):
+    return Distribution(from_counts=dict(
+        (2 ** i, n) for i in range(10, 30)))
+
+
+@benchmark('distribution_subtract', [10, 1000, 100000])
+def bench_distribution_subtract(n):
+    a = chunk_distribution(n)
+    b = chunk_distribution(n // 2)
+
+    def run():
+        a.subtract(b)
+    return (run, None)
+
+
+@benchmark('distribution_get_list', [10, 1000, 100000])
+def bench_distribution_get_list(n):
+    a = chunk_distribution(n)
+    return (a.get_list, None)
+
+
+@benchmark('mutable_type_wrapper_call', [10, 100, 1000])
+def bench_mutable_type_wrapper_call(n):
+    # a method call on a wrapped object pickles it twice, so the cost grows
+    # with the size of the object, like a heartbeat state
+    wrapper = MutableTypeWrapper(dict(
+        ('key{0}'.format(i), os.urandom(32)) for i in range(0, n)))
+
+    def run():
+        for i in range(0, 100):
+            wrapper.get('key0')
+    return (run, None)
+
+
+@benchmark('add_file_prepare_contract', [1000, 100000, 1000000])
+def bench_add_file_prepare_contract(size):
+    reset_database()
+    if (not os.path.isdir(app.config['TAGS_PATH'])):
+        os.makedirs(app.config['TAGS_PATH'])
+    tag_paths = list()
+
+    def run():
+        seed = binascii.hexlify(os.urandom(16)).decode()
+        db_file = node.add_file(seed, size, 1)
+        tag_paths.append(node.prepare_contract(db_file).tag_path)
+
+    def reset():
+        while (len(tag_paths) > 0):
+            os.remove(tag_paths.pop())
+
+    return (run, reset)
+
+
+def reset_database():
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+
+def measure(run, reset, repeat):
+    times = list()
+    for i in range(0, repeat):
+        if (reset is not None):
+            reset()
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+    if (reset is not None):
+        reset()
+    times.sort()
+    return dict(min=times[0],
+                median=times[len(times) // 2],
+                repeat=repeat)
+
+
+def run_benchmarks(args):
+    results = dict()
+    for (name, f, scales) in benchmarks:
+        if (args.filter is not None and args.filter not in name):
+            continue
+        if (args.quick):
+            scales = scales[:1]
+        results[name] = dict()
+        for scale in scales:
+            try:
+                (run, reset) = f(scale)
+                result = measure(run, reset, args.repeat)
+            except Exception as ex:
+                result = dict(error='{0}: {1}'.format(type(ex).__name__, ex))
+                db.session.rollback()
+            results[name][str(scale)] = result
+            if ('error' in result):
+                print('{0:<28} {1:>12}   {2}'.format(
+                    name, scale, result['error'][:60]))
+            else:
+                print('{0:<28} {1:>12} {2:>12.6f} {3:>12.6f}'.format(
+                    name, scale, result['median'], result['min']))
+    return results
+
+
+def compare(results, baseline, max_regression):
+    """Returns a list of (name, scale, ratio) for the benchmarks that
+    regressed against baseline by more than max_regression.  The ratio is
+    None for benchmarks that ran in the baseline but failed now.
+    """
+    regressions = list()
+    for (name, scales) in results.items():
+        for (scale, result) in scales.items():
+            base = baseline.get(name, dict()).get(scale)
+            if (base is None or 'median' not in base or base['median'] <= 0):
+                continue
+            if ('error' in result):
+                regressions.append((name, scale, None))
+                continue
+            ratio = result['median'] / base['median']
+            if (ratio > 1 + max_regression):
+                regressions.append((name, scale, ratio))
+    return regressions
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='times to run each benchmark at each scale')
+    parser.add_argument('--filter', help='only run benchmarks whose name '
+                        'contains this')
+    parser.add_argument('--quick', action='store_true',
+                        help='only run the smallest scale')
+    parser.add_argument('--database', default='sqlite:///benchmark.db',
+                        help='database to reset and run the database '
+                        'benchmarks against')
+    parser.add_argument('--output', help='write the results as json')
+    parser.add_argument('--baseline', help='compare against the results in '
+                        'this json file')
+    parser.add_argument('--save-baseline', help='write the results as a '
+                        'baseline to this json file')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='fraction slower than the baseline that fails '
+                        'the run')
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    create_app()
+
+    print('{0:<28} {1:>12} {2:>12} {3:>12}'.format(
+        'benchmark', 'scale', 'median s', 'min s'))
+    results = run_benchmarks(args)
+
+    report = dict(commit=current_commit(),
+                  python=platform.python_version(),
+                  platform=platform.platform(),
+                  time=datetime.utcnow().isoformat(),
+                  results=results)
+
+    for path in [args.output, args.save_baseline]:
+        if (path is not None):
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    if (args.baseline is not None):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'],
+                              args.max_regression)
+        for (name, scale, ratio) in regressions:
+            if (ratio is None):
+                print('REGRESSION {0} at {1}: failed, but ran in the '
+                      'baseline ({2})'.format(name, scale, baseline['commit']))
+            else:
+                print('REGRESSION {0} at {1}: {2:.2f}x the baseline '
+                      '({3})'.format(name, scale, ratio, baseline['commit']))
+        if (len(regressions) > 0):
+            sys.exit(1)
+        print('No regressions against {0}'.format(baseline['commit']))
+
+
+if __name__ == '__main__':
+    main()
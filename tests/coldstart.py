@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Measures the cold start of the node: how long a fresh process takes to
+# import downstream_node.startup, to load the app with create_app, and to
+# serve its first request, and how much memory it then holds.
+#
+#     python tests/coldstart.py --repeat 10 --output results.json
+#
+# Run it from the directory the node is normally run from, since the
+# heartbeat and GeoIP database paths in the config are relative.  Commits
+# from before create_app existed loaded everything on import, so they can be
+# measured too.
+
+import os
+import sys
+import json
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+CHILD = """
+import sys
+import json
+import time
+import resource
+start = time.time()
+sys.path.insert(0, {root!r})
+from downstream_node import startup
+imported = time.time()
+create_app = getattr(startup, 'create_app', None)
+app = create_app() if create_app is not None else startup.app
+created = time.time()
+app.test_client().get('/')
+served = time.time()
+print(json.dumps(dict(
+    import_time=imported - start,
+    create_time=created - imported,
+    first_request_time=served - created,
+    total_time=served - start,
+    max_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)))
+"""
+
+PHASES = ['import_time', 'create_time', 'first_request_time', 'total_time',
+          'max_rss']
+
+
+def measure_once():
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD.format(root=ROOT)])
+    # the last line, in case the app printed anything while loading
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser('coldstart')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of processes to start')
+    parser.add_argument('--output', help='write the results as json')
+    args = parser.parse_args()
+
+    runs = [measure_once() for i in range(0, args.repeat)]
+    results = dict((p, median([r[p] for r in runs])) for p in PHASES)
+
+    for p in PHASES[:-1]:
+        print('{0:<20} {1:>10.1f} ms'.format(p, results[p] * 1000))
+    print('{0:<20} {1:>10} KB'.format('max_rss', results['max_rss']))
+
+    if (args.output is not None):
+        report = dict(commit=current_commit(),
+                      python=platform.python_version(),
+                      platform=platform.platform(),
+                      time=datetime.utcnow().isoformat(),
+                      repeat=args.repeat,
+                      results=results)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Simulates farmers against the node and reports throughput and latency per
+# route.  Each farmer gets a token with /new/, a chunk with /chunk/, and then
+# answers its challenges with real proofs, asking /challenge/ for the next
+# one each time the current one falls due.
+#
+# By default the app is run in process against a fresh SQLite database:
+#
+#     python tests/loadtest.py --farmers 20 --duration 60
+#
+# --database may instead point at a MySQL stand in, which is reset too.
+# To load a running node, whitelist the farmer addresses first (the node
+# should have REQUIRE_SIGNATURE off, a high MAX_TOKENS_PER_IP and chunks
+# generated with runapp.py --maintain):
+#
+#     python tests/loadtest.py --farmers 20 --write-whitelist farmers.csv
+#     python runapp.py --whitelist farmers.csv
+#     python tests/loadtest.py --farmers 20 \
+#         --url http://localhost:5000/api/downstream/v1
+#
+# Runs with the same --farmers, --duration, --seed and --size are comparable.
+# --poll has the farmers poll /challenge/ on a fixed interval like a naive
+# client, and --wait has them long poll it instead.  --since has them pass
+# the cursor of their last /challenge/ response, so only the contracts that
+# changed are sent back.  The bytes received per route are reported too.
+# --output writes the results as json, along with the commit they were
+# measured at.
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import binascii
+import threading
+import subprocess
+
+import base58
+from RandomIO import RandomIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from downstream_node.startup import app, db, create_app  # NOQA
+from downstream_node import models, node  # NOQA
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError
+
+ROUTES = ['/new/', '/chunk/', '/challenge/', '/answer/']
+
+
+def farmer_address(seed, i):
+    """Returns a deterministic bitcoin style address for farmer i"""
+    h = hashlib.sha256('{0}:{1}'.format(seed, i).encode('utf-8')).digest()
+    address = base58.b58encode_check(b'\x00' + h[:20])
+    if (isinstance(address, bytes)):
+        address = address.decode('ascii')
+    return address
+
+
+class LocalClient(object):
+
+    """Makes requests to the app in process"""
+
+    def __init__(self, remote_addr):
+        self.client = app.test_client()
+        self.environ = {'REMOTE_ADDR': remote_addr}
+
+    def request(self, method, path, data=None):
+        if (data is not None):
+            r = self.client.open(path, method=method,
+                                 data=json.dumps(data),
+                                 content_type='application/json',
+                                 environ_base=self.environ)
+        else:
+            r = self.client.open(path, method=method,
+                                 environ_base=self.environ)
+        return (r.status_code, r.data)
+
+
+class HttpClient(object):
+
+    """Makes requests to a running node"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def request(self, method, path, data=None):
+        body = None
+        headers = dict()
+        if (data is not None):
+            body = json.dumps(data).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        r = Request(self.url + path, body, headers)
+        r.get_method = lambda: method
+        try:
+            response = urlopen(r)
+            return (response.getcode(), response.read())
+        except HTTPError as ex:
+            return (ex.code, ex.read())
+
+
+class Results(object):
+
+    """Collects the latency of each request per route"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = dict((r, list()) for r in ROUTES)
+        self.errors = dict((r, 0) for r in ROUTES)
+        self.bytes = dict((r, 0) for r in ROUTES)
+
+    def add(self, route, elapsed, ok, size):
+        with self.lock:
+            self.latencies[route].append(elapsed)
+            self.bytes[route] += size
+            if (not ok):
+                self.errors[route] += 1
+
+    def summary(self, duration):
+        routes = dict()
+        for route in ROUTES:
+            latencies = sorted(self.latencies[route])
+            n = len(latencies)
+            routes[route] = dict(
+                requests=n,
+                errors=self.errors[route],
+                bytes=self.bytes[route],
+                throughput=n / duration,
+                mean=sum(latencies) / n if n > 0 else None,
+                p50=latencies[int(0.50 * (n - 1))] if n > 0 else None,
+                p99=latencies[int(0.99 * (n - 1))] if n > 0 else None)
+        total = sum(r['requests'] for r in routes.values())
+        return dict(routes=routes,
+                    requests=total,
+                    errors=sum(r['errors'] for r in routes.values()),
+                    bytes=sum(r['bytes'] for r in routes.values()),
+                    throughput=total / duration)
+
+
+class Farmer(threading.Thread):
+
+    """Behaves like a farmer running the downstream client"""
+
+    def __init__(self, client, address, size, deadline, results, poll=None,
+                 wait=None, since=False):
+        """
+        :param poll: poll /challenge/ every this many seconds, like a client
+            that does not keep track of when its challenges are due
+        :param wait: long poll /challenge/ with this wait instead
+        :param since: only ask /challenge/ for the contracts that changed
+            since the last response
+        """
+        threading.Thread.__init__(self)
+        self.poll = poll
+        self.wait = wait
+        self.since = since
+        self.cursor = None
+        self.daemon = True
+        self.client = client
+        self.address = address
+        self.size = size
+        self.deadline = deadline
+        self.results = results
+        self.beat = None
+        self.token = None
+        # file hash -> chunk dict, with a 'data' member holding its contents
+        self.chunks = dict()
+        self.error = None
+
+    def call(self, route, method, path, data=None):
+        start = time.time()
+        (status, body) = self.client.request(method, path, data)
+        elapsed = time.time() - start
+        response = None
+        if (status == 200):
+            response = json.loads(body.decode('utf-8'))
+        ok = response is not None and not any(
+            'error' in r for r in response.get('report', []) +
+            response.get('challenges', []))
+        self.results.add(route, elapsed, ok, len(body))
+        return response
+
+    def prove(self, chunk):
+        chal = self.beat.challenge_type().fromdict(chunk['challenge'])
+        tag = self.beat.tag_type().fromdict(chunk['tag'])
+        proof = self.beat.prove(io.BytesIO(chunk['data']), chal, tag)
+        return dict(file_hash=chunk['file_hash'], proof=proof.todict())
+
+    def answer(self, chunks):
+        self.call('/answer/', 'POST', '/answer/{0}'.format(self.token),
+                  dict(proofs=[self.prove(c) for c in chunks]))
+        now = time.time()
+        for c in chunks:
+            c['due_at'] = now + c['due']
+
+    def setup(self):
+        r = self.call('/new/', 'GET', '/new/{0}'.format(self.address))
+        if (r is None):
+            raise RuntimeError('Unable to get a token')
+        self.token = r['token']
+        self.beat = app.config['HEARTBEAT'].fromdict(r['heartbeat'])
+
+        # concurrent farmers can race for the same pregenerated chunk, so
+        # retry like the client does.  the failures are still counted
+        for attempt in range(0, 5):
+            r = self.call('/chunk/', 'GET',
+                          '/chunk/{0}/{1}'.format(self.token, self.size))
+            if (r is not None and len(r['chunks']) > 0):
+                break
+            time.sleep(random.random())
+        else:
+            raise RuntimeError('Unable to get a chunk')
+        for c in r['chunks']:
+            c['data'] = RandomIO(c['seed']).read(c['size'])
+            self.chunks[c['file_hash']] = c
+        self.answer(list(self.chunks.values()))
+
+    def cycle(self):
+        args = list()
+        remaining = max(self.deadline - time.time(), 0)
+        if (self.since and self.cursor is not None):
+            args.append('since={0}'.format(self.cursor))
+        if (self.wait is not None):
+            # the node holds the request until a challenge is due
+            args.append('wait={0:.3f}'.format(min(self.wait, remaining)))
+        else:
+            if (self.poll is not None):
+                wait = self.poll
+            else:
+                wait = min(c['due_at'] for c in self.chunks.values()) - \
+                    time.time()
+            if (wait > 0):
+                time.sleep(min(wait, remaining))
+        if (time.time() >= self.deadline):
+            return
+        path = '/challenge/{0}'.format(self.token)
+        if (len(args) > 0):
+            path += '?' + '&'.join(args)
+        r = self.call('/challenge/', 'POST', path,
+                      dict(hashes=list(self.chunks.keys())))
+        if (r is None):
+            return
+        self.cursor = r.get('cursor')
+        fresh = list()
+        for c in r['challenges']:
+            if ('challenge' not in c):
+                # expired or out of challenges
+                self.chunks.pop(c['file_hash'], None)
+                continue
+            chunk = self.chunks[c['file_hash']]
+            chunk['due'] = c['due']
+            chunk['due_at'] = time.time() + c['due']
+            if (not c['answered']):
+                chunk['challenge'] = c['challenge']
+                fresh.append(chunk)
+        if (len(fresh) > 0):
+            self.answer(fresh)
+
+    def run(self):
+        try:
+            self.setup()
+            while (time.time() < self.deadline and len(self.chunks) > 0):
+                self.cycle()
+        except Exception as ex:
+            self.error = ex
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def prepare_local(args, addresses):
+    """Resets the database and adds a whitelisted address and a chunk for
+    each farmer
+    """
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    app.config['REQUIRE_SIGNATURE'] = False
+    app.config['MAX_TOKENS_PER_IP'] = args.farmers + 1
+    # each local farmer is a thread of its own, so it may block in a wait
+    app.config['CHALLENGE_WAIT_BLOCKING'] = True
+    create_app()
+    if (not os.path.isdir(app.config['TAGS_PATH'])):
+        os.makedirs(app.config['TAGS_PATH'])
+    db.drop_all()
+    db.create_all()
+    rng = random.Random(args.seed)
+    for address in addresses:
+        db.session.add(models.Address(
+            address=address,
+            crowdsale_balance=app.config['MIN_SJCX_BALANCE']))
+    db.session.commit()
+    print('Preparing {0} chunks...'.format(len(addresses)))
+    for i in range(0, len(addresses)):
+        seed = binascii.hexlify(
+            bytearray(rng.getrandbits(8) for j in range(0, 16))).decode()
+        db_file = node.add_file(seed, args.size, 1, args.interval)
+        node.prepare_contract(db_file)
+
+
+def main():
+    parser = argparse.ArgumentParser('loadtest')
+    parser.add_argument('--farmers', type=int, default=10,
+                        help='number of concurrent farmers')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to run for')
+    parser.add_argument('--size', type=int, default=1000,
+                        help='chunk size')
+    parser.add_argument('--interval', type=int, default=5,
+                        help='challenge interval of the chunks created for '
+                        'an in process run')
+    parser.add_argument('--seed', default='loadtest',
+                        help='seed for the farmer addresses and chunks')
+    parser.add_argument('--database', default='sqlite:///loadtest.db',
+                        help='database to reset and run in process against')
+    parser.add_argument('--url', help='load a running node at this url '
+                        'instead of running in process')
+    parser.add_argument('--write-whitelist', help='write a whitelist csv of '
+                        'the farmer addresses for runapp.py --whitelist, '
+                        'and exit')
+    parser.add_argument('--poll', type=float, help='have farmers poll '
+                        '/challenge/ every specified number of seconds '
+                        'rather than when their challenges are due')
+    parser.add_argument('--wait', type=float, help='have farmers long poll '
+                        '/challenge/ with the specified wait rather than '
+                        'keep track of when their challenges are due')
+    parser.add_argument('--since', action='store_true', help='have farmers '
+                        'only ask /challenge/ for the contracts that changed '
+                        'since their last poll')
+    parser.add_argument('--output', help='write the results as json')
+    args = parser.parse_args()
+
+    addresses = [farmer_address(args.seed, i) for i in range(0, args.farmers)]
+
+    if (args.write_whitelist is not None):
+        with open(args.write_whitelist, 'w') as f:
+            f.write('"address","crowdsale_balance"\n')
+            for address in addresses:
+                f.write('"{0}","{1}"\n'.format(
+                    address, app.config['MIN_SJCX_BALANCE']))
+        return
+
+    if (args.url is None):
+        prepare_local(args, addresses)
+
+    results = Results()
+    start = time.time()
+    deadline = start + args.duration
+    farmers = list()
+    for i in range(0, args.farmers):
+        if (args.url is None):
+            client = LocalClient('10.0.{0}.{1}'.format(i // 250, i % 250 + 1))
+        else:
+            client = HttpClient(args.url)
+        farmers.append(Farmer(client, addresses[i], args.size, deadline,
+                              results, args.poll, args.wait, args.since))
+    for f in farmers:
+        f.start()
+    for f in farmers:
+        f.join()
+    elapsed = time.time() - start
+
+    summary = results.summary(elapsed)
+    summary.update(commit=current_commit(),
+                   farmers=args.farmers,
+                   duration=elapsed,
+                   size=args.size,
+                   seed=args.seed,
+                   poll=args.poll,
+                   wait=args.wait,
+                   since=args.since,
+                   target=args.url or args.database,
+                   failed_farmers=sum(1 for f in farmers
+                                      if f.error is not None))
+
+    print('{0:<12} {1:>8} {2:>7} {3:>9} {4:>9} {5:>9} {6:>9}'.format(
+        'route', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms', 'KB'))
+    for route in ROUTES:
+        r = summary['routes'][route]
+        print('{0:<12} {1:>8} {2:>7} {3:>9.2f} {4:>9} {5:>9} {6:>9.1f}'.format(
+            route, r['requests'], r['errors'], r['throughput'],
+            '-' if r['p50'] is None else '{0:.1f}'.format(r['p50'] * 1000),
+            '-' if r['p99'] is None else '{0:.1f}'.format(r['p99'] * 1000),
+            r['bytes'] / 1024.0))
+    print('{0} requests, {1:.2f} req/s, {2} errors, {3} farmers failed'.format(
+        summary['requests'], summary['throughput'], summary['errors'],
+        summary['failed_farmers']))
+    for f in farmers:
+        if (f.error is not None):
+            print('  {0}: {1}'.format(f.address, f.error))
+            break
+
+    if (args.output is not None):
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,8 @@ import datetime
 from RandomIO import RandomIO
 
 from mock import patch
-from downstream_node.startup import app, db
+from downstream_node.startup import app, db, create_app
+create_app()
 from downstream_node import models
 from downstream_node import node
 from downstream_node import config
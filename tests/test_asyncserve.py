@@ -0,0 +1,207 @@
+import json
+import unittest
+
+import mock
+from flask import Flask, request, jsonify, stream_with_context
+
+try:
+    import asyncio
+    from downstream_node import asyncserve
+except (ImportError, SyntaxError):
+    # python 2, or python 3 before async def
+    asyncserve = None
+
+
+@unittest.skipIf(asyncserve is None, 'asyncio unavailable')
+class TestAsgiApp(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(asyncserve.__name__)
+        self.app.config['APPLICATION_ROOT'] = '/api'
+        self.app.mongo_logger = None
+        self.app.heartbeat_pool = None
+
+        @self.app.route('/echo', methods=['GET', 'POST'])
+        def echo():
+            return jsonify(args=request.args.to_dict(),
+                           data=request.get_data().decode('utf-8'),
+                           remote_addr=request.remote_addr,
+                           agent=request.headers.get('User-Agent'))
+
+        @self.app.route('/challenge/<token>', methods=['GET', 'POST'])
+        def challenge(token):
+            return jsonify(token=token, args=request.args.to_dict())
+
+        @self.app.route('/stream')
+        def stream():
+            return self.app.response_class(
+                (str(i) for i in range(0, 3)), mimetype='text/plain')
+
+        @self.app.route('/stream/context')
+        def stream_context():
+            def generate():
+                # every chunk needs the request
+                for i in range(0, 3):
+                    yield request.args['a']
+            return self.app.response_class(stream_with_context(generate()))
+
+        @self.app.route('/stream/error')
+        def stream_error():
+            def generate():
+                yield 'a'
+                raise ValueError('test')
+            return self.app.response_class(generate())
+
+        self.asgi = asyncserve.AsgiApp(self.app, 2)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.asgi.executor.shutdown()
+        self.loop.close()
+
+    def resolved(self, value):
+        future = self.loop.create_future()
+        future.set_result(value)
+        return future
+
+    def call(self, scope, messages):
+        messages = list(messages)
+        sent = list()
+
+        def receive():
+            return self.resolved(messages.pop(0))
+
+        def send(message):
+            sent.append(message)
+            return self.resolved(None)
+
+        self.loop.run_until_complete(self.asgi(scope, receive, send))
+        return sent
+
+    def request(self, path, method='GET', query=b'', bodies=(b'',)):
+        scope = {'type': 'http',
+                 'method': method,
+                 'path': path,
+                 'query_string': query,
+                 'headers': [(b'user-agent', b'test'),
+                             (b'content-type', b'application/json')],
+                 'client': ('10.0.0.1', 1234),
+                 'server': ('localhost', 80)}
+        messages = [{'type': 'http.request', 'body': b, 'more_body': True}
+                    for b in bodies[:-1]]
+        messages.append({'type': 'http.request', 'body': bodies[-1]})
+        sent = self.call(scope, messages)
+        self.assertEqual(sent[0]['type'], 'http.response.start')
+        self.assertEqual(sent[-1], {'type': 'http.response.body'})
+        body = b''.join(m.get('body', b'') for m in sent[1:])
+        return (sent[0]['status'], dict(sent[0]['headers']), body)
+
+    def test_request(self):
+        (status, headers, body) = self.request(
+            '/api/echo', 'POST', b'a=1', [b'{"he', b'llo": 1}'])
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'content-type'], b'application/json')
+        self.assertEqual(json.loads(body.decode('utf-8')),
+                         {'args': {'a': '1'},
+                          'data': '{"hello": 1}',
+                          'remote_addr': '10.0.0.1',
+                          'agent': 'test'})
+
+    def test_not_found(self):
+        (status, headers, body) = self.request('/echo')
+
+        self.assertEqual(status, 404)
+
+    def test_streamed_response(self):
+        (status, headers, body) = self.request('/api/stream')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'012')
+
+    def test_streamed_with_context(self):
+        with mock.patch.object(asyncserve, 'RESPONSE_BUFFER', 1):
+            (status, headers, body) = self.request('/api/stream/context',
+                                                   query=b'a=x')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'xxx')
+
+    def test_streamed_error(self):
+        with self.assertRaises(ValueError):
+            self.request('/api/stream/error')
+
+    def test_disconnect_while_streaming(self):
+        scope = {'type': 'http', 'method': 'GET', 'path': '/api/stream',
+                 'query_string': b''}
+        messages = [{'type': 'http.request', 'body': b''}]
+
+        def receive():
+            return self.resolved(messages.pop(0))
+
+        def send(message):
+            if (message.get('more_body', False)):
+                raise IOError('disconnected')
+            return self.resolved(None)
+
+        with self.assertRaises(IOError):
+            self.loop.run_until_complete(self.asgi(scope, receive, send))
+
+    def test_disconnect(self):
+        scope = {'type': 'http', 'method': 'POST', 'path': '/api/echo',
+                 'query_string': b''}
+        sent = self.call(scope, [{'type': 'http.request', 'body': b'{',
+                                  'more_body': True},
+                                 {'type': 'http.disconnect'}])
+
+        self.assertEqual(sent, [])
+
+    def test_long_poll(self):
+        with mock.patch.object(self.asgi, 'challenge_delay') as delay:
+            delay.return_value = 0.01
+            (status, headers, body) = self.request(
+                '/api/challenge/token', 'POST', b'wait=30&since=1-2',
+                [b'{"hashes": ["a"]}'])
+
+        delay.assert_called_once_with('token', ['a'], 30.0)
+        r_json = json.loads(body.decode('utf-8'))
+        # the route does not wait again
+        self.assertEqual(r_json['args'], {'since': '1-2'})
+
+    def test_long_poll_left_to_route(self):
+        with mock.patch.object(self.asgi, 'challenge_delay') as delay:
+            for query in [b'wait=-1', b'wait=x', b'await=1']:
+                (status, headers, body) = self.request(
+                    '/api/challenge/token', query=query)
+                r_json = json.loads(body.decode('utf-8'))
+                self.assertEqual(len(r_json['args']), 1)
+            (status, headers, body) = self.request(
+                '/api/challenge/token', 'POST', b'wait=1', [b'invalid'])
+
+        self.assertFalse(delay.called)
+
+    def test_lifespan(self):
+        sent = self.call({'type': 'lifespan'},
+                         [{'type': 'lifespan.startup'},
+                          {'type': 'lifespan.shutdown'}])
+
+        self.assertEqual(sent, [{'type': 'lifespan.startup.complete'},
+                                {'type': 'lifespan.shutdown.complete'}])
+
+
+@unittest.skipIf(asyncserve is None, 'asyncio unavailable')
+class TestQueuedLogger(unittest.TestCase):
+    def test_log_event(self):
+        logger = mock.MagicMock()
+        queued = asyncserve.QueuedLogger(logger)
+
+        queued.log_event('challenge', {'token': 'a'})
+        queued.log_exception(ValueError('test'), {'token': 'b'})
+        queued.shutdown()
+
+        self.assertEqual(logger.log_event.call_args_list, [
+            mock.call('challenge', {'token': 'a'}),
+            mock.call('exception', {'type': 'ValueError',
+                                    'value': 'test',
+                                    'context': {'token': 'b'}})])
+        self.assertIs(queued.db, logger.db)
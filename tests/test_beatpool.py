@@ -0,0 +1,57 @@
+import io
+import os
+import pickle
+import sys
+import unittest
+
+from heartbeat import Merkle
+from RandomIO import RandomIO
+
+try:
+    from downstream_node import beatpool
+except ImportError:
+    # python 2
+    beatpool = None
+
+
+# the pool initializes its workers, which needs python 3.7
+@unittest.skipIf(beatpool is None or sys.version_info < (3, 7),
+                 'process pool initializer unavailable')
+class TestHeartbeatPool(unittest.TestCase):
+    def setUp(self):
+        self.beat = Merkle.Merkle()
+        self.data = RandomIO('seed').read(1000)
+        (self.tag, self.state) = self.beat.encode(io.BytesIO(self.data))
+        self.pool = beatpool.HeartbeatPool(self.beat, 2)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_gen_challenge_and_verify(self):
+        original = pickle.dumps(self.state)
+
+        (chal, state) = self.pool.gen_challenge(self.state)
+
+        # the state passed in is left as it is
+        self.assertEqual(pickle.dumps(self.state), original)
+        self.assertNotEqual(pickle.dumps(state), original)
+
+        proof = self.beat.prove(io.BytesIO(self.data), chal, self.tag)
+        self.assertTrue(self.pool.verify(proof, chal, state))
+
+        (other, state) = self.pool.gen_challenge(state)
+        self.assertFalse(self.pool.verify(proof, other, state))
+
+    def test_executor_per_process(self):
+        self.assertIsNone(self.pool.executor)
+
+        self.pool.gen_challenge(self.state)
+        executor = self.pool.executor
+        self.assertEqual(self.pool.executor_pid, os.getpid())
+
+        # as seen from a forked worker
+        self.pool.executor_pid = -1
+        self.pool.gen_challenge(self.state)
+        self.assertIsNot(self.pool.executor, executor)
+        self.assertEqual(self.pool.executor_pid, os.getpid())
+        executor.shutdown()
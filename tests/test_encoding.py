@@ -0,0 +1,174 @@
+import json
+import zlib
+import gzip
+import io
+import os
+import unittest
+from datetime import datetime
+
+import mock
+from flask import Flask
+
+from downstream_node import encoding
+
+
+class TestEncoding(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(encoding.__name__)
+        self.app.config['COMPRESS_MIN_SIZE'] = 100
+        self.app.config['COMPRESS_LEVEL'] = 6
+        self.app.config['MSGPACK'] = True
+        self.app.config['STREAM_JSON'] = True
+        self.done = mock.MagicMock()
+        self.obj = dict(chunks=[dict(tag='0' * 64, index=i)
+                                for i in range(0, 20)])
+
+        @self.app.route('/large')
+        def large():
+            response = encoding.respond(self.obj)
+            response.set_etag('tag')
+            return response
+
+        @self.app.route('/small')
+        def small():
+            return encoding.respond(dict(status='ok'))
+
+        @self.app.route('/missing')
+        def missing():
+            response = encoding.respond(self.obj)
+            response.status_code = 404
+            return response
+
+        @self.app.route('/stream')
+        def stream():
+            return self.app.response_class(('0' * 100 for i in range(0, 2)))
+
+        @self.app.route('/list')
+        def stream_list():
+            return encoding.respond_list(
+                'chunks', (c for c in self.obj['chunks']), self.done)
+
+        encoding.install(self.app)
+        self.client = self.app.test_client()
+
+    def get(self, path, **headers):
+        return self.client.get(path, headers=headers)
+
+    def test_gzip(self):
+        r = self.get('/large', **{'Accept-Encoding': 'gzip, deflate'})
+
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', r.headers['Vary'])
+        data = gzip.GzipFile(fileobj=io.BytesIO(r.data)).read()
+        self.assertEqual(json.loads(data.decode('utf-8')), self.obj)
+        self.assertLess(len(r.data), len(data))
+        self.assertEqual(r.headers['ETag'], 'W/"tag"')
+
+    def test_deflate(self):
+        r = self.get('/large', **{'Accept-Encoding': 'deflate'})
+
+        self.assertEqual(r.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(json.loads(zlib.decompress(r.data).decode('utf-8')),
+                         self.obj)
+
+    def test_not_compressed(self):
+        r = self.get('/large')
+        self.assertNotIn('Content-Encoding', r.headers)
+        self.assertEqual(json.loads(r.data.decode('utf-8')), self.obj)
+        self.assertEqual(r.headers['ETag'], '"tag"')
+
+        for path in ['/small', '/missing']:
+            r = self.get(path, **{'Accept-Encoding': 'gzip'})
+            self.assertNotIn('Content-Encoding', r.headers)
+
+        r = self.get('/large', **{'Accept-Encoding': 'br'})
+        self.assertNotIn('Content-Encoding', r.headers)
+
+    def test_json_by_default(self):
+        for accept in ['*/*', 'application/json',
+                       'application/json, application/x-msgpack;q=0.5']:
+            r = self.get('/small', Accept=accept)
+            self.assertEqual(r.mimetype, 'application/json')
+
+    @unittest.skipIf(encoding.msgpack is None, 'msgpack unavailable')
+    def test_msgpack(self):
+        r = self.get('/large', Accept='application/x-msgpack')
+
+        self.assertEqual(r.mimetype, 'application/x-msgpack')
+        self.assertIn('Accept', r.headers['Vary'])
+        self.assertEqual(encoding.msgpack.unpackb(r.data, raw=False),
+                         self.obj)
+
+        self.app.config['MSGPACK'] = False
+        r = self.get('/large', Accept='application/x-msgpack')
+        self.assertEqual(r.mimetype, 'application/json')
+
+    @unittest.skipIf(encoding.msgpack is None, 'msgpack unavailable')
+    def test_msgpack_datetime(self):
+        due = datetime(2015, 1, 2, 3, 4, 5)
+        self.obj = dict(due=due)
+
+        r = self.get('/large', Accept='application/x-msgpack')
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(encoding.msgpack.unpackb(r.data, raw=False),
+                         json.loads(self.get('/large').data.decode('utf-8')))
+
+    def test_streamed_gzip(self):
+        r = self.get('/stream', **{'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', r.headers)
+        data = gzip.GzipFile(fileobj=io.BytesIO(r.data)).read()
+        self.assertEqual(data, b'0' * 200)
+
+    def test_stream_json(self):
+        with mock.patch.object(encoding, 'STREAM_BUFFER_SIZE', 100):
+            r = self.get('/list')
+
+        self.assertEqual(r.mimetype, 'application/json')
+        self.assertIn('Accept', r.headers['Vary'])
+        self.assertEqual(json.loads(r.data.decode('utf-8')), self.obj)
+        self.done.assert_called_once_with()
+
+        r = self.get('/list', **{'Accept-Encoding': 'gzip'})
+        data = gzip.GzipFile(fileobj=io.BytesIO(r.data)).read()
+        self.assertEqual(json.loads(data.decode('utf-8')), self.obj)
+
+    def test_stream_json_empty(self):
+        with self.app.test_request_context():
+            response = encoding.stream_json('chunks', [])
+            data = b''.join(response.response)
+
+        self.assertEqual(json.loads(data.decode('utf-8')), dict(chunks=[]))
+
+    def test_stream_json_off(self):
+        self.app.config['STREAM_JSON'] = False
+        r = self.get('/list')
+
+        self.assertEqual(json.loads(r.data.decode('utf-8')), self.obj)
+        self.done.assert_called_once_with()
+
+    @unittest.skipIf(encoding.msgpack is None, 'msgpack unavailable')
+    def test_stream_json_msgpack(self):
+        r = self.get('/list', Accept='application/x-msgpack')
+
+        self.assertEqual(r.mimetype, 'application/x-msgpack')
+        self.assertEqual(encoding.msgpack.unpackb(r.data, raw=False),
+                         self.obj)
+
+    def test_compress_stream_closes(self):
+        closed = list()
+
+        def body():
+            try:
+                while (True):
+                    yield os.urandom(1000)
+            finally:
+                closed.append(True)
+
+        stream = encoding.compress_stream(body(), 'deflate', 6)
+        next(stream)
+        stream.close()
+
+        self.assertEqual(closed, [True])
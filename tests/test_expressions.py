@@ -0,0 +1,89 @@
+import unittest
+from datetime import datetime, timedelta
+
+from sqlalchemy import (create_engine, MetaData, Table, Column, Integer,
+                        DateTime, Interval, Boolean, select)
+from sqlalchemy.dialects import mysql, postgresql
+
+from downstream_node.expressions import (if_, timestamp_diff, timestamp_add,
+                                         interval_seconds)
+
+
+class TestExpressions(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.metadata = MetaData()
+        self.table = Table('t', self.metadata,
+                           Column('id', Integer, primary_key=True),
+                           Column('start', DateTime),
+                           Column('end', DateTime),
+                           Column('seconds', Integer),
+                           Column('span', Interval),
+                           Column('flag', Boolean))
+        self.metadata.create_all(self.engine)
+        self.start = datetime(2015, 1, 1, 12, 0, 0, 250000)
+        self.engine.execute(self.table.insert(), [
+            dict(id=1, start=self.start,
+                 end=self.start + timedelta(seconds=90, microseconds=900000),
+                 seconds=60, span=timedelta(seconds=3725), flag=True),
+            dict(id=2, start=self.start,
+                 end=self.start - timedelta(seconds=30),
+                 seconds=-30, span=timedelta(days=2), flag=False)])
+
+    def tearDown(self):
+        self.metadata.drop_all(self.engine)
+
+    def select(self, expression):
+        t = self.table
+        return [r[0] for r in self.engine.execute(
+            select([expression]).order_by(t.c.id)).fetchall()]
+
+    def test_timestamp_diff(self):
+        t = self.table
+        self.assertEqual(self.select(timestamp_diff(t.c.start, t.c.end)),
+                         [90, -30])
+
+    def test_timestamp_add(self):
+        t = self.table
+        self.assertEqual(self.select(timestamp_add(t.c.seconds, t.c.start)),
+                         [self.start + timedelta(seconds=60),
+                          self.start - timedelta(seconds=30)])
+
+    def test_timestamp_add_compares(self):
+        t = self.table
+        later = timestamp_add(t.c.seconds, t.c.start)
+        self.assertEqual(self.select(later > self.start), [True, False])
+        self.assertEqual(self.select(later > t.c.end), [False, False])
+
+    def test_interval_seconds(self):
+        t = self.table
+        self.assertEqual(self.select(interval_seconds(t.c.span)),
+                         [3725, 172800])
+
+    def test_if(self):
+        t = self.table
+        self.assertEqual(self.select(if_(t.c.flag, t.c.seconds, 0)),
+                         [60, 0])
+
+    def test_mysql(self):
+        t = self.table
+        s = str(timestamp_add(t.c.seconds, t.c.start).compile(
+            dialect=mysql.dialect()))
+        self.assertEqual(s, 'TIMESTAMPADD(SECOND, t.seconds, t.start)')
+        s = str(timestamp_diff(t.c.start, t.c.end).compile(
+            dialect=mysql.dialect()))
+        self.assertEqual(s, 'TIMESTAMPDIFF(SECOND, t.start, t.end)')
+        s = str(interval_seconds(t.c.span).compile(dialect=mysql.dialect()))
+        self.assertEqual(s, "TIMESTAMPDIFF(SECOND, '1970-01-01', t.span)")
+
+    def test_postgresql(self):
+        t = self.table
+        s = str(timestamp_add(t.c.seconds, t.c.start).compile(
+            dialect=postgresql.dialect()))
+        self.assertEqual(s, "(t.start + t.seconds * INTERVAL '1 second')")
+        s = str(timestamp_diff(t.c.start, t.c.end).compile(
+            dialect=postgresql.dialect()))
+        self.assertIn('EXTRACT(EPOCH FROM (t."end" - t.start))', s)
+        s = str(interval_seconds(t.c.span).compile(
+            dialect=postgresql.dialect()))
+        self.assertIn('EXTRACT(EPOCH FROM t.span)', s)
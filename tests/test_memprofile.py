@@ -0,0 +1,89 @@
+import os
+import unittest
+
+from flask import Flask
+
+from downstream_node import memprofile
+
+TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+@unittest.skipIf(memprofile.tracemalloc is None, 'tracemalloc unavailable')
+class TestMemoryProfiler(unittest.TestCase):
+    def setUp(self):
+        self.tracing = memprofile.tracemalloc.is_tracing()
+        self.profiler = memprofile.MemoryProfiler(5, 3, TESTS_PATH)
+        self.leak = list()
+        self.app = Flask(memprofile.__name__)
+        self.app.config['KEY'] = 'secret'
+
+        @self.app.route('/leak/<int:size>')
+        def leak(size):
+            self.allocate(size)
+            return 'ok'
+
+        @self.app.route('/key')
+        def key():
+            return str(memprofile.check_key(self.app.config['KEY']))
+
+        self.profiler.install(self.app)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        if (not self.tracing):
+            memprofile.tracemalloc.stop()
+
+    def allocate(self, size):
+        self.leak.append(bytearray(size))
+
+    def test_diff(self):
+        self.profiler.take_snapshot('*')
+        self.allocate(100000)
+        self.profiler.take_snapshot('*')
+
+        diff = self.profiler.diff('*')
+
+        top = diff['sites'][0]
+        self.assertTrue(top['site'].startswith('tests/test_memprofile.py:'))
+        self.assertIn('bytearray(size)', top['line'])
+        self.assertGreaterEqual(top['size_diff'], 100000)
+        self.assertGreaterEqual(top['count_diff'], 1)
+        self.assertGreaterEqual(diff['traced_diff'], 100000)
+
+    def test_single_snapshot(self):
+        self.allocate(100000)
+        self.profiler.take_snapshot('*')
+
+        top = self.profiler.diff('*')['sites'][0]
+
+        self.assertEqual(top['size_diff'], top['size'])
+
+    def test_no_snapshots(self):
+        self.assertIsNone(self.profiler.diff('/leak/<int:size>'))
+
+    def test_snapshot_after_request(self):
+        self.client.get('/leak/1000')
+        self.assertEqual(self.profiler.routes(), dict())
+
+        self.profiler.request_snapshot('/leak/<int:size>')
+        self.client.get('/leak/1000')
+        self.client.get('/leak/1000')
+
+        routes = self.profiler.routes()
+        self.assertEqual(routes['/leak/<int:size>']['snapshots'], 1)
+
+    def test_max_snapshots(self):
+        for i in range(0, 5):
+            self.profiler.take_snapshot('*')
+
+        self.assertEqual(self.profiler.routes()['*']['snapshots'], 3)
+
+    def test_check_key(self):
+        self.assertEqual(self.client.get('/key').data, b'False')
+        self.assertEqual(self.client.get('/key?key=wrong').data, b'False')
+        self.assertEqual(self.client.get('/key?key=secret').data, b'True')
+        self.assertEqual(self.client.get(
+            '/key', headers={'X-Memory-Profile-Key': 'secret'}).data, b'True')
+
+        self.app.config['KEY'] = None
+        self.assertEqual(self.client.get('/key?key=None').data, b'False')
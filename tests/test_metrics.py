@@ -0,0 +1,69 @@
+import unittest
+
+from flask import Flask
+
+from downstream_node import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def tearDown(self):
+        pass
+
+    def test_counter(self):
+        counter = self.registry.counter('test_total', 'A test counter',
+                                        ['route', 'status'])
+        counter.inc(('/a', '200'))
+        counter.inc(('/a', '200'), 2)
+        counter.inc(('/b', '404'))
+        self.assertEqual(counter.get(('/a', '200')), 3)
+        text = self.registry.expose()
+        self.assertIn('# TYPE test_total counter', text)
+        self.assertIn('test_total{route="/a",status="200"} 3.0', text)
+        self.assertIn('test_total{route="/b",status="404"} 1.0', text)
+
+    def test_gauge(self):
+        gauge = self.registry.gauge('test_gauge', 'A test gauge', ['size'])
+        gauge.set(5, ('100',))
+        gauge.replace({('200',): 2})
+        self.assertEqual(gauge.get(('100',)), 0)
+        self.assertIn('test_gauge{size="200"} 2.0', self.registry.expose())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('test_seconds', 'A histogram',
+                                            bounds=[1, 2])
+        histogram.observe(0.5)
+        histogram.observe(1.5)
+        histogram.observe(3)
+        text = self.registry.expose()
+        self.assertIn('test_seconds_bucket{le="1.0"} 1.0', text)
+        self.assertIn('test_seconds_bucket{le="2.0"} 2.0', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3.0', text)
+        self.assertIn('test_seconds_sum 5.0', text)
+        self.assertIn('test_seconds_count 3.0', text)
+
+    def test_timer(self):
+        histogram = self.registry.histogram('test_seconds', 'A histogram',
+                                            ['route'])
+        with histogram.time(('/a',)):
+            pass
+        self.assertEqual(histogram.get(('/a',)).count, 1)
+
+    def test_label_escaping(self):
+        counter = self.registry.counter('test_total', 'A test counter',
+                                        ['route'])
+        counter.inc(('a"b\\c',))
+        self.assertIn('test_total{route="a\\"b\\\\c"} 1.0',
+                      self.registry.expose())
+
+    def test_get_route(self):
+        app = Flask(metrics.__name__)
+        app.add_url_rule('/challenge/<token>', 'challenge', lambda token: '')
+
+        with app.test_request_context('/challenge/abc'):
+            self.assertEqual(metrics.get_route(), '/challenge/<token>')
+        # probes of made up paths share one label
+        with app.test_request_context('/wp-login.php'):
+            self.assertEqual(metrics.get_route(), '<unmatched>')
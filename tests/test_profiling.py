@@ -0,0 +1,108 @@
+import threading
+import unittest
+
+from downstream_node import profiling
+
+
+class Stats(object):
+    def __init__(self, timings, unit):
+        self.timings = timings
+        self.unit = unit
+
+
+class TestProfileRollups(unittest.TestCase):
+    def setUp(self):
+        self.rollups = profiling.ProfileRollups()
+
+    def test_add_request(self):
+        self.rollups.add_request('/challenge/<token>', 0.002)
+        self.rollups.add_request('/challenge/<token>', 0.2)
+        self.rollups.add_request('/answer/<token>', 0.02)
+
+        (latency, lines) = self.rollups.drain()
+        self.assertEqual(latency['/challenge/<token>'].count, 2)
+        self.assertAlmostEqual(latency['/challenge/<token>'].total, 0.202)
+        self.assertEqual(latency['/answer/<token>'].count, 1)
+        self.assertEqual(lines, dict())
+        self.assertEqual(self.rollups.drain(), (dict(), dict()))
+
+    def test_add_line_stats(self):
+        stats = Stats({('node.py', 10, 'verify'): [(11, 2, 1000),
+                                                   (12, 1, 500)]}, 1e-6)
+        self.rollups.add_line_stats('/answer/<token>', stats)
+        self.rollups.add_line_stats('/answer/<token>', stats)
+
+        (latency, lines) = self.rollups.drain()
+        key = ('/answer/<token>', 'node.py', 10, 'verify', 11)
+        self.assertEqual(lines[key][0], 4)
+        self.assertAlmostEqual(lines[key][1], 0.002)
+        self.assertEqual(len(lines), 2)
+
+    def test_due(self):
+        self.assertTrue(self.rollups.due(0))
+        self.assertFalse(self.rollups.due(60))
+
+    def test_drain_concurrent(self):
+        drained = list()
+
+        def add():
+            for i in range(0, 2000):
+                self.rollups.add_request('/a', 0.001)
+
+        threads = [threading.Thread(target=add) for i in range(0, 4)]
+        for t in threads:
+            t.start()
+        while (any(t.is_alive() for t in threads)):
+            drained.append(self.rollups.drain()[0])
+        drained.append(self.rollups.drain()[0])
+
+        # no observation is lost between drains
+        self.assertEqual(sum(d['/a'].count for d in drained if '/a' in d),
+                         8000)
+
+
+class TestProfileViews(unittest.TestCase):
+    def setUp(self):
+        self.frame = '{0}:1:test_function:{1}'.format(profiling.__file__, 1)
+        self.inner = '{0}:1:inner_function:{1}'.format(profiling.__file__, 2)
+
+    def test_resolve_route(self):
+        self.assertEqual(profiling.resolve_route('/challenge/abc'),
+                         '/challenge/<token>')
+        self.assertEqual(profiling.resolve_route('/challenge/<token>'),
+                         '/challenge/<token>')
+        self.assertEqual(profiling.resolve_route('/not/a/route'),
+                         '/not/a/route')
+
+    def test_collapsed_stacks(self):
+        stacks = [{'stack': '/a/b.py:1:f:3;/a/c.py:5:g:7', 'samples': 2},
+                  {'stack': '/a/b.py:1:f:4', 'samples': 1}]
+
+        self.assertEqual(profiling.collapsed_stacks(stacks),
+                         'f (b.py:3);g (c.py:7) 2\nf (b.py:4) 1\n')
+
+    def test_stack_line_totals(self):
+        stacks = [{'stack': ';'.join([self.frame, self.inner]), 'samples': 3},
+                  {'stack': self.frame, 'samples': 2}]
+
+        lines = profiling.stack_line_totals(stacks)
+        self.assertEqual([(line['function'], line['self_samples'],
+                           line['total_samples']) for line in lines],
+                         [('inner_function', 3, 3), ('test_function', 2, 5)])
+        self.assertEqual(lines[0]['lineno'], 2)
+        self.assertEqual(lines[0]['source'],
+                         open(profiling.__file__).readlines()[1].strip())
+        self.assertEqual(len(profiling.stack_line_totals(stacks, 1)), 1)
+
+    def test_route_summary(self):
+        self.assertEqual(profiling.route_summary(None)['requests'], 0)
+
+        bounds = [0.1, 1.0]
+        summary = profiling.route_summary({'bounds': bounds,
+                                           'buckets': {'0': 3, '2': 1},
+                                           'time': 5.0})
+        self.assertEqual(summary['requests'], 4)
+        self.assertEqual(summary['time'], 5.0)
+        self.assertEqual(summary['mean'], 1.25)
+        self.assertEqual(summary['p99'], 1.0)
+        self.assertLess(summary['p50'], 0.1)
@@ -0,0 +1,83 @@
+import os
+import unittest
+
+from flask import Flask
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, select
+
+from downstream_node import replicas
+
+
+class LaggingRouter(replicas.EngineRouter):
+    def __init__(self, *args, **kwargs):
+        replicas.EngineRouter.__init__(self, *args, **kwargs)
+        self.lags = list()
+        self.checks = 0
+
+    def measure_lag(self):
+        self.checks += 1
+        lag = self.lags.pop(0)
+        if (isinstance(lag, Exception)):
+            raise lag
+        return lag
+
+
+class TestEngineRouter(unittest.TestCase):
+    def setUp(self):
+        # two sqlite databases stand in for the primary and its replica
+        self.paths = ['test_primary.db', 'test_replica.db']
+        self.metadata = MetaData()
+        self.table = Table('t', self.metadata,
+                           Column('id', Integer, primary_key=True))
+        self.primary = create_engine('sqlite:///' + self.paths[0])
+        self.replica = create_engine('sqlite:///' + self.paths[1])
+        for (engine, id) in [(self.primary, 1), (self.replica, 2)]:
+            self.metadata.create_all(engine)
+            engine.execute(self.table.insert(), [dict(id=id)])
+        self.app = Flask(replicas.__name__)
+
+    def tearDown(self):
+        for engine in [self.primary, self.replica]:
+            engine.dispose()
+        for path in self.paths:
+            if (os.path.isfile(path)):
+                os.remove(path)
+
+    def read(self, engine):
+        return engine.execute(select([self.table.c.id])).scalar()
+
+    def test_no_replica(self):
+        router = replicas.EngineRouter(lambda: self.primary)
+        self.assertEqual(self.read(router.reader()), 1)
+        self.assertEqual(self.read(router.writer()), 1)
+
+    def test_replica(self):
+        router = replicas.EngineRouter(lambda: self.primary, self.replica)
+        self.assertEqual(router.lag(), 0)
+        self.assertEqual(self.read(router.reader()), 2)
+        self.assertEqual(self.read(router.writer()), 1)
+
+    def test_lagging_replica(self):
+        router = LaggingRouter(lambda: self.primary, self.replica, 5, 0)
+        router.lags = [5, 6, None, Exception('unreachable'), 0]
+        self.assertEqual(self.read(router.reader()), 2)
+        self.assertEqual(self.read(router.reader()), 1)
+        self.assertEqual(self.read(router.reader()), 1)
+        self.assertEqual(self.read(router.reader()), 1)
+        self.assertEqual(self.read(router.reader()), 2)
+
+    def test_lag_checked_once_per_interval(self):
+        router = LaggingRouter(lambda: self.primary, self.replica, 5, 60)
+        router.lags = [0]
+        for i in range(0, 3):
+            self.assertIs(router.reader(), self.replica)
+        self.assertEqual(router.checks, 1)
+
+    def test_session(self):
+        router = replicas.EngineRouter(lambda: self.primary, self.replica)
+        router.install(self.app)
+        with self.app.app_context():
+            self.assertEqual(
+                router.session.query(self.table.c.id).scalar(), 2)
+            session = router.session()
+        with self.app.app_context():
+            self.assertIsNot(router.session(), session)
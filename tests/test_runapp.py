@@ -0,0 +1,205 @@
+import os
+import sys
+import shutil
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import runapp  # NOQA
+from downstream_node.startup import app, db, create_app  # NOQA
+from downstream_node import models  # NOQA
+
+app.config['SQLALCHEMY_DATABASE_URI'] = \
+    'mysql+pymysql://localhost/test_downstream'
+create_app()
+
+
+class TestCleanDb(unittest.TestCase):
+    def setUp(self):
+        db.engine.execute('DROP TABLE IF EXISTS '
+                          'contracts,chunks,tokens,addresses,files')
+        db.create_all()
+        self.tags_path = app.config['TAGS_PATH']
+        app.config['TAGS_PATH'] = 'test_tags/'
+        os.mkdir(app.config['TAGS_PATH'])
+
+        address = models.Address(address='0', crowdsale_balance=20000)
+        db.session.add(address)
+        db.session.commit()
+        token = models.Token(token='0',
+                             address_id=address.id,
+                             ip_address='0',
+                             farmer_id='0',
+                             hbcount=0,
+                             location=None)
+        db.session.add(token)
+        added = datetime.utcnow() - timedelta(hours=1)
+        self.referenced = models.File(hash='referenced',
+                                      redundancy=1,
+                                      interval=60,
+                                      added=added,
+                                      seed='0',
+                                      size=100)
+        self.orphaned = models.File(hash='orphaned',
+                                    redundancy=1,
+                                    interval=60,
+                                    added=added,
+                                    seed='1',
+                                    size=100)
+        db.session.add(self.referenced)
+        db.session.add(self.orphaned)
+        db.session.commit()
+
+        self.referenced_tag = os.path.join(app.config['TAGS_PATH'], 'tag0')
+        self.orphaned_tag = os.path.join(app.config['TAGS_PATH'], 'tag1')
+        for path in [self.referenced_tag, self.orphaned_tag]:
+            with open(path, 'wb') as f:
+                f.write(b'tag')
+        contract = models.Contract(token_id=token.id,
+                                   file_id=self.referenced.id,
+                                   state=b'',
+                                   challenge=b'',
+                                   tag_path=self.referenced_tag,
+                                   start=datetime.utcnow(),
+                                   due=datetime.utcnow() +
+                                   timedelta(seconds=60),
+                                   answered=False)
+        db.session.add(contract)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.close()
+        db.engine.execute('DROP TABLE contracts,chunks,tokens,addresses,files')
+        shutil.rmtree(app.config['TAGS_PATH'])
+        app.config['TAGS_PATH'] = self.tags_path
+
+    def test_cleandb(self):
+        runapp.cleandb(batch_size=1, pause=0, grace=0)
+
+        hashes = [f.hash for f in models.File.query.all()]
+        self.assertEqual(hashes, ['referenced'])
+        self.assertTrue(os.path.isfile(self.referenced_tag))
+        self.assertFalse(os.path.isfile(self.orphaned_tag))
+
+    def test_cleandb_grace(self):
+        # the orphans may belong to a chunk that is still being prepared
+        runapp.cleandb(batch_size=1, pause=0, grace=7200)
+
+        self.assertEqual(len(models.File.query.all()), 2)
+        self.assertTrue(os.path.isfile(self.orphaned_tag))
+
+    def test_delete_in_batches(self):
+        files = models.File.__table__
+        deleted = runapp.delete_in_batches(files, files,
+                                           files.c.seed != None,  # NOQA
+                                           files.c.hash == 'orphaned',
+                                           batch_size=1)
+
+        # only the rows that still meet the guard are deleted
+        self.assertEqual(deleted, 1)
+        self.assertEqual([f.hash for f in models.File.query.all()],
+                         ['referenced'])
+
+
+class TestUpdateWhitelist(unittest.TestCase):
+    def setUp(self):
+        db.engine.execute('DROP TABLE IF EXISTS '
+                          'contracts,chunks,tokens,addresses,files')
+        db.create_all()
+        self.path = 'test_whitelist.csv'
+        self.stamp_path = app.config['WHITELIST_STAMP_PATH']
+        app.config['WHITELIST_STAMP_PATH'] = 'test_whitelist.stamp'
+
+        for address in ['0', '1', '2']:
+            db.session.add(models.Address(address=address,
+                                          crowdsale_balance=100))
+        db.session.commit()
+        address = models.Address.query.filter(
+            models.Address.address == '2').first()
+        token = models.Token(token='2',
+                             address_id=address.id,
+                             ip_address='2',
+                             farmer_id='2',
+                             hbcount=0,
+                             location=None)
+        db.session.add(token)
+        db_file = models.File(hash='0',
+                              redundancy=1,
+                              interval=60,
+                              added=datetime.utcnow(),
+                              seed='0',
+                              size=100)
+        db.session.add(db_file)
+        db.session.commit()
+        db.session.add(models.Contract(token_id=token.id,
+                                       file_id=db_file.id,
+                                       state=b'',
+                                       challenge=b'',
+                                       tag_path='tag0',
+                                       start=datetime.utcnow(),
+                                       due=datetime.utcnow(),
+                                       answered=False))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.close()
+        db.engine.execute('DROP TABLE contracts,chunks,tokens,addresses,files')
+        for path in [self.path, app.config['WHITELIST_STAMP_PATH']]:
+            if (os.path.exists(path)):
+                os.remove(path)
+        app.config['WHITELIST_STAMP_PATH'] = self.stamp_path
+
+    def write_whitelist(self, rows):
+        with open(self.path, 'w') as f:
+            f.write('"address","crowdsale_balance"\n')
+            for row in rows:
+                f.write('"{0}","{1}"\n'.format(*row))
+
+    def balances(self):
+        db.session.expire_all()
+        return dict((a.address, a.crowdsale_balance)
+                    for a in models.Address.query.all())
+
+    def staging_tables(self):
+        return [t for t in db.engine.table_names()
+                if t.startswith('whitelist_staging')]
+
+    def test_updatewhitelist(self):
+        self.write_whitelist([('0', 100), ('1', 200), ('3', 300), ('3', 400)])
+
+        runapp.updatewhitelist(self.path, batch_size=1)
+
+        self.assertEqual(self.balances(), {'0': 100, '1': 200, '3': 400})
+        # the unlisted address goes with its tokens and contracts
+        self.assertEqual(models.Token.query.count(), 0)
+        self.assertEqual(models.Contract.query.count(), 0)
+        self.assertEqual(self.staging_tables(), [])
+        self.assertTrue(os.path.isfile(app.config['WHITELIST_STAMP_PATH']))
+
+    def test_updatewhitelist_shrunk(self):
+        self.write_whitelist([('0', 100)])
+
+        with self.assertRaises(ValueError) as ex:
+            runapp.updatewhitelist(self.path)
+
+        self.assertIn('Refusing a whitelist of 1 addresses when 3 are listed',
+                      str(ex.exception))
+        self.assertEqual(self.balances(), {'0': 100, '1': 100, '2': 100})
+        self.assertEqual(models.Contract.query.count(), 1)
+        self.assertEqual(self.staging_tables(), [])
+
+    def test_updatewhitelist_min_ratio(self):
+        self.write_whitelist([('0', 100)])
+
+        runapp.updatewhitelist(self.path, min_ratio=0)
+
+        self.assertEqual(self.balances(), {'0': 100})
+
+    def test_updatewhitelist_empty(self):
+        self.write_whitelist([])
+
+        with self.assertRaises(ValueError):
+            runapp.updatewhitelist(self.path, min_ratio=0)
+
+        self.assertEqual(len(self.balances()), 3)
@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+import threading
+import unittest
+
+from downstream_node.sampler import StackSampler
+
+
+def busy_function(event):
+    event.wait(5)
+
+
+class TestStackSampler(unittest.TestCase):
+    def setUp(self):
+        self.sampler = StackSampler(rate=1000)
+        self.event = threading.Event()
+
+    def tearDown(self):
+        self.event.set()
+        self.sampler.stop()
+
+    def start_request(self, route):
+        started = threading.Event()
+
+        def serve():
+            self.sampler.begin(route)
+            started.set()
+            busy_function(self.event)
+            self.sampler.end()
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        started.wait(5)
+        return thread
+
+    def test_collapse(self):
+        def inner():
+            return self.sampler.collapse(sys._getframe())
+
+        stack = inner().split(';')
+        self.assertIn(':inner:', stack[-1])
+        self.assertIn(':test_collapse:', stack[-2])
+
+    def test_collapse_max_depth(self):
+        sampler = StackSampler(max_depth=2)
+        stack = sampler.collapse(sys._getframe())
+        self.assertEqual(len(stack.split(';')), 2)
+        self.assertIn(':test_collapse_max_depth:', stack.split(';')[-1])
+
+    def test_sample(self):
+        thread = self.start_request('/challenge/<token>')
+        self.sampler.sample()
+        self.sampler.sample()
+        self.event.set()
+        thread.join()
+
+        counts = self.sampler.drain()
+        self.assertEqual(len(counts), 1)
+        ((route, stack), samples) = list(counts.items())[0]
+        self.assertEqual(route, '/challenge/<token>')
+        self.assertIn(':busy_function:', stack)
+        self.assertEqual(samples, 2)
+        self.assertEqual(self.sampler.drain(), dict())
+
+    def test_idle_threads_not_sampled(self):
+        thread = self.start_request('/challenge/<token>')
+        self.event.set()
+        thread.join()
+        self.sampler.sample()
+        self.assertEqual(self.sampler.drain(), dict())
+
+    def test_flush(self):
+        flushed = list()
+        sampler = StackSampler(rate=1000, flush=flushed.append,
+                               flush_interval=0)
+        self.sampler = sampler
+        thread = self.start_request('/answer/<token>')
+        sampler.start()
+        deadline = time.time() + 5
+        while (sum([len(f) for f in flushed]) == 0
+               and time.time() < deadline):
+            time.sleep(0.01)
+        sampler.stop()
+        self.event.set()
+        thread.join()
+        routes = set(k[0] for f in flushed for k in f)
+        self.assertEqual(routes, set(['/answer/<token>']))
+
+    def test_start_after_fork(self):
+        self.sampler.start()
+        thread = self.sampler.thread
+        self.sampler.start()
+        self.assertIs(self.sampler.thread, thread)
+
+        # as seen by a forked worker, which has none of the parent's threads
+        self.sampler.counts[('/a', 'stack')] = 1
+        self.sampler.pid = os.getpid() + 1
+        self.sampler.start()
+        self.assertIsNot(self.sampler.thread, thread)
+        self.assertTrue(self.sampler.thread.is_alive())
+        self.assertEqual(self.sampler.pid, os.getpid())
+        self.assertEqual(self.sampler.drain(), dict())
+        self.sampler.running = False
+        thread.join()
@@ -0,0 +1,92 @@
+import os
+import json
+import unittest
+
+import mock
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+
+from downstream_node import slowlog
+
+
+class TestSlowQueryLog(unittest.TestCase):
+    def setUp(self):
+        self.path = 'test_slow_queries.db'
+        # statements are explained on a connection of their own, so the
+        # database must be shared between connections
+        self.db_path = 'test_slow_queries_data.db'
+        self.engine = create_engine('sqlite:///' + self.db_path)
+        self.engine.execute('CREATE TABLE t (id INTEGER PRIMARY KEY, v TEXT)')
+        self.log = slowlog.SlowQueryLog(self.path, 0, 5)
+        self.log.install()
+
+    def tearDown(self):
+        event.remove(Engine, 'before_cursor_execute',
+                     self.log.before_cursor_execute)
+        event.remove(Engine, 'after_cursor_execute',
+                     self.log.after_cursor_execute)
+        self.log.flush()
+        self.engine.dispose()
+        for path in [self.path, self.db_path]:
+            if (os.path.exists(path)):
+                os.remove(path)
+
+    def test_fingerprint_in_lists(self):
+        self.assertEqual(slowlog.fingerprint('SELECT a WHERE a IN (?, ?)'),
+                         slowlog.fingerprint('SELECT a WHERE a IN (?,?,?)'))
+        self.assertNotEqual(slowlog.fingerprint('SELECT a WHERE a = ?'),
+                            slowlog.fingerprint('SELECT b WHERE b = ?'))
+
+    def test_parameter_shapes(self):
+        self.assertEqual(json.loads(slowlog.parameter_shapes((1, 'abc'),
+                                                             False)),
+                         ['int', 'str[3]'])
+        self.assertEqual(json.loads(slowlog.parameter_shapes({'a': None},
+                                                             False)),
+                         {'a': 'NoneType'})
+        shapes = json.loads(slowlog.parameter_shapes([(1,), (2,)], True))
+        self.assertEqual(shapes['executemany'], 2)
+        self.assertEqual(shapes['first'], ['int'])
+
+    def test_record(self):
+        self.engine.execute('SELECT v FROM t WHERE id = ?', 1)
+        self.engine.execute('SELECT v FROM t WHERE id = ?', 2)
+        self.log.flush()
+
+        statements = [s for s in self.log.statements()
+                      if s['statement'].startswith('SELECT v')]
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(statements[0]['count'], 2)
+        self.assertIn('SEARCH', statements[0]['explain'])
+
+        recent = self.log.recent(statements[0]['fingerprint'])
+        self.assertEqual(len(recent), 2)
+        self.assertIsNone(recent[0]['route'])
+        self.assertEqual(json.loads(recent[0]['parameters']), ['int'])
+
+    def test_install_once(self):
+        self.log.install()
+        self.engine.execute('SELECT v FROM t WHERE id = ?', 1)
+        self.log.flush()
+
+        self.assertEqual(len(self.log.recent(limit=100)), 1)
+
+    def test_threshold(self):
+        self.log.threshold = 3600
+        self.engine.execute('SELECT v FROM t')
+        self.log.flush()
+        self.assertEqual(self.log.statements(), [])
+
+    def test_bounded(self):
+        for i in range(0, 20):
+            self.engine.execute('SELECT v FROM t WHERE id = ?', i)
+        self.log.flush()
+        self.assertEqual(len(self.log.recent(limit=100)), 5)
+
+    def test_pending_bounded(self):
+        log = slowlog.SlowQueryLog(self.path, 0, 5, max_pending=2)
+        with mock.patch.object(log, 'write'):
+            for i in range(0, 5):
+                log.submit((None, 'SELECT 1', (), False, 1, None, '[]', 0))
+            self.assertEqual(log.pending.qsize(), 2)
+        self.assertEqual(log.writer_pid, os.getpid())
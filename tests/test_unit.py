@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 import json
 import os
+import time
 import pickle
 import unittest
 import io
@@ -15,16 +16,25 @@ from datetime import datetime, timedelta
 
 import heartbeat
 from RandomIO import RandomIO
+from sqlalchemy import inspect
 
-from downstream_node.startup import app, db, load_heartbeat, load_logger
+from downstream_node.startup import (app, db, create_app, load_heartbeat,
+                                     load_logger, load_heartbeat_pool)
 from downstream_node import models
 from downstream_node import node
 from downstream_node import config
 from downstream_node import uptime
 from downstream_node import log
+from downstream_node import whitelist
+from downstream_node import sqlstats
+from downstream_node import metrics
+from downstream_node import queries
+from downstream_node import encoding
 from downstream_node.exc import InvalidParameterError, NotFoundError, HttpHandler
+from downstream_node.types import MutableTypeWrapper
 
 app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql+pymysql://localhost/test_downstream'
+create_app()
 
 class TestStartup(unittest.TestCase):
     def setUp(self):
@@ -58,6 +68,25 @@ class TestStartup(unittest.TestCase):
         self.assertIsInstance(logger, log.mongolog)
         self.assertEqual(logger.server, mock_alias)
         
+    def test_create_app(self):
+        self.assertIs(create_app(), app)
+        self.assertTrue(app.created)
+        self.assertIsNotNone(app.heartbeat)
+        self.assertIn('api_downstream_new_token', app.view_functions)
+
+    def test_load_heartbeat_pool_none(self):
+        self.assertIsNone(load_heartbeat_pool(0, app.heartbeat))
+
+    def test_load_heartbeat_pool_old_python(self):
+        with patch('downstream_node.startup.sys') as sys:
+            sys.version_info = (3, 6, 0)
+            with self.assertRaises(RuntimeError) as ex:
+                load_heartbeat_pool(2, app.heartbeat)
+
+        self.assertEqual(str(ex.exception),
+                         'HEARTBEAT_PROCESSES needs python 3.7 or later.')
+        self.assertIsNone(app.heartbeat_pool)
+
     def test_log_startup_none(self):
         mock_uri = 'mock_uri'
         mock_alias = 'mock_alias'
@@ -107,6 +136,8 @@ class TestDownstreamRoutes(unittest.TestCase):
         address = models.Address(address=self.test_address,crowdsale_balance=10000)
         db.session.add(address)
         db.session.commit()
+        # contract ids are reused after the tables are recreated
+        app.state_cache.clear()
 
     def tearDown(self):
         db.session.close()
@@ -124,6 +155,76 @@ class TestDownstreamRoutes(unittest.TestCase):
         
         self.assertEqual(r_json['msg'],'ok')
 
+    def test_api_query_stats_headers(self):
+        debug = app.debug
+        app.debug = True
+        try:
+            r = self.app.get('/status/show/nonexistent')
+        finally:
+            app.debug = debug
+
+        self.assertGreater(int(r.headers['X-Query-Count']), 0)
+        self.assertGreaterEqual(float(r.headers['X-Query-Time']), 0)
+        self.assertIn('SELECT', r.headers['X-Slowest-Query'])
+        self.assertNotIn('\n', r.headers['X-Slowest-Query'])
+
+    def test_api_query_stats_no_headers(self):
+        debug = app.debug
+        app.debug = False
+        try:
+            r = self.app.get('/status/show/nonexistent')
+        finally:
+            app.debug = debug
+
+        self.assertNotIn('X-Query-Count', r.headers)
+
+    def test_api_metrics(self):
+        self.app.get('/')
+        r = self.app.get('/metrics')
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.mimetype, 'text/plain')
+
+        text = r.data.decode('utf-8')
+
+        self.assertIn('downstream_requests_total{route="/",status="200"}',
+                      text)
+        self.assertIn('downstream_request_duration_seconds_bucket{route="/"',
+                      text)
+        self.assertIn('# TYPE downstream_chunk_pool gauge', text)
+
+    def test_api_metrics_errors(self):
+        before = metrics.errors.get(('/status/show/<farmer_id>', '404'))
+        self.app.get('/status/show/nonexistent')
+        after = metrics.errors.get(('/status/show/<farmer_id>', '404'))
+
+        self.assertEqual(after, before + 1)
+
+    def test_api_debug_queries(self):
+        debug = app.debug
+        app.debug = True
+        try:
+            self.app.get('/status/show/nonexistent')
+            r = self.app.get('/debug/queries/')
+        finally:
+            app.debug = debug
+
+        r_json = json.loads(r.data.decode('utf-8'))
+
+        stats = r_json['routes']['/status/show/<farmer_id>']
+        self.assertGreater(stats['requests'], 0)
+        self.assertGreater(stats['queries'], 0)
+
+    def test_api_debug_queries_not_debug(self):
+        debug = app.debug
+        app.debug = False
+        try:
+            r = self.app.get('/debug/queries/')
+        finally:
+            app.debug = debug
+
+        self.assertEqual(r.status_code, 404)
+
     def test_api_downstream_new(self):
         app.mongo_logger = mock.MagicMock()
         with patch('downstream_node.routes.request') as request:
@@ -268,6 +369,25 @@ class TestDownstreamRoutes(unittest.TestCase):
         r_json = json.loads(r.data.decode('utf-8'))
         self.assertEqual(r_json['message'], 'Nonexistent token.')
         
+    def test_api_downstream_heartbeat_conditional(self):
+        with patch('downstream_node.routes.request') as request:
+            request.remote_addr = 'test.ip.address'
+            with patch('downstream_node.node.get_ip_location') as p:
+                p.return_value = dict()
+                r = self.app.get('/new/{0}'.format(self.test_address))
+        
+        r_token = json.loads(r.data.decode('utf-8'))['token']
+        
+        r = self.app.get('/heartbeat/{0}'.format(r_token))
+        self.assertEqual(r.status_code, 200)
+        etag = r.headers['ETag']
+        
+        r = self.app.get('/heartbeat/{0}'.format(r_token),
+                         headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.headers['ETag'], etag)
+        self.assertEqual(len(r.data), 0)
+        
     def test_api_downstream_chunk(self):
         app.mongo_logger = mock.MagicMock()
         with patch('downstream_node.routes.request') as request:
@@ -346,6 +466,20 @@ class TestDownstreamRoutes(unittest.TestCase):
         r_json = json.loads(r.data.decode('utf-8'))
         
         self.assertEqual(r_json['chunks'], [])
+
+    def test_api_downstream_chunk_missing_tag(self):
+        app.mongo_logger = mock.MagicMock()
+        db_contract = Mock(tag_path='nonexistent tag')
+        with patch('downstream_node.routes.get_chunk_contracts') as p:
+            p.return_value = [db_contract]
+            r = self.app.get('/chunk/test_token')
+
+        # an error rather than a response that is cut short
+        self.assertEqual(r.status_code, 500)
+        self.assertEqual(r.content_type, 'application/json')
+        self.assertTrue(app.mongo_logger.log_exception.called)
+        self.assertFalse(app.mongo_logger.log_event.called)
+        app.mongo_logger = None
         
     def test_api_downstream_challenge(self):
         with patch('downstream_node.node.get_ip_location') as p:
@@ -383,6 +517,63 @@ class TestDownstreamRoutes(unittest.TestCase):
         self.assertEqual(r.status_code, 400)
         self.assertEqual(r.content_type, 'application/json')
         
+    def test_api_downstream_challenge_since(self):
+        with patch('downstream_node.node.get_ip_location') as p:
+            p.return_value = dict()
+            db_token = node.create_token(self.test_address,'test.ip.address')
+
+        node.generate_test_file(self.test_size)
+        node.generate_test_file(self.test_size)
+
+        with patch('downstream_node.node.get_ip_location') as p:
+            p.return_value = dict()
+            db_contracts = node.get_chunk_contracts(
+                db_token.token, 2 * self.test_size, 'test.ip.address')
+
+        self.assertEqual(len(db_contracts), 2)
+
+        token = db_token.token
+        hash = db_contracts[0].file.hash
+
+        r = self.app.get('/challenge/{0}'.format(token))
+        r_json = json.loads(r.data.decode('utf-8'))
+
+        self.assertEqual(len(r_json['challenges']), 2)
+        cursor = r_json['cursor']
+
+        r = self.app.get('/challenge/{0}?since={1}'.format(token, cursor))
+        r_json = json.loads(r.data.decode('utf-8'))
+
+        self.assertEqual(r.status_code, 200, r.data.decode('utf-8'))
+        self.assertEqual(r_json['challenges'], [])
+        self.assertEqual(r_json['cursor'].split('-')[0], cursor.split('-')[0])
+
+        # the contract falls due, so it gets a new challenge
+        db_contract = node.lookup_contract(token, hash)
+        db_contract.due = datetime.utcnow() - timedelta(seconds=1)
+        db_contract.answered = True
+        db.session.commit()
+
+        r = self.app.get('/challenge/{0}?since={1}'.format(token, cursor))
+        r_json = json.loads(r.data.decode('utf-8'))
+
+        self.assertEqual([c['file_hash'] for c in r_json['challenges']],
+                         [hash])
+        self.assertIn('challenge', r_json['challenges'][0])
+        self.assertNotEqual(r_json['cursor'], cursor)
+
+        r = self.app.get('/challenge/{0}?since={1}'.format(
+            token, r_json['cursor']))
+        r_json = json.loads(r.data.decode('utf-8'))
+
+        self.assertEqual(r_json['challenges'], [])
+
+        r = self.app.get('/challenge/{0}?since=invalid'.format(token))
+        r_json = json.loads(r.data.decode('utf-8'))
+
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(r_json['message'], 'Invalid since cursor.')
+
     def test_api_downstream_answer(self):
         app.mongo_logger = mock.MagicMock()
         with patch('downstream_node.routes.request') as request:
@@ -507,6 +698,8 @@ class TestDownstreamNodeStatus(unittest.TestCase):
     def setUp(self):
         self.app = app.test_client()
         app.config['TESTING'] = True
+        # the status views bring the summary up to date for each test
+        models.summary_updated = None
         db.engine.execute('DROP TABLE IF EXISTS contracts,chunks,tokens,addresses,files')
         db.create_all()
         
@@ -602,6 +795,54 @@ class TestDownstreamNodeStatus(unittest.TestCase):
         self.assertEqual(r_json['farmers'][0]['id'],'0')
         self.assertEqual(r_json['farmers'][1]['id'],'1')
 
+    def test_api_status_list_streamed(self):
+        r_whole = self.app.get('/status/list/')
+        app.config['STREAM_JSON'] = True
+        try:
+            r = self.app.get('/status/list/')
+        finally:
+            app.config['STREAM_JSON'] = False
+
+        self.assertEqual(r_whole.status_code, 200)
+        self.assertEqual(json.loads(r.data.decode('utf-8')),
+                         json.loads(r_whole.data.decode('utf-8')))
+
+    @unittest.skipIf(encoding.msgpack is None, 'msgpack unavailable')
+    def test_api_status_list_msgpack(self):
+        r = self.app.get('/status/list/',
+                         headers={'Accept': encoding.MSGPACK_MIMETYPE})
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.mimetype, encoding.MSGPACK_MIMETYPE)
+
+        r_msgpack = encoding.msgpack.unpackb(r.data, raw=False)
+        r_json = json.loads(self.app.get('/status/list/').data.decode('utf-8'))
+
+        # farmer 0 has contracts, so a due date to encode
+        self.assertIsNotNone(r_json['farmers'][0]['last_due'])
+        self.assertEqual(r_msgpack, r_json)
+
+    def test_refresh_uptime_summary(self):
+        with patch('downstream_node.models.update_uptime_summary') as p:
+            self.assertTrue(models.refresh_uptime_summary(60))
+            self.assertFalse(models.refresh_uptime_summary(60))
+            self.assertEqual(p.call_count, 1)
+
+            models.summary_updated -= 60
+            self.assertTrue(models.refresh_uptime_summary(60))
+            self.assertEqual(p.call_count, 2)
+
+            # left to runapp.py --summary-interval
+            models.summary_updated = None
+            self.assertFalse(models.refresh_uptime_summary(0))
+            self.assertEqual(p.call_count, 2)
+
+    def test_api_status_list_summary_interval(self):
+        self.app.get('/status/list/')
+        with patch('downstream_node.routes.refresh_uptime_summary') as p:
+            self.app.get('/status/list/')
+        p.assert_called_once_with(app.config['UPTIME_SUMMARY_INTERVAL'])
+
     def test_api_status_list_invalid_sort(self):
         r = self.app.get('/status/list/by/invalid.sort')
         
@@ -759,7 +1000,205 @@ class TestDownstreamNodeStatus(unittest.TestCase):
         r_json = json.loads(r.data.decode('utf-8'))
         
         self.assertEqual(r_json['id'],'1')
-        
+
+    def test_api_status_geo_country(self):
+        db_token = queries.get_token('1')
+        db_token.location = dict(country='US', state='CA')
+        db.session.commit()
+
+        r = self.app.get('/status/geo/country/')
+
+        self.assertEqual(r.status_code, 200)
+
+        r_json = json.loads(r.data.decode('utf-8'))
+
+        self.assertEqual(len(r_json['locations']), 2)
+        us = [l for l in r_json['locations'] if l['country'] == 'US'][0]
+        self.assertEqual(us['farmers'], 1)
+        self.assertEqual(us['online'], 1)
+        self.assertEqual(us['size'], 150)
+
+    def test_api_status_geo_region(self):
+        queries.get_token('0').location = dict(country='US', state='NY')
+        queries.get_token('1').location = dict(country='US', state='CA')
+        db.session.commit()
+
+        r = self.app.get('/status/geo/region/US')
+
+        self.assertEqual(r.status_code, 200)
+
+        r_json = json.loads(r.data.decode('utf-8'))
+
+        self.assertEqual([l['region'] for l in r_json['locations']],
+                         ['CA', 'NY'])
+        self.assertEqual([l['online'] for l in r_json['locations']], [1, 0])
+
+    def test_token_location(self):
+        db_token = queries.get_token('0')
+        db_token.location = dict(country='US', state='CA', city='SF',
+                                 zip='94103', lat=37.7, lon=-122.4)
+        db.session.commit()
+        self.assertEqual(db_token.region, 'CA')
+        self.assertEqual(db_token.location['zip'], '94103')
+        db_token.location = None
+        self.assertEqual(set(db_token.location.values()), set([None]))
+
+    def test_queries_get_token(self):
+        self.assertEqual(queries.get_token('1').farmer_id, '1')
+        self.assertIsNone(queries.get_token('nonexistent'))
+
+    def test_queries_get_contract(self):
+        db_token = queries.get_token('1')
+        db_file = queries.get_file('2')
+        db_contract = queries.get_contract(db_token.id, db_file.id)
+        self.assertEqual(db_contract.tag_path, 'tag2')
+        self.assertIsNone(queries.get_file('nonexistent'))
+
+    def test_queries_get_token_contracts(self):
+        db_token = queries.get_token('1')
+        contracts = queries.get_token_contracts(db_token.id)
+        self.assertEqual(sorted(c.tag_path for c in contracts),
+                         ['tag1', 'tag2'])
+        contracts = queries.get_token_contracts(db_token.id, ['2', '0'])
+        self.assertEqual([c.tag_path for c in contracts], ['tag2'])
+        self.assertEqual(queries.get_token_contracts(db_token.id, []), [])
+
+    def test_queries_farmer_statement_compiled_once(self):
+        s = queries.farmer_statement('id', True, True, False)
+        self.assertIs(queries.farmer_statement('id', True, True, False), s)
+        rows = queries.execute(db.engine, s, limit=1).fetchall()
+        self.assertEqual([r.id for r in rows], ['1'])
+        compiled = len(queries.compiled_cache)
+        rows = queries.execute(db.engine, s, limit=2).fetchall()
+        self.assertEqual([r.id for r in rows], ['1', '0'])
+        self.assertEqual(len(queries.compiled_cache), compiled)
+
+    def test_queries_farmer_statement_current_time(self):
+        db_contract = models.Contract.query.filter(
+            models.Contract.tag_path == 'tag2').first()
+        db_contract.due = datetime.utcnow() + timedelta(seconds=0.5)
+        db.session.commit()
+        s = queries.farmer_statement('id', True)
+        rows = queries.execute(db.engine, s).fetchall()
+        self.assertEqual([bool(r.online) for r in rows], [True, False])
+        # the statement is reused, but online is as of each execution
+        time.sleep(0.6)
+        rows = queries.execute(db.engine, s).fetchall()
+        self.assertEqual([bool(r.online) for r in rows], [False, False])
+
+    def test_wait_for_challenge(self):
+        db_token = queries.get_token('1')
+        with patch('downstream_node.node.time.sleep') as sleep:
+            self.assertEqual(node.wait_for_challenge(db_token.id, None, 5), 5)
+            sleep.assert_called_once_with(5)
+            sleep.reset_mock()
+            # the only contract for this hash has expired
+            self.assertEqual(
+                node.wait_for_challenge(db_token.id, ['1'], 5), 0)
+            self.assertEqual(node.wait_for_challenge(db_token.id, None, 0), 0)
+            self.assertFalse(sleep.called)
+
+    def test_challenge_seq(self):
+        db_token = queries.get_token('1')
+        self.assertEqual(node.taken_challenge_seq(db_token.id), None)
+        self.assertEqual(node.challenge_seq(db_token.id), 1)
+        self.assertEqual(node.challenge_seq(db_token.id), 1)
+        self.assertEqual(node.taken_challenge_seq(db_token.id), 1)
+        db.session.commit()
+        self.assertEqual(node.taken_challenge_seq(db_token.id), None)
+        self.assertEqual(node.challenge_seq(db_token.id), 2)
+        db.session.rollback()
+        self.assertEqual(node.read_challenge_seq(db_token.id), 1)
+
+    def test_challenge_cursor(self):
+        now = datetime.utcnow()
+        cursor = node.challenge_cursor(3, now)
+        self.assertEqual(node.parse_challenge_cursor(cursor), (3, now))
+        for cursor in ['', '3', '3-x', '3-1-1', '3-99999999999999999999']:
+            with self.assertRaises(InvalidParameterError):
+                node.parse_challenge_cursor(cursor)
+
+    def test_queries_get_token_contracts_since(self):
+        db_token = queries.get_token('1')
+        now = datetime.utcnow()
+        # the first contract expired a second ago
+        contracts = queries.get_token_contracts(
+            db_token.id, since=(0, now - timedelta(seconds=10)), now=now)
+        self.assertEqual([c.file.hash for c in contracts], ['1'])
+        contracts = queries.get_token_contracts(
+            db_token.id, since=(0, now), now=now)
+        self.assertEqual(contracts, [])
+        db_contract = queries.get_contract(db_token.id,
+                                           queries.get_file('2').id)
+        db_contract.challenge_seq = 1
+        db.session.commit()
+        contracts = queries.get_token_contracts(
+            db_token.id, ['2'], since=(0, now), now=now)
+        self.assertEqual([c.file.hash for c in contracts], ['2'])
+        contracts = queries.get_token_contracts(
+            db_token.id, since=(1, now), now=now)
+        self.assertEqual(contracts, [])
+
+    def test_api_challenge_negative_wait(self):
+        r = self.app.get('/challenge/1?wait=-1')
+
+        self.assertEqual(r.status_code, 400)
+
+        r_json = json.loads(r.data.decode('utf-8'))
+
+        self.assertEqual(r_json['message'], 'Wait must not be negative.')
+
+    def test_api_challenge_blocking_wait(self):
+        r = self.app.get('/challenge/1?wait=5')
+
+        self.assertEqual(r.status_code, 400)
+
+        r_json = json.loads(r.data.decode('utf-8'))
+
+        self.assertEqual(r_json['message'],
+                         'Wait is not supported by this server.')
+
+    def test_api_challenge_cooperative_wait(self):
+        with patch('downstream_node.routes.cooperative_sleep',
+                   return_value=True),\
+                patch('downstream_node.routes.wait_for_challenge') as wait:
+            r = self.app.get('/challenge/0?wait=5')
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(wait.call_args[0][2], 5)
+
+    def test_cooperative_sleep(self):
+        self.assertFalse(node.cooperative_sleep())
+        monkey = Mock()
+        monkey.is_module_patched.return_value = True
+        with patch.dict('sys.modules', {'gevent.monkey': monkey}):
+            self.assertTrue(node.cooperative_sleep())
+        monkey.is_module_patched.assert_called_once_with('time')
+
+    def test_token_aggregates(self):
+        db_token = queries.get_token('1')
+        db_contract = queries.get_contract(db_token.id,
+                                           queries.get_file('2').id)
+        self.assertEqual(db_token.size, 250)
+        self.assertTrue(db_token.online)
+        self.assertEqual(db_token.online_count, 1)
+        self.assertEqual(db_token.online_size, 150)
+        self.assertEqual(db_token.last_due, db_contract.due.isoformat())
+        db_token = queries.get_token('0')
+        self.assertFalse(db_token.online)
+        self.assertEqual(db_token.online_size, 0)
+
+    def test_contract_blobs_deferred(self):
+        db_token = queries.get_token('1')
+        contracts = queries.get_token_contracts(db_token.id)
+        for c in contracts:
+            self.assertTrue({'state', 'challenge', 'next_challenge',
+                             'next_state'} <= inspect(c).unloaded)
+        queries.load_contract_groups(contracts, 'challenge')
+        for c in contracts:
+            self.assertNotIn('challenge', inspect(c).unloaded)
+            self.assertIn('state', inspect(c).unloaded)
+
 
 class TestDownstreamNodeFuncs(unittest.TestCase):
     def setUp(self):
@@ -810,6 +1249,8 @@ class TestDownstreamNodeFuncs(unittest.TestCase):
         address = models.Address(address=self.test_address,crowdsale_balance=20000)
         db.session.add(address)
         db.session.commit()
+        # contract ids are reused after the tables are recreated
+        app.state_cache.clear()
 
     def tearDown(self):
         db.session.close()
@@ -859,12 +1300,31 @@ class TestDownstreamNodeFuncs(unittest.TestCase):
                 db_token = node.create_token(base58.b58encode_check(b'\x00'+os.urandom(20)),'ipaddress')
         
         self.assertEqual(str(ex.exception),'Invalid address given: address must be in whitelist.')
+
+    def test_create_token_whitelist_index(self):
+        app.whitelist = whitelist.WhitelistIndex()
+        try:
+            with patch('downstream_node.node.get_ip_location') as p:
+                p.return_value = dict()
+                db_token = node.create_token(self.test_address, 'address')
+            self.assertEqual(db_token.address.address, self.test_address)
+            self.assertEqual(len(app.whitelist), 1)
+            
+            # unknown addresses are rejected from the index alone
+            with patch('downstream_node.node.Address') as a,\
+                    patch('downstream_node.node.Token') as t:
+                with self.assertRaises(InvalidParameterError) as ex:
+                    node.create_token(base58.b58encode_check(b'\x00'+os.urandom(20)),'address')
+            self.assertEqual(str(ex.exception),'Invalid address given: address must be in whitelist.')
+            self.assertFalse(a.query.called)
+            self.assertFalse(t.query.called)
+        finally:
+            app.whitelist = None
         
     def test_get_ip_location(self):
-        with patch('downstream_node.node.maxminddb.Reader') as reader:
+        with patch.object(app, 'geoip') as reader:
             for l in [self.full_location, self.partial_location, self.no_location]:
-                reader.return_value = Mock()
-                reader.return_value.get.return_value = l
+                reader.get.return_value = l
                 location = node.get_ip_location('testaddress')
                 if ('country' in l):
                     self.assertEqual(location['country'],l['country']['names']['en'])
@@ -889,6 +1349,11 @@ class TestDownstreamNodeFuncs(unittest.TestCase):
                 else:
                     self.assertIsNone(location['zip'])
 
+    def test_get_ip_location_disabled(self):
+        with patch.object(app, 'geoip', None):
+            location = node.get_ip_location('17.0.0.1')
+        self.assertEqual(set(location.values()), set([None]))
+
     def test_create_token_duplicate_id(self):
         with patch('downstream_node.node.get_ip_location') as p:
             p.return_value = dict()
@@ -1083,6 +1548,117 @@ class TestDownstreamNodeFuncs(unittest.TestCase):
             beat_patch.gen_challenge.side_effect = heartbeat.HeartbeatError('test error')
             self.assertFalse(node.contract_insert_next_challenge(db_contract))
         
+    def test_contract_insert_next_challenge_pregenerated(self):
+        db_contract = self.add_test_contract()
+        db_contract.next_challenge = 'next challenge'
+        db_contract.next_state = 'next state'
+        db.session.commit()
+        
+        with patch('downstream_node.node.app.heartbeat') as beat_patch:
+            self.assertTrue(node.contract_insert_next_challenge(db_contract))
+            self.assertFalse(beat_patch.gen_challenge.called)
+        db.session.commit()
+        
+        self.assertEqual(db_contract.challenge, 'next challenge')
+        self.assertEqual(db_contract.state._underlying_object, 'next state')
+        self.assertIsNone(db_contract.next_challenge)
+        self.assertIsNone(db_contract.next_state)
+        
+    def test_contract_insert_next_challenge_version(self):
+        db_contract = self.add_test_contract()
+        version = db_contract.state_version
+
+        with patch('downstream_node.node.app.heartbeat') as beat_patch:
+            beat_patch.gen_challenge.return_value = 'new challenge'
+            self.assertTrue(node.contract_insert_next_challenge(db_contract))
+        db.session.commit()
+
+        self.assertEqual(db_contract.state_version, version + 1)
+        self.assertEqual(db_contract.challenge, 'new challenge')
+
+    def test_heartbeat_pool(self):
+        with patch('downstream_node.node.app.heartbeat_pool') as pool:
+            pool.gen_challenge.return_value = ('challenge', 'new state')
+            pool.verify.return_value = True
+            self.assertEqual(node.gen_challenge('state'),
+                             ('challenge', 'new state'))
+            self.assertTrue(node.verify_heartbeat('proof', 'challenge',
+                                                  'new state'))
+        pool.gen_challenge.assert_called_once_with('state')
+        pool.verify.assert_called_once_with('proof', 'challenge', 'new state')
+
+    def test_contract_heartbeat_cached(self):
+        db_contract = self.add_test_contract()
+        hits = app.state_cache.hits
+
+        (state, chal) = node.contract_heartbeat(db_contract)
+        self.assertEqual(chal, 'test challenge')
+        self.assertNotIsInstance(state, MutableTypeWrapper)
+        self.assertIs(node.contract_heartbeat(db_contract)[0], state)
+        self.assertEqual(app.state_cache.hits, hits + 1)
+
+        # a new version is read from the contract again
+        db_contract.state_version += 1
+        db_contract.challenge = 'new challenge'
+        self.assertEqual(node.contract_heartbeat(db_contract)[1],
+                         'new challenge')
+        db.session.commit()
+        self.assertEqual(node.contract_heartbeat(db_contract)[1],
+                         'new challenge')
+
+    def test_contract_heartbeat_reused_id(self):
+        db_contract = self.add_test_contract()
+        db_contract.start = datetime.utcnow() - timedelta(seconds=60)
+        db.session.commit()
+        contract_id = db_contract.id
+        self.assertEqual(node.contract_heartbeat(db_contract)[1],
+                         'test challenge')
+
+        # the contract is cleaned up and its id is given to a new one
+        db.session.delete(db_contract)
+        db.session.commit()
+        db_contract = models.Contract(id=contract_id,
+                                      token_id=db_contract.token_id,
+                                      file_id=db_contract.file_id,
+                                      state='new state',
+                                      challenge='new challenge',
+                                      start=datetime.utcnow(),
+                                      due=datetime.utcnow())
+        db.session.add(db_contract)
+        db.session.commit()
+        self.assertFalse(node.heartbeat_cached(db_contract))
+        self.assertEqual(node.contract_heartbeat(db_contract),
+                         ('new state', 'new challenge'))
+
+    def test_pregenerate_challenges(self):
+        db_contract = self.add_test_contract()
+        db_contract.answered = True
+        db.session.commit()
+        
+        with patch('downstream_node.node.app.heartbeat') as beat_patch:
+            beat_patch.gen_challenge.return_value = 'pregenerated challenge'
+            self.assertEqual(node.pregenerate_challenges(30), 1)
+            # already generated, so nothing else to do
+            self.assertEqual(node.pregenerate_challenges(30), 0)
+        
+        db.session.refresh(db_contract)
+        self.assertEqual(db_contract.next_challenge, 'pregenerated challenge')
+        self.assertEqual(db_contract.challenge, 'test challenge')
+        
+    def test_pregenerate_challenges_exhausted(self):
+        db_contract = self.add_test_contract()
+        db_contract.answered = True
+        db.session.commit()
+        
+        exhausted = set()
+        with patch('downstream_node.node.app.heartbeat') as beat_patch:
+            beat_patch.gen_challenge.side_effect = heartbeat.HeartbeatError('test error')
+            self.assertEqual(node.pregenerate_challenges(30, exhausted=exhausted), 0)
+            self.assertEqual(exhausted, set([db_contract.id]))
+            beat_patch.gen_challenge.reset_mock()
+            self.assertEqual(node.pregenerate_challenges(30, exhausted=exhausted), 0)
+            self.assertFalse(beat_patch.gen_challenge.called)
+        
     def test_get_chunk_contracts_no_chunks(self):
         db_token = self.add_test_token()
         
@@ -1154,6 +1730,38 @@ class TestDownstreamHttpHandler(unittest.TestCase):
             raise test_exception
         
         logger.log_exception.assert_called_with(test_exception, handler.context)
+
+    def test_logging_query_stats(self):
+        logger = mock.MagicMock()
+        stats = sqlstats.QueryStats()
+        stats.record('SELECT 1', 0.5)
+        with patch('downstream_node.exc.jsonify'),\
+                patch('downstream_node.exc.current_stats',
+                      return_value=stats),\
+                HttpHandler(logger) as handler:
+            raise Exception('test exception')
+
+        self.assertEqual(handler.context['queries']['count'], 1)
+        self.assertEqual(handler.context['queries']['slowest'], 'SELECT 1')
+
+    def test_log_event_query_stats(self):
+        logger = mock.MagicMock()
+        stats = sqlstats.QueryStats()
+        stats.record('SELECT 1', 0.5)
+        with patch('downstream_node.exc.current_stats',
+                   return_value=stats):
+            with HttpHandler(logger, dict(token='a')) as handler:
+                handler.log_event('challenge', dict(challenges=[]))
+
+        logger.log_event.assert_called_once_with(
+            'challenge', {'context': handler.context,
+                          'response': dict(challenges=[])})
+        self.assertEqual(handler.context['token'], 'a')
+        self.assertEqual(handler.context['queries']['count'], 1)
+        self.assertIsNone(handler.response)
+
+    def test_context_not_shared(self):
+        self.assertIsNot(HttpHandler().context, HttpHandler().context)
         
 class TestDownstreamNodeLog(unittest.TestCase):
     def test_init(self):
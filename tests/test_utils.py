@@ -111,3 +111,83 @@ class TestMonopolyDistribution(unittest.TestCase):
         self.assertIn(left, missing)
         self.assertIn(right, missing)
         self.assertEqual(len(missing), 2)
+
+
+class TestHistogram(unittest.TestCase):
+    def setUp(self):
+        self.histogram = utils.Histogram([1, 2, 4])
+
+    def tearDown(self):
+        pass
+
+    def test_observe(self):
+        for v in [0.5, 1, 1.5, 3, 10]:
+            self.histogram.observe(v)
+        self.assertEqual(self.histogram.counts, [2, 1, 1, 1])
+        self.assertEqual(self.histogram.count, 5)
+        self.assertEqual(self.histogram.total, 16)
+        self.assertEqual(self.histogram.mean(), 3.2)
+
+    def test_percentile(self):
+        for v in [0.5] * 50 + [3] * 50:
+            self.histogram.observe(v)
+        self.assertAlmostEqual(self.histogram.percentile(50), 1)
+        self.assertAlmostEqual(self.histogram.percentile(75), 3)
+        self.assertAlmostEqual(self.histogram.percentile(100), 4)
+
+    def test_percentile_overflow(self):
+        self.histogram.observe(100)
+        self.assertEqual(self.histogram.percentile(99), 4)
+
+    def test_empty(self):
+        self.assertEqual(self.histogram.percentile(50), 0)
+        self.assertEqual(self.histogram.mean(), 0)
+
+    def test_cumulative(self):
+        histogram = utils.Histogram([1, 2], [1, 2, 3], 10)
+        self.assertEqual(histogram.cumulative(), [(1, 1), (2, 3), (None, 6)])
+
+
+class TestLRUCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = utils.LRUCache(2)
+
+    def tearDown(self):
+        pass
+
+    def test_get(self):
+        self.cache.put('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('b', 2), 2)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertIn('c', self.cache)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_put_existing(self):
+        self.cache.put('a', 1)
+        self.cache.put('a', 2)
+        self.assertEqual(self.cache.get('a'), 2)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.evictions, 0)
+
+    def test_stats(self):
+        self.assertEqual(self.cache.hit_rate(), 0)
+        self.cache.put('a', 1)
+        self.cache.get('a')
+        self.cache.get('b')
+        self.cache.clear()
+        stats = self.cache.stats()
+        self.assertEqual(stats['size'], 0)
+        self.assertEqual(stats['capacity'], 2)
+        self.assertEqual(stats['hit_rate'], 0.5)
@@ -0,0 +1,87 @@
+import os
+import unittest
+
+from mock import patch
+
+from downstream_node import whitelist
+
+
+class TestBloomFilter(unittest.TestCase):
+    def setUp(self):
+        self.items = ['address{0}'.format(i) for i in range(0, 1000)]
+        self.bloom = whitelist.BloomFilter(len(self.items))
+        for item in self.items:
+            self.bloom.add(item)
+
+    def tearDown(self):
+        pass
+
+    def test_contains(self):
+        for item in self.items:
+            self.assertIn(item, self.bloom)
+
+    def test_false_positive_rate(self):
+        false_positives = sum([1 for i in range(0, 10000)
+                               if 'other{0}'.format(i) in self.bloom])
+        self.assertLess(false_positives, 300)
+
+    def test_bytes(self):
+        self.bloom.add(b'bytes item')
+        self.assertIn(b'bytes item', self.bloom)
+
+    def test_empty(self):
+        bloom = whitelist.BloomFilter(0)
+        self.assertNotIn('address', bloom)
+
+
+class TestWhitelistIndex(unittest.TestCase):
+    def setUp(self):
+        self.stamp_path = 'test_whitelist.stamp'
+        self.rows = [('address0', 1, 20000),
+                     ('address1', 2, 5000),
+                     ('address2', 3, None)]
+        self.index = whitelist.WhitelistIndex(self.stamp_path, 0)
+
+    def tearDown(self):
+        if (os.path.exists(self.stamp_path)):
+            os.remove(self.stamp_path)
+
+    def test_unloaded_is_stale(self):
+        self.assertTrue(self.index.is_stale())
+        self.assertIsNone(self.index.lookup('address0'))
+
+    def test_lookup(self):
+        self.index.load(self.rows)
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.lookup('address0'), (1, 20000))
+        self.assertEqual(self.index.lookup('address1'), (2, 5000))
+        self.assertEqual(self.index.lookup('address2'), (3, None))
+        self.assertIsNone(self.index.lookup('address3'))
+
+    def test_lookup_bloom_miss(self):
+        self.index.load(self.rows)
+        with patch.object(self.index, 'addresses') as addresses:
+            self.assertIsNone(self.index.lookup('not an address'))
+        self.assertFalse(addresses.get.called)
+
+    def test_stamp(self):
+        whitelist.touch_stamp(self.stamp_path)
+        self.index.load(self.rows)
+        self.assertFalse(self.index.is_stale())
+        with open(self.stamp_path, 'w') as f:
+            f.write('changed')
+        self.assertTrue(self.index.is_stale())
+        self.index.load(self.rows[:1])
+        self.assertFalse(self.index.is_stale())
+        self.assertIsNone(self.index.lookup('address1'))
+
+    def test_stamp_check_interval(self):
+        index = whitelist.WhitelistIndex(self.stamp_path, 3600)
+        index.load(self.rows)
+        whitelist.touch_stamp(self.stamp_path)
+        self.assertFalse(index.is_stale())
+
+    def test_no_stamp(self):
+        index = whitelist.WhitelistIndex()
+        index.load(self.rows)
+        self.assertFalse(index.is_stale())
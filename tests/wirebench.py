@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Measures the bytes on the wire and the cpu cost of each response encoding
+# for the large farmer responses: /chunk/, /challenge/ and /answer/ for a
+# farmer with --chunks contracts, and the status list for --farmers
+# farmers.  Each route is requested once, in process against a fresh
+# database, and its response is then encoded --repeat times with each
+# encoding.
+#
+#     python tests/wirebench.py --chunks 50 --farmers 100
+#
+# The cpu column is the median time to encode the response, next to the
+# time the route took to serve it as json.  msgpack is only measured if the
+# msgpack package is installed.  --output writes the results as json, along
+# with the commit they were measured at.
+
+import io
+import json
+import time
+import argparse
+import platform
+
+from RandomIO import RandomIO
+
+from loadtest import (app, db, models, node, LocalClient, farmer_address,
+                      prepare_local, current_commit)
+
+from downstream_node import encoding  # NOQA
+
+# cpu time, where there is a clock for it
+process_time = getattr(time, 'process_time', None) or time.clock
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def timed(f, repeat):
+    """Returns the result of f and the median cpu time it took"""
+    times = list()
+    for i in range(0, repeat):
+        start = process_time()
+        result = f()
+        times.append(process_time() - start)
+    return (result, median(times))
+
+
+def encodings(level):
+    """Returns the (name, encode) pairs to measure.  encode takes the json
+    body and the decoded object and returns the encoded bytes"""
+    pairs = [('json', lambda body, obj: body),
+             ('json+deflate',
+              lambda body, obj: encoding.compress(body, 'deflate', level)),
+             ('json+gzip',
+              lambda body, obj: encoding.compress(body, 'gzip', level))]
+    if (encoding.msgpack is not None):
+        packb = encoding.msgpack.packb
+        pairs += [('msgpack', lambda body, obj: packb(obj, use_bin_type=True)),
+                  ('msgpack+gzip',
+                   lambda body, obj: encoding.compress(
+                       packb(obj, use_bin_type=True), 'gzip', level))]
+    return pairs
+
+
+class Recorder(object):
+
+    """Requests routes as a farmer and keeps their json responses"""
+
+    def __init__(self, client):
+        self.client = client
+        # route -> (body, cpu time)
+        self.responses = dict()
+
+    def request(self, route, method, path, data=None):
+        start = process_time()
+        (status, body) = self.client.request(method, path, data)
+        elapsed = process_time() - start
+        if (status != 200):
+            raise RuntimeError('{0} failed: {1}'.format(path, body))
+        self.responses[route] = (body, elapsed)
+        return json.loads(body.decode('utf-8'))
+
+
+def prepare(args):
+    """Resets the database, gives a farmer --chunks contracts and every
+    other farmer one, and records the responses of the routes"""
+    addresses = [farmer_address(args.seed, i)
+                 for i in range(0, args.farmers)]
+    # the first farmer takes every chunk prepared so far
+    prepare_local(argparse.Namespace(database=args.database,
+                                     farmers=args.farmers,
+                                     seed=args.seed,
+                                     size=args.size,
+                                     interval=60),
+                  addresses[0:args.chunks])
+    for address in addresses[args.chunks:]:
+        db.session.add(models.Address(
+            address=address,
+            crowdsale_balance=app.config['MIN_SJCX_BALANCE']))
+    db.session.commit()
+
+    farmer = Recorder(LocalClient('10.0.0.1'))
+    r = farmer.request('/new/', 'GET', '/new/{0}'.format(addresses[0]))
+    token = r['token']
+    beat = app.config['HEARTBEAT'].fromdict(r['heartbeat'])
+    chunks = farmer.request('/chunk/', 'GET', '/chunk/{0}'.format(token))
+    proofs = list()
+    for c in chunks['chunks']:
+        data = RandomIO(c['seed']).read(c['size'])
+        chal = beat.challenge_type().fromdict(c['challenge'])
+        tag = beat.tag_type().fromdict(c['tag'])
+        proofs.append(dict(file_hash=c['file_hash'],
+                           proof=beat.prove(io.BytesIO(data), chal,
+                                            tag).todict()))
+    farmer.request('/answer/', 'POST', '/answer/{0}'.format(token),
+                   dict(proofs=proofs))
+    farmer.request('/challenge/', 'GET', '/challenge/{0}'.format(token))
+
+    print('Preparing {0} farmers...'.format(args.farmers))
+    for (i, address) in enumerate(addresses[1:]):
+        client = LocalClient('10.0.{0}.{1}'.format(i // 250, i % 250 + 2))
+        r = json.loads(client.request(
+            'GET', '/new/{0}'.format(address))[1].decode('utf-8'))
+        db_file = node.add_file(address, args.size, 1, 60)
+        node.prepare_contract(db_file)
+        client.request('GET', '/chunk/{0}'.format(r['token']))
+    farmer.request('/status/list/', 'GET', '/status/list/')
+
+    return farmer.responses
+
+
+def main():
+    parser = argparse.ArgumentParser('wirebench')
+    parser.add_argument('--chunks', type=int, default=20,
+                        help='number of contracts of the measured farmer')
+    parser.add_argument('--farmers', type=int, default=50,
+                        help='number of farmers in the status list')
+    parser.add_argument('--size', type=int, default=1000,
+                        help='chunk size')
+    parser.add_argument('--level', type=int, default=6,
+                        help='zlib compression level')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='number of times to encode each response')
+    parser.add_argument('--seed', default='wirebench',
+                        help='seed for the farmer addresses and chunks')
+    parser.add_argument('--database', default='sqlite:///wirebench.db',
+                        help='database to reset and use')
+    parser.add_argument('--output', help='write the results as json')
+    args = parser.parse_args()
+    args.farmers = max(args.farmers, args.chunks)
+
+    responses = prepare(args)
+
+    results = dict()
+    print('{0:<14} {1:<14} {2:>9} {3:>7} {4:>9} {5:>11}'.format(
+        'route', 'encoding', 'bytes', 'ratio', 'cpu us', 'route cpu us'))
+    for route in ['/chunk/', '/challenge/', '/answer/', '/status/list/']:
+        (body, route_time) = responses[route]
+        obj = json.loads(body.decode('utf-8'))
+        results[route] = dict(route_time=route_time, encodings=dict())
+        for (name, encode) in encodings(args.level):
+            (data, cpu) = timed(lambda: encode(body, obj), args.repeat)
+            results[route]['encodings'][name] = dict(bytes=len(data),
+                                                     time=cpu)
+            print('{0:<14} {1:<14} {2:>9} {3:>7.3f} {4:>9.1f} {5:>11.1f}'
+                  .format(route, name, len(data),
+                          float(len(data)) / len(body), cpu * 1000000,
+                          route_time * 1000000))
+
+    if (args.output is not None):
+        report = dict(commit=current_commit(),
+                      python=platform.python_version(),
+                      platform=platform.platform(),
+                      chunks=args.chunks,
+                      farmers=args.farmers,
+                      size=args.size,
+                      level=args.level,
+                      repeat=args.repeat,
+                      msgpack=encoding.msgpack is not None,
+                      results=results)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()